@@ -11,8 +11,10 @@
 from __future__ import print_function
 
 import arrow
+import email.utils
 import logging
 import json
+import random
 import socket
 
 import requests
@@ -48,9 +50,11 @@ def _translate_errors(fcn, post_params=None):
         if response.status_code not in [200, 206]:
             # Decode the error object returned by the service
             error = json.loads(response.content.decode('utf-8'))
-            raise interpret_b2_error(
+            e = interpret_b2_error(
                 int(error['status']), error['code'], error['message'], post_params
             )
+            e.retry_after = _parse_retry_after(response.headers.get('Retry-After'))
+            raise e
         return response
 
     except B2Error:
@@ -83,21 +87,51 @@ def _translate_errors(fcn, post_params=None):
         raise UnknownError(repr(e))
 
 
+def _parse_retry_after(value):
+    """
+    Returns the seconds to wait from a Retry-After header, which is either
+    a number of seconds or an HTTP date, or None if there isn't one.
+    """
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    parsed = email.utils.parsedate_tz(value)
+    if parsed is None:
+        return None
+    return max(0.0, email.utils.mktime_tz(parsed) - time.time())
+
+
+def backoff_time(attempt, retry_after=None, base=1.0, cap=64.0):
+    """
+    Returns the seconds to wait before retry number attempt (0 for the
+    first retry).  The wait doubles with every attempt up to cap, and
+    the second half of it is random so that the threads and clients that
+    failed together don't all come back at the same moment.  When the
+    service said how long to wait, that is waited instead, plus a little
+    jitter for the same reason.
+    """
+    if retry_after is not None:
+        return retry_after + random.uniform(0, base)
+    wait_time = min(cap, base * 2 ** attempt)
+    return wait_time / 2 + random.uniform(0, wait_time / 2)
+
+
 def _translate_and_retry(fcn, try_count, post_params=None):
     """
     Try calling fcn try_count times, retrying only if
     the exception is a retryable B2Error.
     """
     # For all but the last try, catch the exception.
-    wait_time = 1.0
-    for _ in range(try_count - 1):
+    for attempt in range(try_count - 1):
         try:
             return _translate_errors(fcn, post_params)
         except B2Error as e:
             if not e.should_retry_http():
                 raise
-            time.sleep(wait_time)
-            wait_time *= 1.5
+            time.sleep(backoff_time(attempt, e.retry_after))
 
     # If the last try gets an exception, it will be raised.
     return _translate_errors(fcn, post_params)
@@ -118,6 +152,43 @@ class ResponseContextManager(object):
         self.response.close()
 
 
+class LimitedResponse(object):
+    """
+    A streamed response that holds a slot of the concurrency controller
+    until it is closed, and reports the bytes read from its body.
+    Everything except iter_content() and close() is passed through to
+    the response.
+    """
+
+    def __init__(self, response, concurrency):
+        self.response = response
+        self.concurrency = concurrency
+        self.bytes_read = 0
+        self.closed = False
+
+    def iter_content(self, *args, **kwargs):
+        try:
+            for data in self.response.iter_content(*args, **kwargs):
+                self.bytes_read += len(data)
+                yield data
+        except requests.Timeout:
+            self.concurrency.congestion()
+            raise
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            self.response.close()
+        finally:
+            self.concurrency.success(self.bytes_read)
+            self.concurrency.release()
+
+    def __getattr__(self, name):
+        return getattr(self.response, name)
+
+
 class HttpCallback(object):
     """
     A callback object that does nothing.  Override pre_request
@@ -192,6 +263,12 @@ class B2Http(object):
     needed to access B2, and handles retrying when the returned
     status is 503 Service Unavailable or 429 Too Many Requests.
 
+    When a concurrency controller is given every request holds one of its
+    slots while it runs, and tells it how much was transferred or that the
+    service was busy, so the number of requests in flight follows what the
+    service and the link can take.  A GET holds its slot until the response
+    is closed, so downloads are limited while their bodies stream.
+
     The operations supported are:
        - post_json_return_json
        - post_content_return_json
@@ -207,16 +284,20 @@ class B2Http(object):
             ...
     """
 
-    def __init__(self, requests_module=None, install_clock_skew_hook=True):
+    def __init__(self, requests_module=None, install_clock_skew_hook=True, concurrency=None):
         """
         Initialize with a reference to the requests module, which makes
         it easy to mock for testing.
 
         The optional after_request_hook is called on the Response
         object after every request that doesn't throw an exception.
+
+        :param concurrency: object with acquire(), release(), success(nbytes)
+                            and congestion(), or None to not limit requests
         """
         requests_to_use = requests_module or requests
         self.session = requests_to_use.Session()
+        self.concurrency = concurrency
         self.callbacks = []
         if install_clock_skew_hook:
             self.add_callback(ClockSkewHook())
@@ -252,7 +333,10 @@ class B2Http(object):
         def do_post():
             data.seek(0)
             self._run_pre_request_hooks('POST', url, headers)
-            response = self.session.post(url, headers=headers, data=data)
+            response = self._limited(
+                lambda: self.session.post(url, headers=headers, data=data),
+                int(headers.get('Content-Length', 0))
+            )
             self._run_post_request_hooks('POST', url, headers, response)
             return response
 
@@ -314,13 +398,52 @@ class B2Http(object):
         # Do the HTTP GET.
         def do_get():
             self._run_pre_request_hooks('GET', url, headers)
-            response = self.session.get(url, headers=headers, stream=True)
-            self._run_post_request_hooks('GET', url, headers, response)
+            # the body is streamed by the caller, a successful response keeps its slot until it's closed
+            response = self._limited(
+                lambda: self.session.get(url, headers=headers, stream=True),
+                None
+            )
+            if self.concurrency is not None and response.status_code in [200, 206]:
+                response = LimitedResponse(response, self.concurrency)
+            try:
+                self._run_post_request_hooks('GET', url, headers, response)
+            except BaseException:
+                response.close()
+                raise
             return response
 
         response = _translate_and_retry(do_get, try_count, None)
         return ResponseContextManager(response)
 
+    def _limited(self, fcn, sent_bytes):
+        """
+        Runs one request in a slot of the concurrency controller, and
+        reports the bytes transferred or the congestion to it.
+
+        :param sent_bytes: bytes in the request, None for a streamed
+                           response that keeps the slot when it succeeds,
+                           LimitedResponse releases it and reports the
+                           bytes read from the body
+        """
+        if self.concurrency is None:
+            return fcn()
+        self.concurrency.acquire()
+        try:
+            response = fcn()
+        except BaseException as e:
+            self.concurrency.release()
+            if isinstance(e, requests.Timeout):
+                self.concurrency.congestion()
+            raise
+        if response.status_code in [200, 206]:
+            if sent_bytes is None:
+                return response
+            self.concurrency.success(sent_bytes)
+        elif response.status_code == 429 or response.status_code >= 500:
+            self.concurrency.congestion()
+        self.concurrency.release()
+        return response
+
     def _run_pre_request_hooks(self, method, url, headers):
         for callback in self.callbacks:
             callback.pre_request(method, url, headers)
@@ -8,10 +8,13 @@
 #
 ######################################################################
 
+import collections
 import logging
 import six
 import threading
+import time
 
+from .b2http import backoff_time
 from .download_dest import DownloadDestProgressWrapper
 from .exception import (
     AlreadyFailed, B2Error, MaxFileSizeExceeded, MaxRetriesExceeded, UnrecognizedBucketType
@@ -99,6 +102,8 @@ class Bucket(object):
     MAX_UPLOAD_ATTEMPTS = 5
     MAX_LARGE_FILE_SIZE = 10 * 1000 * 1000 * 1000 * 1000  # 10 TB
     MAX_LARGE_FILE_PART_SIZE = 5 * 1000 * 1000 * 1000  # 5 GB
+    MAX_LARGE_FILE_PARTS = 10000
+    MAX_STREAM_PARTS_IN_MEMORY = 2
 
     def __init__(
         self, api, id_, name=None, type_=None, bucket_info=None, revision=None, bucket_dict=None
@@ -380,6 +385,165 @@ class Bucket(object):
                 ignore_unfinished_check, progress_listener
             )
 
+    def upload_stream(
+        self,
+        input_stream,
+        file_name,
+        content_type=None,
+        file_info=None,
+        min_large_file_size=None,
+        content_length_hint=None,
+        max_parts_in_memory=None,
+        progress_listener=None
+    ):
+        """
+        AS: Uploads a stream of unknown length to B2 without a temp file.
+
+        Streams shorter than min_large_file_size are read in to memory and uploaded as a
+        small file.  Longer streams are uploaded as a large file, each part is buffered in
+        memory just long enough to compute its sha1 and send it.  The stream can't be
+        re-read, so a large file that fails is cancelled instead of being left to resume.
+
+        :param input_stream: binary file-like object, only read() is used
+        :param file_name: the file name of the new B2 file
+        :param content_type: the MIME type, or None to accept the default based on file extension of the B2 file name
+        :param file_info: custom file info to be stored with the file
+        :param min_large_file_size: minimum size for a file to be considered large
+        :param content_length_hint: approximate length of the stream, used to pick a part size that keeps the
+                                    part count under the B2 limit
+        :param max_parts_in_memory: max number of parts that are buffered or uploading at once
+        :param progress_listener: object to notify as data is transferred
+        :return: FileVersionInfo of the new file
+        """
+        validate_b2_file_name(file_name)
+        file_info = file_info or {}
+        content_type = content_type or self.DEFAULT_CONTENT_TYPE
+        progress_listener = progress_listener or DoNothingProgressListener()
+        max_parts_in_memory = max_parts_in_memory or self.MAX_STREAM_PARTS_IN_MEMORY
+
+        part_size = self.stream_part_size(self.api.account_info.get_minimum_part_size(), content_length_hint)
+        min_large_file_size = max(min_large_file_size or 0, part_size)
+
+        # Read the start of the stream, if it ends before the large file size it's a small file
+        head = self._read_full(input_stream, min_large_file_size)
+        tail = self._read_full(input_stream, 1) if len(head) == min_large_file_size else b''
+        if not tail:
+            return self.upload(
+                UploadSourceBytes(head),
+                file_name,
+                content_type=content_type,
+                file_info=file_info,
+                min_large_file_size=len(head) + 1,
+                progress_listener=progress_listener
+            )
+
+        large_file_upload_state = LargeFileUploadState(progress_listener)
+        unfinished_file = self.start_large_file(file_name, content_type, file_info)
+        file_id = unfinished_file.file_id
+        try:
+            # Keep a limited number of parts in flight so memory use is bounded
+            part_futures = collections.deque()
+            part_sha1_array = []
+            parts = self._iter_stream_parts(input_stream, part_size, head + tail)
+            del head, tail
+            for part_index, part in enumerate(parts):
+                if self.MAX_LARGE_FILE_PARTS <= part_index:
+                    raise MaxFileSizeExceeded(part_index * part_size, self.MAX_LARGE_FILE_PARTS * part_size)
+                if max_parts_in_memory <= len(part_futures):
+                    part_sha1_array.append(interruptible_get_result(part_futures.popleft())['contentSha1'])
+                part_futures.append(
+                    self.api.get_thread_pool().submit(
+                        self._upload_part,
+                        file_id,
+                        part_index + 1,  # part number
+                        (0, len(part)),
+                        UploadSourceBytes(part),
+                        large_file_upload_state
+                    )
+                )
+                del part
+            part_sha1_array.extend(interruptible_get_result(f)['contentSha1'] for f in part_futures)
+
+            response = self.api.session.finish_large_file(file_id, part_sha1_array)
+        except:
+            large_file_upload_state.set_error('stream upload failed')
+            logger.exception('error when uploading stream, cancelling large file %s', file_id)
+            self.cancel_large_file(file_id)
+            raise
+        progress_listener.close()
+        return FileVersionInfoFactory.from_api_response(response)
+
+    @classmethod
+    def stream_part_size(cls, minimum_part_size, content_length_hint=None):
+        """
+        Returns the part size upload_stream uses for a stream of about content_length_hint bytes.
+        """
+        part_size = minimum_part_size
+        if content_length_hint:
+            part_size = max(part_size, content_length_hint // (cls.MAX_LARGE_FILE_PARTS - 1000))
+        return part_size
+
+    @classmethod
+    def stream_memory_size(
+        cls, minimum_part_size, content_length, min_large_file_size=None, max_parts_in_memory=None
+    ):
+        """
+        Returns the most bytes upload_stream holds in memory at once for a stream of about
+        content_length bytes, so callers can budget the memory of the uploads that run at once.
+
+        :param minimum_part_size: the account's minimum part size, as used by upload_stream
+        """
+        max_parts_in_memory = max_parts_in_memory or cls.MAX_STREAM_PARTS_IN_MEMORY
+        part_size = cls.stream_part_size(minimum_part_size, content_length)
+        min_large_file_size = max(min_large_file_size or 0, part_size)
+        # the stream is compressed and encrypted, leave room for it to come out a little longer
+        if content_length + content_length // 100 + 64 * 1024 < min_large_file_size:
+            # read whole and uploaded as a small file, _read_full holds the last chunk read, its
+            # buffer and the bytes copied from the buffer
+            return 3 * content_length
+        # the head is read the same way, then it's cut in to parts.  Each part that is uploading
+        # is held twice (the part and the copy it's read from), and up to two more parts' worth
+        # are held while the next one is read and joined
+        return max(
+            3 * min_large_file_size,
+            min_large_file_size + 1 + (2 * max_parts_in_memory + 2) * part_size
+        )
+
+    @classmethod
+    def _iter_stream_parts(cls, input_stream, part_size, buffered):
+        """
+        Yields the stream in parts of part_size bytes, starting with the bytes that were
+        already read from it.  Only the last part can be smaller.
+        """
+        offset = 0
+        while part_size <= len(buffered) - offset:
+            yield buffered[offset:offset + part_size]
+            offset += part_size
+        remainder = buffered[offset:]
+        del buffered
+
+        while True:
+            part = remainder + cls._read_full(input_stream, part_size - len(remainder))
+            remainder = b''
+            if not part:
+                return
+            yield part
+            if len(part) < part_size:
+                return
+
+    @classmethod
+    def _read_full(cls, input_stream, size):
+        """
+        Reads exactly size bytes from the stream, less if the stream ends first.
+        """
+        buf = bytearray()
+        while len(buf) < size:
+            data = input_stream.read(size - len(buf))
+            if not data:
+                break
+            buf.extend(data)
+        return bytes(buf)
+
     def _upload_small_file(
         self, upload_source, file_name, content_type, file_info, progress_listener
     ):
@@ -387,7 +551,10 @@ class Bucket(object):
         sha1_sum = upload_source.get_content_sha1()
         upload_url = None
         exception_info_list = []
-        for _ in six.moves.xrange(self.MAX_UPLOAD_ATTEMPTS):
+        for attempt in six.moves.xrange(self.MAX_UPLOAD_ATTEMPTS):
+            if attempt:
+                # give a busy service time to recover instead of hitting it again right away
+                time.sleep(backoff_time(attempt - 1, exception_info_list[-1].retry_after))
             # refresh upload data in every attempt to work around a "busy storage pod"
             upload_url, upload_auth_token = self._get_upload_data()
 
@@ -533,7 +700,10 @@ class Bucket(object):
         upload_url = None
         # Retry the upload as needed
         exception_list = []
-        for _ in six.moves.xrange(self.MAX_UPLOAD_ATTEMPTS):
+        for attempt in six.moves.xrange(self.MAX_UPLOAD_ATTEMPTS):
+            if attempt:
+                # give a busy service time to recover instead of hitting it again right away
+                time.sleep(backoff_time(attempt - 1, exception_list[-1].retry_after))
             # refresh upload data in every attempt to work around a "busy storage pod"
             upload_url, upload_auth_token = self._get_upload_part_data(file_id)
 
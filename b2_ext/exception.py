@@ -18,6 +18,9 @@ from .utils import camelcase_to_underscore
 
 @six.add_metaclass(ABCMeta)
 class B2Error(Exception):
+    # seconds the service asked to wait before trying again (Retry-After header), None if it didn't say
+    retry_after = None
+
     def __init__(self, *args, **kwargs):
         """
         Python 2 does not like it when you pass unicode as the message
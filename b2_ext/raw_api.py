@@ -220,7 +220,8 @@ class B2RawApi(AbstractRawApi):
             assert (range_[0] + 0) <= (range_[1] + 0), range_  # not strings
             assert range_[0] >= 0, range_
             assert range_[1] >= 1, range_
-            request_headers['Range'] = "bytes=%d-%d" % range_
+            # the end of range_ is exclusive like a slice, the end of the header is inclusive
+            request_headers['Range'] = "bytes=%d-%d" % (range_[0], range_[1] - 1)
 
         if account_auth_token_or_none is not None:
             request_headers['Authorization'] = account_auth_token_or_none
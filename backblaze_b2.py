@@ -1,12 +1,13 @@
 import os
 
 import logging
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from b2_ext.account_info.sqlite_account_info import (SqliteAccountInfo)
 from b2_ext.api import (B2Api, B2RawApi)
 from b2_ext.api import Bucket
 from b2_ext.b2http import (B2Http)
 from b2_ext.cache import (AuthInfoCache)
-from b2_ext.download_dest import DownloadDestLocalFile
 from b2_ext.exception import B2Error
 from b2_ext.raw_api import SRC_LAST_MODIFIED_MILLIS
 from b2_ext.upload_source import UploadSourceLocalFile
@@ -16,6 +17,15 @@ from utility import util
 
 log = logging.getLogger()
 
+# custom file info key that records the crypto backend of a secure file
+CRYPTO_BACKEND_INFO = 'ssync_crypto'
+# custom file info key that records the journal sequence number of an index base or delta
+INDEX_SEQ_INFO = 'ssync_seq'
+# largest page b2_list_file_versions returns
+MAX_LIST_PAGE = 10000
+# characters secure names are made of (url safe base64), in sort order
+SECURE_NAME_ALPHABET = '-0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZ_abcdefghijklmnopqrstuvwxyz'
+
 def authorizeAccount(api, accountId, applicationKey):
     try:
         api.authorize_account('production', accountId, applicationKey)
@@ -24,9 +34,12 @@ def authorizeAccount(api, accountId, applicationKey):
         print('ERROR: unable to authorize account: ' + str(e))
         return 1
 
-def setupApi(conf):
+def setupApi(conf, concurrency=None):
+    """
+    :param concurrency: AimdController that limits the requests in flight, None to not limit them
+    """
     info = SqliteAccountInfo('b2_account_info')
-    b2Http = B2Http()
+    b2Http = B2Http(concurrency=concurrency)
     rawApi = B2RawApi(b2Http)
     b2Api = B2Api(info, AuthInfoCache(info), raw_api=rawApi)
     authorizeAccount(b2Api, conf.AccountId, conf.ApplicationKey)
@@ -41,6 +54,67 @@ def getFileInfoByName(api, bucketName, fileName):
     else:
         return bucketFiles['files'][0]
 
+def listFileInfosByPrefix(api, bucketName, prefix):
+    """
+    Yields the file info of every file whose name starts with the prefix, sorted by name
+    """
+    bucket = api.get_bucket_by_name(bucketName)
+    startName = prefix
+    while startName is not None:
+        bucketFiles = bucket.list_file_names(startName, 1000)
+        for f in bucketFiles['files']:
+            if not f['fileName'].startswith(prefix):
+                return
+            yield f
+        startName = bucketFiles.get('nextFileName')
+
+def listFileVersionsPartitioned(bucket: Bucket, prefix, boundaries=None, workers=8):
+    """
+    Yields the file version dicts of every file whose name starts with the prefix, in the same order as
+    b2_list_file_versions (by name, newest version first).
+    The names are split into ranges at the boundaries and the ranges are listed concurrently,
+    the results are yielded in order as each range finishes.
+    :param boundaries: sorted names to split the ranges at, defaults to the prefix followed by each
+                       character of SECURE_NAME_ALPHABET
+    :param workers: max number of ranges that are listed at the same time
+    """
+    if boundaries is None:
+        boundaries = [prefix + c for c in SECURE_NAME_ALPHABET[1:]]
+    boundaries = [b for b in boundaries if b > prefix]
+    ranges = iter(zip([prefix] + boundaries, boundaries + [None]))
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        # only list workers ranges ahead of the one that is being yielded so memory stays bounded
+        pending = deque()
+        for start, end in ranges:
+            pending.append(executor.submit(__listFileVersionRange, bucket, prefix, start, end))
+            if len(pending) == workers:
+                break
+        while pending:
+            files = pending.popleft().result()
+            nextRange = next(ranges, None)
+            if nextRange is not None:
+                pending.append(executor.submit(__listFileVersionRange, bucket, prefix, *nextRange))
+            yield from files
+
+def __listFileVersionRange(bucket: Bucket, prefix, start, end):
+    """
+    :return: list of the file version dicts with names that start with the prefix and are >= start and < end
+    """
+    files = []
+    startName = start
+    startId = None
+    while startName is not None:
+        response = bucket.list_file_versions(startName, startId, MAX_LIST_PAGE)
+        for f in response['files']:
+            name = f['fileName']
+            if not name.startswith(prefix) or (end is not None and name >= end):
+                return files
+            files.append(f)
+        startName = response.get('nextFileName')
+        startId = response.get('nextFileId')
+    return files
+
 def getModTimeFromFileInfo(fileInfo):
     """
     get the mod time from the file info object for a remote file
@@ -54,25 +128,60 @@ def getModTimeFromFileInfo(fileInfo):
             return int(fileInfoData[SRC_LAST_MODIFIED_MILLIS])
     return None
 
-def downloadSecureFile(conf, api: B2Api, fileId, destination):
-    tempPath = security.getTempPath(destination)
+def getIndexSeqFromFileInfo(fileInfo):
+    """
+    get the journal sequence number from the file info object for a remote index base or delta
+    :param fileInfo: file info dictionary returned from api
+    :return: sequence number or None for indexes uploaded before journaling
+    """
+    if fileInfo is not None and 'fileInfo' in fileInfo and INDEX_SEQ_INFO in fileInfo['fileInfo']:
+        return int(fileInfo['fileInfo'][INDEX_SEQ_INFO])
+    return None
+
+def getCryptoBackendFromFileInfo(fileInfo):
+    """
+    get the crypto backend from the file info object for a remote secure file
+    :param fileInfo: file info dictionary returned from api
+    :return: backend name or None if it wasn't recorded
+    """
+    if fileInfo is not None and 'fileInfo' in fileInfo:
+        return fileInfo['fileInfo'].get(CRYPTO_BACKEND_INFO)
+    return None
+
+def normalizeContentSha1(contentSha1):
+    """
+    get the sha1 of the whole file from the contentSha1 returned by b2
+    :return: hex sha1 or None if b2 doesn't know it (large files)
+    """
+    if contentSha1 is None or contentSha1 == 'none':
+        return None
+    # files uploaded with the sha1 at the end of the data, b2 checked it but reports it as unverified
+    if contentSha1.startswith('unverified:'):
+        return contentSha1[len('unverified:'):]
+    return contentSha1
 
-    dest = DownloadDestLocalFile(tempPath)
+def downloadSecureFile(conf, api: B2Api, fileId, destination, backendName=None):
+    dest = security.openDecryptDestination(conf, destination, backendName)
     api.download_file_by_id(fileId, dest)
-    security.decompressAndDecrypt(conf, tempPath, destination)
-    util.silentRemove(tempPath)
     log.info(f"Downloaded secure file: '{fileId}' to '{destination}'")
     return 0
 
-def uploadSecureFile(conf, bucket: Bucket, filepath, saveModTime=False, customName=None):
+def uploadSecureFile(conf, bucket: Bucket, filepath, saveModTime=False, customName=None, secureName=None,
+                     extraInfo=None):
+    """
+    :param customName: name to generate the secure name from, defaults to filepath
+    :param secureName: name to upload to as is, overrides customName
+    :param extraInfo: additional custom file info
+    """
     name = customName if customName else filepath
+    fileInfo = {CRYPTO_BACKEND_INFO: conf.CryptoBackend}
     if saveModTime:
-        fileInfo = {SRC_LAST_MODIFIED_MILLIS: str(util.getModTime(filepath))}
-    else:
-        fileInfo = None
+        fileInfo[SRC_LAST_MODIFIED_MILLIS] = str(util.getModTime(filepath))
+    if extraInfo:
+        fileInfo.update(extraInfo)
 
     tempPath = security.compressAndEncrypt(conf, filepath)
-    secureName = security.generateSecureName(conf, name)
+    secureName = secureName or security.generateSecureName(conf, name)
 
     uploadSource = UploadSourceLocalFile(tempPath)
     fileVersionInfo = bucket.upload(uploadSource, secureName, file_info=fileInfo)
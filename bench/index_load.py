@@ -0,0 +1,90 @@
+"""
+Measures how long it takes to load a large index and how much memory the loaded entries use.
+
+python bench/index_load.py --rows 1000000
+python bench/index_load.py --rows 10000000 --index /big/disk/index.db
+
+A synthetic index with the given number of rows is written first (it's reused if the file already has them),
+then a separate process opens it, calls getAll() and reports the time and the growth of its peak RSS.
+"""
+import argparse
+import os
+import resource
+import sqlite3
+import subprocess
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from index.secure_index import SecureIndex, INDEX_TABLE_NAME, INDEX_COLUMNS
+
+BATCH = 100000
+
+
+def peakRssMb():
+    # ru_maxrss is in KB on linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def syntheticRows(count):
+    for i in range(count):
+        path = f'Photos/{i // 100000:03d}/Album {i // 1000 % 100:02d}/IMG_{i:08d}.jpg'
+        yield (path, False, 100000 + i % 5000000, 1500000000000 + i,
+               f'{i:040x}', f'4_z{i:024x}_f{i:016x}', f'{i:064x}', 'done', None, None, None, path.lower())
+
+
+def buildIndex(filename, rows):
+    if os.path.exists(filename):
+        conn = sqlite3.connect(filename)
+        try:
+            if conn.execute(f'SELECT count(*) FROM {INDEX_TABLE_NAME}').fetchone()[0] == rows:
+                return
+        finally:
+            conn.close()
+        os.remove(filename)
+
+    print(f'Writing {rows} rows to {filename}')
+    SecureIndex(filename).flush()
+    columns = INDEX_COLUMNS + ('lowerPath',)
+    conn = sqlite3.connect(filename)
+    try:
+        insert = f'INSERT INTO {INDEX_TABLE_NAME} ({", ".join(columns)}) VALUES ({", ".join("?" * len(columns))})'
+        batch = []
+        for row in syntheticRows(rows):
+            batch.append(row)
+            if len(batch) >= BATCH:
+                conn.executemany(insert, batch)
+                batch.clear()
+        conn.executemany(insert, batch)
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def measureLoad(filename):
+    before = peakRssMb()
+    start = time.monotonic()
+    index = SecureIndex(filename)
+    entries = index.getAll()
+    elapsed = time.monotonic() - start
+    print(f'{len(entries)} entries loaded in {elapsed:.1f}s, peak RSS +{peakRssMb() - before:.0f} MB')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Index load benchmark')
+    parser.add_argument('--rows', type=int, default=1000000)
+    parser.add_argument('--index', default='bench_index.db', help='path of the synthetic index')
+    parser.add_argument('--load', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.load:
+        measureLoad(args.index)
+        return
+    buildIndex(args.index, args.rows)
+    # load in a fresh process so the memory used to write the index isn't counted
+    subprocess.check_call([sys.executable, os.path.abspath(__file__), '--index', args.index, '--load'])
+
+
+if __name__ == '__main__':
+    main()
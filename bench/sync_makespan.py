@@ -0,0 +1,146 @@
+"""
+Measures how long a sync of a synthetic tree takes against the simulated b2 api, to compare the scheduling of
+large files with the plain order of the compare.
+
+python bench/sync_makespan.py --dist tail
+python bench/sync_makespan.py --dist tail --fifo
+
+Each upload takes LATENCY plus its size over BANDWIDTH seconds, like a connection with a fixed speed.
+--fifo runs the actions in the order they're found and without the large file lane, the way they ran before
+largest-first scheduling. The distributions:
+  tail      - small files first and a few large ones that sort last, like VM images in a zz_ directory
+  head      - a few large files first and then lots of small ones
+  lognormal - sizes spread over a log scale in random name order
+"""
+import argparse
+import base64
+import logging
+import os
+import random
+import sys
+import tempfile
+import time
+import types
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from b2_ext.account_info.in_memory import InMemoryAccountInfo
+from b2_ext.api import B2Api
+from b2_ext.cache import InMemoryCache
+from b2_ext.raw_simulator import RawSimulator
+from index.secure_index import SecureIndex
+from sync import sync as syncModule
+from sync.folder import LocalFolder, SecureFolder
+from utility import config
+
+BANDWIDTH = 256 * 1024
+LATENCY = 0.05
+MB = 1024 ** 2 // 10
+LARGE_FILE_BYTES = 20 * MB
+
+# (name prefix, number of files, (min size, max size) or None for log normal sizes)
+DISTRIBUTIONS = {
+    'tail': [('a', 300, (400, 6400)), ('m', 6, (15 * MB, 19 * MB)), ('zz', 3, (60 * MB, 60 * MB))],
+    'head': [('a', 3, (60 * MB, 60 * MB)), ('m', 6, (15 * MB, 19 * MB)), ('z', 300, (400, 6400))],
+    'lognormal': [('r', 150, None)],
+}
+
+
+class SlowRawSimulator(RawSimulator):
+    """
+    RawSimulator where every upload takes as long as it would over a connection of BANDWIDTH bytes/s
+    """
+
+    MIN_PART_SIZE = 5 * MB
+
+    def upload_file(self, upload_url, upload_auth_token, file_name, content_length, *args, **kwargs):
+        time.sleep(LATENCY + content_length / BANDWIDTH)
+        return super().upload_file(upload_url, upload_auth_token, file_name, content_length, *args, **kwargs)
+
+    def upload_part(self, upload_url, upload_auth_token, part_number, content_length, *args, **kwargs):
+        time.sleep(LATENCY + content_length / BANDWIDTH)
+        return super().upload_part(upload_url, upload_auth_token, part_number, content_length, *args, **kwargs)
+
+
+def makeTree(root, dist):
+    if os.path.exists(root):
+        return
+    os.makedirs(root)
+    rnd = random.Random(1)
+    for prefix, count, sizes in DISTRIBUTIONS[dist]:
+        for i in range(count):
+            if sizes is None:
+                size = int(min(80 * MB, rnd.lognormvariate(8.7, 2.2)))
+                name = f'{prefix}{rnd.randrange(10 ** 6):06d}_{i}'
+            else:
+                size = rnd.randint(*sizes)
+                name = f'{prefix}{i:05d}'
+            with open(os.path.join(root, name), 'wb') as f:
+                f.write(os.urandom(size))
+
+
+def makeConf(workDir, workers):
+    conf = config.Config()
+    conf.GPGHome = os.path.join(workDir, 'gpg')
+    conf.CryptoBackend = 'aes'
+    conf.ArgonSalt = base64.b64encode(b'bench-salt-bench').decode('ascii')
+    conf.SecureNameSalt = 'bench'
+    conf.largeFileBytes = LARGE_FILE_BYTES
+    conf.checkpointBytes = 0
+    conf.maxTempBytes = 4 * 1024 ** 3
+    conf.maxMemoryBytes = 1024 ** 3
+    conf.concurrency = None
+    conf.args = types.SimpleNamespace(workers=workers, cpuWorkers=2, netWorkers=workers, exclude=[], include=[],
+                                      comparison=4, keep=False, dryrun=False, test=False, testIndex=False,
+                                      quiet=True, passphrase='bench', streamUpload=False, checkpointMinutes=0)
+    return conf
+
+
+def runFifo():
+    # no reordering window and every file in the small file lane
+    getattr(syncModule, '__largest_first').__defaults__ = (0,)
+    syncModule.LANE_LARGE = syncModule.LANE_SMALL
+
+
+class IndexSource(object):
+    def uploadIndex(self, secureIndex):
+        pass
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Sync makespan benchmark on the simulated b2 api')
+    parser.add_argument('--dist', choices=sorted(DISTRIBUTIONS), default='tail')
+    parser.add_argument('--fifo', action='store_true', help='run the actions in the order they are found')
+    parser.add_argument('--workers', type=int, default=8)
+    parser.add_argument('--dir', default=os.path.join(tempfile.gettempdir(), 'ssync_bench'),
+                        help='directory for the synthetic tree, it is reused between runs')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+
+    root = os.path.join(args.dir, args.dist)
+    makeTree(root, args.dist)
+    if args.fifo:
+        runFifo()
+
+    api = B2Api(InMemoryAccountInfo(), InMemoryCache(), raw_api=SlowRawSimulator())
+    api.account_info.REALM_URLS = {'production': 'http://production.example.com'}
+    api.authorize_account('production', 'account', 'good-app-key')
+    api.set_thread_pool_size(args.workers)
+    bucket = api.create_bucket('bench', 'allPrivate')
+
+    with tempfile.TemporaryDirectory() as workDir:
+        conf = makeConf(workDir, args.workers)
+        index = SecureIndex(os.path.join(workDir, 'index.sqlite'), IndexSource())
+        total = sum(os.path.getsize(os.path.join(root, f)) for f in os.listdir(root))
+        start = time.time()
+        with open(os.devnull, 'w') as devnull:
+            syncModule.sync_folders(LocalFolder(root), SecureFolder('', index, bucket), int(start * 1000), devnull,
+                                    conf)
+        elapsed = time.time() - start
+        uploaded = sum(1 for e in index.getAll() if e.remoteId)
+        print(f'{args.dist} {"fifo" if args.fifo else "largest first"}: {uploaded} of {len(os.listdir(root))} '
+              f'files, {total / 1024 ** 2:.1f} MB, makespan {elapsed:.2f}s')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,122 @@
+"""
+Measures the peak memory of a sync of a very large tree, to check that the scan, the compare, the scheduling and the
+index writes don't keep every file in memory until the end of the sync.
+
+python bench/sync_memory.py
+python bench/sync_memory.py --entries 5000000 --maxRss 100
+
+The local folder is synthetic, it yields the files of a tree with 1000 files per directory without touching the disk.
+The first sync runs in test index mode against an empty index, every file is compared, scheduled, run through the
+stages and recorded in the index like an upload that doesn't transfer anything. The second sync runs in test mode
+with an empty local folder, so every file is deleted from the index, the way a sync without uploads runs. The script
+fails if the peak RSS of the two syncs is over --maxRss MB.
+"""
+import argparse
+import base64
+import logging
+import os
+import resource
+import sqlite3
+import sys
+import tempfile
+import time
+import types
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from index.secure_index import SecureIndex, INDEX_TABLE_NAME
+from sync.folder import LocalFolder, SecureFolder
+from sync.path_entity import PathEntity, FileVersion
+from sync.sync import sync_folders
+from utility import config
+
+FILES_PER_DIR = 1000
+
+
+def peakRssMb():
+    # ru_maxrss is in KB on linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+class SyntheticFolder(LocalFolder):
+    """
+    Local folder with count files that only exist in memory, in the order the walk of a real folder yields them
+    """
+
+    def __init__(self, path, count):
+        LocalFolder.__init__(self, path)
+        self.count = count
+
+    def all_files(self, reporter, pathFilter=None, summaryIndex=None, useHash=False):
+        for i in range(self.count):
+            dirPath = f'dir{i // FILES_PER_DIR:05d}/'
+            if i % FILES_PER_DIR == 0:
+                yield PathEntity(self.path + dirPath, dirPath, True, [FileVersion(self.path + dirPath, 0, 0, None)])
+            path = f'{dirPath}file{i % FILES_PER_DIR:04d}.dat'
+            yield PathEntity(self.path + path, path, False,
+                             [FileVersion(self.path + path, i % 65536, 1500000000000 + i, None)])
+
+
+class IndexSource(object):
+    def uploadIndex(self, secureIndex):
+        pass
+
+
+def makeConf(testIndex):
+    conf = config.Config()
+    conf.CryptoBackend = 'aes'
+    conf.ArgonSalt = base64.b64encode(b'bench-salt-bench').decode('ascii')
+    conf.SecureNameSalt = 'bench'
+    conf.largeFileBytes = 200 * 1024 ** 2
+    conf.checkpointBytes = 0
+    conf.maxTempBytes = 4 * 1024 ** 3
+    conf.maxMemoryBytes = 1024 ** 3
+    conf.concurrency = None
+    conf.args = types.SimpleNamespace(workers=8, cpuWorkers=2, netWorkers=8, exclude=[], include=[], comparison=4,
+                                      keep=False, dryrun=False, test=True, testIndex=testIndex, quiet=True,
+                                      streamUpload=False, checkpointMinutes=0)
+    return conf
+
+
+def runSync(indexPath, localFolder, testIndex):
+    # the sync closes the index when it's done, each one opens it like ssync does
+    index = SecureIndex(indexPath, IndexSource())
+    start = time.monotonic()
+    with open(os.devnull, 'w') as devnull:
+        sync_folders(localFolder, SecureFolder('', index, None), int(time.time() * 1000), devnull, makeConf(testIndex))
+    return time.monotonic() - start
+
+
+def countEntries(indexPath):
+    conn = sqlite3.connect(indexPath)
+    try:
+        return conn.execute(f'SELECT count(*) FROM {INDEX_TABLE_NAME}').fetchone()[0]
+    finally:
+        conn.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Sync memory benchmark')
+    parser.add_argument('--entries', type=int, default=5000000, help='number of files in the synthetic tree')
+    parser.add_argument('--maxRss', type=int, default=100, help='max peak RSS in MB, 0 to only report it')
+    parser.add_argument('--dir', default=tempfile.gettempdir(), help='directory for the index that is written')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+
+    with tempfile.TemporaryDirectory(dir=args.dir) as workDir:
+        indexPath = os.path.join(workDir, 'index.sqlite')
+        localPath = os.path.join(workDir, 'synthetic')
+        elapsed = runSync(indexPath, SyntheticFolder(localPath, args.entries), True)
+        print(f'{args.entries} files uploaded in {elapsed:.0f}s, {countEntries(indexPath)} index entries, '
+              f'peak RSS {peakRssMb():.0f} MB')
+        elapsed = runSync(indexPath, SyntheticFolder(localPath, 0), False)
+        print(f'Deleted in {elapsed:.0f}s, {countEntries(indexPath)} index entries left')
+
+    rss = peakRssMb()
+    print(f'Peak RSS {rss:.0f} MB')
+    if args.maxRss and rss > args.maxRss:
+        sys.exit(f'Peak RSS {rss:.0f} MB is over {args.maxRss} MB')
+
+
+if __name__ == '__main__':
+    main()
@@ -17,6 +17,7 @@
 
 import codecs
 import threading
+import time
 import os
 import gnupg
 import logging
@@ -39,6 +40,13 @@ class CryptExt(gnupg.Crypt):
 class GpgExt(GPG):
     """
     Allows stream-like objects to be encrypted and decrypted in chunks
+
+    gpg can only process one message per process, to keep the process start up and key loading out of the time
+    it takes to process a file the next process is started as soon as a stream is closed (a warm process).
+    The warm process is only used if it is still running, was started with the same arguments and isn't older
+    than WARM_PROCESS_MAX_AGE_SEC, otherwise it's killed and a new process is started.
+    There is one GpgExt per thread, so at most MAX_WARM_PROCESSES of them keep a warm process at a time, the
+    others start a new process for each stream.
     """
     pass
 
@@ -52,9 +60,20 @@ class GpgExt(GPG):
         self.__buf = None
         self.__process = None
         self.__stdin = None
+        self.__lastArgs = None
+        self.__warm = None
         self.result = None
+        self.keepWarm = True
+        self.warmStarts = 0
+        self.coldStarts = 0
 
     CHUNK = 1024
+    # Max time a warm process is kept before it's replaced
+    WARM_PROCESS_MAX_AGE_SEC = 300
+    # Max number of idle warm processes across all instances
+    MAX_WARM_PROCESSES = max(2, os.cpu_count() or 1)
+    __warmLock = threading.Lock()
+    __warmCount = 0
 
     def encrypt_file(self, file, recipients, sign=None,
             always_trust=False, passphrase=None,
@@ -127,13 +146,68 @@ class GpgExt(GPG):
         self.result = CryptExt(self) #self.result_map['crypt'](self)
         self.__instream = instream
         self.__buf = Buffer()
-        self.__process = self._open_subprocess(args, passphrase is not None)
+        self.__process = self.__takeProcess(args, passphrase)
         self.__stdin = self.__process.stdin
-        if passphrase:
-            gnupg._write_passphrase(self.__stdin, passphrase, self.encoding)
+        self.__lastArgs = (tuple(args), passphrase)
         self.__streamOpen = True
         self.__startedRead = False
 
+    def __takeProcess(self, args, passphrase):
+        """
+        Use the warm process if it's healthy and was started for the same operation, otherwise start a new one
+        """
+        warm, self.__warm = self.__warm, None
+        if warm is not None:
+            GpgExt.__releaseWarmSlot()
+            warmKey, process, started = warm
+            if warmKey == (tuple(args), passphrase) and process.poll() is None and \
+                    time.time() - started < self.WARM_PROCESS_MAX_AGE_SEC:
+                self.warmStarts += 1
+                return process
+            log.debug(f'Replacing warm gpg process ({process.pid})')
+            self.__killProcess(process)
+        self.coldStarts += 1
+        return self.__startProcess(args, passphrase)
+
+    def __startProcess(self, args, passphrase):
+        process = self._open_subprocess(list(args), passphrase is not None)
+        if passphrase:
+            gnupg._write_passphrase(process.stdin, passphrase, self.encoding)
+            process.stdin.flush()
+        return process
+
+    @staticmethod
+    def __killProcess(process):
+        for stream in (process.stdin, process.stdout, process.stderr):
+            try:
+                stream.close()
+            except OSError:
+                pass
+        process.kill()
+        process.wait()
+
+    @staticmethod
+    def __takeWarmSlot():
+        with GpgExt.__warmLock:
+            if GpgExt.__warmCount >= GpgExt.MAX_WARM_PROCESSES:
+                return False
+            GpgExt.__warmCount += 1
+            return True
+
+    @staticmethod
+    def __releaseWarmSlot():
+        with GpgExt.__warmLock:
+            GpgExt.__warmCount -= 1
+
+    def close(self):
+        """
+        Stop the warm process, should be called when this object is no longer used
+        """
+        warm, self.__warm = self.__warm, None
+        if warm is not None:
+            GpgExt.__releaseWarmSlot()
+            self.__killProcess(warm[1])
+
     def __enter__(self):
         return self
 
@@ -143,7 +217,7 @@ class GpgExt(GPG):
         self.__process.stderr.close()
         self.__process.kill()
         if self.__process.returncode is not None and self.__process.returncode != 0:
-            log.error('Gpg subprocess failed with error code: ' + self.__process.returncode)
+            log.error(f'Gpg subprocess failed with error code: {self.__process.returncode}')
         if not self.result.valid and self.result.status != 'encryption ok':
             log.error('Gpg subprocess with error: ' + self.result.status)
         self.__process = None
@@ -157,6 +231,15 @@ class GpgExt(GPG):
         self.__streamOpen = False
         self.__startedRead = False
 
+        # start the process for the next stream now, so it's ready when it's needed
+        if self.keepWarm and self.__lastArgs is not None and GpgExt.__takeWarmSlot():
+            args, passphrase = self.__lastArgs
+            try:
+                self.__warm = (self.__lastArgs, self.__startProcess(args, passphrase), time.time())
+            except Exception:
+                GpgExt.__releaseWarmSlot()
+                log.exception('Failed to start warm gpg process')
+
     def read (self, size=-1):
         # spawn async writer on first run, writer will read from instream and fill the stdin buffer in gpg.exe
         # when we read from the gpg.exe it will allow more data to be written, buffer seems to be around 70mb in win32
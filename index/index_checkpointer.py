@@ -0,0 +1,82 @@
+import logging
+import time
+from threading import Thread, Condition
+
+log = logging.getLogger()
+
+
+class IndexCheckpointer(Thread):
+    """
+    Uploads the changes in the index from a background thread while a sync is running, every intervalSec
+    seconds or once intervalBytes have been transferred since the last checkpoint, whichever comes first.
+    Each checkpoint is uploaded by the index source the same way as the upload at the end of the sync (a delta
+    of the journal, or a new base when it's time to compact) so a crash only loses the changes since the last
+    checkpoint and the final upload only has to include the rest.
+
+    c = IndexCheckpointer(secureIndex, 15 * 60, 10 * 1024 ** 3)
+    c.start()
+    c.transferred(n) # after each file
+    c.stop()         # waits for a checkpoint that is uploading
+    """
+
+    def __init__(self, secureIndex, intervalSec, intervalBytes):
+        """
+        :param intervalSec: seconds between checkpoints, 0 or None to not checkpoint on time
+        :param intervalBytes: bytes transferred between checkpoints, 0 or None to not checkpoint on size
+        """
+        Thread.__init__(self, name='index-checkpointer', daemon=True)
+        self.secureIndex = secureIndex
+        self.intervalSec = intervalSec
+        self.intervalBytes = intervalBytes
+        self.__cond = Condition()
+        self.__stopped = False
+        self.__lastCheckpoint = time.monotonic()
+        self.__bytes = 0
+        self.checkpoints = 0
+        self.failures = 0
+
+    def transferred(self, nbytes):
+        with self.__cond:
+            self.__bytes += nbytes
+            if self.intervalBytes and self.__bytes >= self.intervalBytes:
+                self.__cond.notify()
+
+    def stop(self):
+        with self.__cond:
+            self.__stopped = True
+            self.__cond.notify()
+        if self.is_alive():
+            self.join()
+
+    def run(self):
+        with self.__cond:
+            while not self.__stopped:
+                if self.intervalBytes and self.__bytes >= self.intervalBytes:
+                    reason = f'{self.__bytes} bytes transferred'
+                elif self.intervalSec and time.monotonic() - self.__lastCheckpoint >= self.intervalSec:
+                    reason = f'{self.intervalSec:.0f} seconds elapsed'
+                else:
+                    timeout = None
+                    if self.intervalSec:
+                        timeout = self.__lastCheckpoint + self.intervalSec - time.monotonic()
+                    self.__cond.wait(timeout)
+                    continue
+
+                self.__bytes = 0
+                # transfers continue while the checkpoint uploads
+                self.__cond.release()
+                try:
+                    self.__checkpoint(reason)
+                finally:
+                    self.__cond.acquire()
+                    self.__lastCheckpoint = time.monotonic()
+
+    def __checkpoint(self, reason):
+        log.info(f'Index checkpoint, {reason}')
+        try:
+            self.secureIndex.source.uploadIndex(self.secureIndex)
+            self.checkpoints += 1
+        except Exception:
+            # the next checkpoint or the upload at the end of the sync includes the same changes
+            self.failures += 1
+            log.exception('Index checkpoint failed')
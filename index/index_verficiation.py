@@ -1,49 +1,235 @@
+import copy
+import json
+import os
+import random
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from b2_ext.download_dest import DownloadDestBytes
+from b2_ext.exception import B2Error
+from b2_ext.file_version import FileVersionInfoFactory
+
+import backblaze_b2
+import security
 from index.secure_index import SecureIndex
 import logging
+from utility import util
 
 log = logging.getLogger()
 
 class VerifyFile:
-    def __init__(self, remoteId, remoteName, size):
+    def __init__(self, remoteId, remoteName, size, sha1=None):
         self.size = size
         self.remoteId = remoteId
         self.remoteName = remoteName
+        self.sha1 = sha1
 
-def ValidateAndUpdateIndex(bucket, folderName, secIndex: SecureIndex):
+# the bucket is listed in about this many ranges per worker so slow ranges don't hold up the others
+RANGES_PER_WORKER = 4
+# sampled files that can't be checked from the start of the file are downloaded whole if they're at most this big
+SAMPLE_MAX_WHOLE_SIZE = 16 * 1024 * 1024
+
+class ValidationReport:
+    """
+    Result of an index validation, counts of each check and one entry per problem found.
+    Written as json so it can be read by other tools.
+    """
+
+    def __init__(self, folderName, deep):
+        self.folderName = folderName
+        self.deep = deep
+        self.counts = {'indexFiles': 0, 'bucketFiles': 0, 'matched': 0, 'missing': 0, 'sizeMismatch': 0,
+                       'sha1Mismatch': 0, 'recorded': 0, 'sampled': 0, 'sampleSkipped': 0, 'sampleInvalid': 0,
+                       'sampleFailed': 0}
+        self.problems = []
+        self.__lock = threading.Lock()
+
+    def count(self, key, n=1):
+        with self.__lock:
+            self.counts[key] += n
+
+    def problem(self, check, indexFile, expected=None, actual=None):
+        """
+        :param check: 'missing', 'size', 'sha1', 'hash', 'decrypt' or 'download'
+        """
+        with self.__lock:
+            self.problems.append({'check': check,
+                                  'path': indexFile.path,
+                                  'remoteName': indexFile.remoteName,
+                                  'remoteId': indexFile.remoteId,
+                                  'expected': expected,
+                                  'actual': actual})
+
+    def toDict(self):
+        return {'folder': self.folderName,
+                'deep': self.deep,
+                'counts': dict(self.counts),
+                'problems': list(self.problems)}
+
+    def write(self, path):
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(self.toDict(), f, indent=2)
+
+def ValidateAndUpdateIndex(bucket, folderName, secIndex: SecureIndex, workers=8, deep=False, conf=None,
+                           sampleRate=0.0, reportPath=None):
     """
     Ensure that the bucket and the index match, name only
     Updates index to match the bucket
+    :param workers: max number of bucket ranges that are listed and files that are sampled at the same time
+    :param deep: also check the size and sha1 of each file against the values recorded when it was uploaded,
+                 files uploaded before they were recorded get the listed values recorded
+    :param conf: needed to decrypt sampled files
+    :param sampleRate: fraction of the files to download and check that they can be decrypted (deep only)
+    :param reportPath: write the ValidationReport as json to this file
+    :return: ValidationReport
     """
 
+    report = ValidationReport(folderName, deep)
     indexFiles = {}
     for f in secIndex.getAll():
         if f.remoteName is not None:
             indexFiles[f.remoteName] = f
 
+    report.counts['indexFiles'] = len(indexFiles)
     log.info(f'Found ({len(indexFiles)}) files in index')
 
+    # files in the bucket that don't match the index, removed so they're uploaded again
+    invalid = []
+    samples = []
+
     #remove all item that are in the bucket
-    for f in __iterateBucket(bucket, folderName):
+    for f in __iterateBucket(bucket, folderName, sorted(indexFiles), workers):
+        report.count('bucketFiles')
         if f.remoteName in indexFiles:
             indexFile = indexFiles[f.remoteName]
             if indexFile.remoteId == f.remoteId:
                 del indexFiles[f.remoteName]
+                if not deep:
+                    report.count('matched')
+                elif not __reconcile(f, indexFile, secIndex, report):
+                    invalid.append(indexFile)
+                else:
+                    report.count('matched')
+                    if sampleRate and random.random() < sampleRate:
+                        samples.append((f, indexFile))
+
+    if samples:
+        log.info(f'Checking ({len(samples)}) sampled files')
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            results = executor.map(lambda s: __checkSample(bucket, conf, s[0], s[1], report), samples)
+            # a sample that couldn't be downloaded (None) says nothing about the file, only bad data removes it
+            invalid.extend(indexFile for (f, indexFile), ok in zip(samples, results) if ok is False)
+
+    for indexFile in indexFiles.values():
+        report.count('missing')
+        report.problem('missing', indexFile)
 
     log.info(f'Removing ({len(indexFiles)}) files in that are no longer on the remote dir')
     for f in indexFiles:
         path = indexFiles[f].path
         log.info(f"Removing: '{path}' ({f})")
         secIndex.remove(path)
+    if invalid:
+        log.info(f'Removing ({len(invalid)}) files that don\'t match the remote dir')
+        for indexFile in invalid:
+            log.info(f"Removing: '{indexFile.path}' ({indexFile.remoteName})")
+            secIndex.remove(indexFile.path)
     secIndex.flush()
 
+    log.info(f'Validation results: {report.counts}')
+    if reportPath:
+        report.write(reportPath)
+        log.info(f"Validation report written to: '{reportPath}'")
+    return report
+
+def __reconcile(f, indexFile, secIndex, report):
+    """
+    Compare the listed size and sha1 with the values recorded in the index, record them if they're missing
+    :return: False if the file doesn't match
+    """
+    ok = True
+    sha1 = backblaze_b2.normalizeContentSha1(f.sha1)
+    if indexFile.remoteSize is not None and indexFile.remoteSize != f.size:
+        report.count('sizeMismatch')
+        report.problem('size', indexFile, indexFile.remoteSize, f.size)
+        ok = False
+    # b2 doesn't have the sha1 of large files
+    if indexFile.remoteSha1 is not None and sha1 is not None and indexFile.remoteSha1 != sha1:
+        report.count('sha1Mismatch')
+        report.problem('sha1', indexFile, indexFile.remoteSha1, sha1)
+        ok = False
+
+    if ok and (indexFile.remoteSize is None or (indexFile.remoteSha1 is None and sha1 is not None)):
+        updated = copy.copy(indexFile)
+        updated.remoteSize = f.size
+        updated.remoteSha1 = sha1
+        secIndex.addorUpdate(updated)
+        report.count('recorded')
+    return ok
+
+def __checkSample(bucket, conf, f, indexFile, report):
+    """
+    Download the start of the file, or the whole file for backends that can't check a part of it,
+    and check that it can be decrypted
+    :return: False if the file can't be decrypted or doesn't match the hash in the index,
+             None if it couldn't be downloaded
+    """
+    try:
+        backend = security.getCryptoBackend(conf, indexFile.crypto)
+        if backend.prefixSize is not None:
+            dest = DownloadDestBytes()
+            range_ = (0, backend.prefixSize) if f.size > backend.prefixSize else None
+            bucket.download_file_by_id(f.remoteId, dest, range_=range_)
+            backend.verifyPrefix(dest.bytes_io.getvalue())
+        elif f.size <= SAMPLE_MAX_WHOLE_SIZE:
+            os.makedirs(conf.TempDir, exist_ok=True)
+            tempPath = os.path.join(conf.TempDir, f.remoteName)
+            try:
+                bucket.download_file_by_id(f.remoteId, security.openDecryptDestination(conf, tempPath,
+                                                                                        indexFile.crypto))
+                hashDigest = util.calculateHash(tempPath)
+            finally:
+                util.silentRemove(tempPath)
+            if indexFile.hash is not None and hashDigest != indexFile.hash:
+                report.count('sampleInvalid')
+                report.problem('hash', indexFile, indexFile.hash, hashDigest)
+                return False
+        else:
+            report.count('sampleSkipped')
+            return True
+    except security.DECRYPT_ERRORS as e:
+        log.warning(f"Failed to decrypt sampled file: '{indexFile.path}' ({indexFile.remoteName}): {e}")
+        report.count('sampleInvalid')
+        report.problem('decrypt', indexFile, actual=repr(e))
+        return False
+    except B2Error as e:
+        log.warning(f"Failed to download sampled file: '{indexFile.path}' ({indexFile.remoteName}): {e}")
+        report.count('sampleFailed')
+        report.problem('download', indexFile, actual=repr(e))
+        return None
+    report.count('sampled')
+    return True
+
+
+def __getBoundaries(folderName, names, workers):
+    """
+    Split the bucket into ranges with about the same number of files, based on the sorted names in the index.
+    Secure names are base64 of the argon hash text so their leading characters aren't evenly spread
+    over the alphabet, the names in the index show where the files actually are.
+    Ranges are at least a full page so the listing doesn't make more calls than a serial one.
+    """
+    count = min(workers * RANGES_PER_WORKER, len(names) // backblaze_b2.MAX_LIST_PAGE + 1)
+    boundaries = [folderName + names[i * len(names) // count] for i in range(1, count)]
+    return sorted(set(boundaries))
 
-def __iterateBucket(bucket, folderName):
+def __iterateBucket(bucket, folderName, names, workers):
     folderName = '' if folderName == '' else folderName + '/'
     current_file = None
 
-    for (file_version_info, file_folder_name) in bucket.ls(
-            folderName, show_versions=True, recursive=True, fetch_count=1000
-    ):
+    boundaries = __getBoundaries(folderName, names, workers)
+    log.info(f'Listing bucket in ({len(boundaries) + 1}) ranges')
+    for fileDict in backblaze_b2.listFileVersionsPartitioned(bucket, folderName, boundaries, workers):
+        file_version_info = FileVersionInfoFactory.from_api_response(fileDict)
         assert file_version_info.file_name.startswith(folderName)
         if file_version_info.action == 'start':
             continue
@@ -51,5 +237,6 @@ def __iterateBucket(bucket, folderName):
         # ignore multiple file versions and just take latest
         file_name = file_version_info.file_name[len(folderName):]
         if current_file is None or current_file.remoteName != file_name:
-            current_file = VerifyFile(file_version_info.id_, file_name, file_version_info.size)
+            current_file = VerifyFile(file_version_info.id_, file_name, file_version_info.size,
+                                      file_version_info.content_sha1)
             yield current_file
@@ -1,19 +1,32 @@
 import copy
+import json
+import sqlite3
+import threading
+from bisect import bisect_left
 from functools import total_ordering
+from operator import attrgetter
 
-from sqlalchemy import Column, Integer, String, Boolean, bindparam
-from sqlalchemy import create_engine
+from sqlalchemy import Column, Integer, String, Boolean
+from sqlalchemy import create_engine, event
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker
 
 from utility import util
+from utility.dir_summary import DirSummaryBuilder
 from utility.RWLock import RWLock
-from utility.ResettingTimer import ResettingTimer
+from utility.BackgroundFlusher import BackgroundFlusher
 
 class IndexException(Exception):
     pass
 
 INDEX_TABLE_NAME = 'files'
+# changes that haven't been uploaded yet, written in the same transaction as the change
+JOURNAL_TABLE_NAME = 'journal'
+META_TABLE_NAME = 'meta'
+# sequence number of the last journal delta that is included in the index, and of the last base snapshot
+META_DELTA_SEQ = 'deltaSeq'
+META_BASE_SEQ = 'baseSeq'
+# merkle summary of each directory, see DirSummaryBuilder. A row is deleted when anything under it changes
+SUMMARY_TABLE_NAME = 'dirs'
 
 Base = declarative_base()
 
@@ -33,8 +46,16 @@ class IndexEntry(Base):
     remoteId = Column(String)
     remoteName = Column(String)
     status = Column(String)
-
-    def __init__(self, path, isDir, size, modTime, hash, remoteId, remoteName):
+    # crypto backend the remote file was encrypted with, None for files from before it was recorded (gpg)
+    crypto = Column(String)
+    # size and sha1 of the encrypted file as reported by b2 when it was uploaded, checked by deep validation
+    remoteSize = Column(Integer)
+    remoteSha1 = Column(String)
+    # python lower case path, indexed for ordered scans. sqlite's lower() only handles ascii so it can't be used
+    lowerPath = Column(String)
+
+    def __init__(self, path, isDir, size, modTime, hash, remoteId, remoteName, crypto=None, remoteSize=None,
+                 remoteSha1=None):
         self.path = path
         self.isDir = isDir
         self.size = size
@@ -42,6 +63,10 @@ class IndexEntry(Base):
         self.hash = hash
         self.remoteId = remoteId
         self.remoteName = remoteName
+        self.crypto = crypto
+        self.remoteSize = remoteSize
+        self.remoteSha1 = remoteSha1
+        self.lowerPath = path.lower()
 
     def __eq__(self, other):
         return self.isDir == other.isDir and \
@@ -66,39 +91,497 @@ class IndexEntry(Base):
     def __repr__(self):
         return f'Index: {self.path}'
 
+# columns held in memory, lowerPath is only stored in the database
+INDEX_COLUMNS = tuple(c.name for c in IndexEntry.__table__.columns if c.name != 'lowerPath')
+INDEX_LOWER_PATH_NAME = f'ix_{INDEX_TABLE_NAME}_lowerPath'
+
+@total_ordering
+class IndexRecord(object):
+    """
+    Compact in memory copy of an IndexEntry, without any ORM state.
+    The lower case path used for sorting is computed once, it is the path itself if the path is already lower case.
+    """
+
+    __slots__ = INDEX_COLUMNS + ('sortKey',)
+
+    def __init__(self, path, isDir, size, modTime, hash, remoteId, remoteName, status=None, crypto=None,
+                 remoteSize=None, remoteSha1=None):
+        self.path = path
+        self.isDir = bool(isDir) if isDir is not None else None
+        self.size = size
+        self.modTime = modTime
+        self.hash = hash
+        self.remoteId = remoteId
+        self.remoteName = remoteName
+        self.status = status
+        self.crypto = crypto
+        self.remoteSize = remoteSize
+        self.remoteSha1 = remoteSha1
+        lower = path.lower()
+        self.sortKey = path if lower == path else lower
+
+    @classmethod
+    def fromEntry(cls, entry):
+        if isinstance(entry, IndexRecord):
+            return entry
+        return cls(*(getattr(entry, c, None) for c in INDEX_COLUMNS))
+
+    def values(self):
+        values = {c: getattr(self, c) for c in INDEX_COLUMNS}
+        values['lowerPath'] = self.sortKey
+        return values
+
+    def __eq__(self, other):
+        return self.isDir == other.isDir and \
+               self.sortKey == other.path.lower()
+
+    def __lt__(self, other):
+        if isinstance(other, str):
+            return self.sortKey < other.lower()
+        return self.sortKey < other.path.lower()
+
+    def __hash__(self):
+        return hash(self.sortKey)
+
+    def __repr__(self):
+        return f'Index: {self.path}'
+
+def upperBound(key):
+    """
+    :return: the smallest string that is greater than every string starting with key
+    """
+    return key[:-1] + chr(ord(key[-1]) + 1)
+
 class SecureIndex:
 
     # can be decimals
     __IDLE_DELAY_SEC = 2
     __MAX_DELAY_SEC = 5
+    __LOAD_BATCH = 10000
+    __SCAN_PAGE = 1000
+    # write the pending changes once this many are waiting instead of waiting for the timers
+    __MAX_PENDING = 5000
 
     def __init__(self, filename, source=None, forceUpload=False):
         self.filename = filename
         self.__files = None
+        # sorted order of the loaded files, kept up to date on every change once it's built
+        # __sortedKeys holds the sort key of each file in __sortedFiles for bisect
         self.__sortedFiles = None
+        self.__sortedKeys = None
+        self.__sortedLock = threading.Lock()
+        # changes that haven't been written yet while the index isn't loaded in memory, path -> record or None
+        self.__overlay = {}
+        # read connection of each thread as [conn, lock], all of them are listed so they can be closed
+        self.__readConnections = threading.local()
+        self.__readEntries = []
+        self.__readEntriesLock = threading.Lock()
         self.__engine = create_engine('sqlite:///' + filename)
+        event.listen(self.__engine, 'connect', self.__setPragmas)
         Base.metadata.create_all(self.__engine)
-        self.__sessionMaker = sessionmaker(bind=self.__engine)
+        self.__addMissingColumns()
+        self.__createJournal()
         self.lock = RWLock()
         self.pendingActions = []
-        self.idleTmr = None
-        self.maxTmr = None
+        # writes the pending actions in the background once they're idle for a while
+        self.__flusher = BackgroundFlusher(self.__IDLE_DELAY_SEC, self.__MAX_DELAY_SEC, self.__writePending,
+                                           name='index-flusher')
+        self.__flusher.start()
         self.source = source
         self.hasChanges = False
         self.forceUpload = forceUpload
 
+    @staticmethod
+    def __setPragmas(dbapiConnection, connectionRecord):
+        # WAL lets the readers continue while a batch is written, and with WAL synchronous=NORMAL only syncs
+        # on checkpoints. A crash can lose the last batches but can't corrupt the index.
+        cursor = dbapiConnection.cursor()
+        cursor.execute('PRAGMA journal_mode=WAL')
+        cursor.execute('PRAGMA synchronous=NORMAL')
+        cursor.close()
+
+    def __addMissingColumns(self):
+        # create_all doesn't change existing tables, add columns that are missing from older indexes
+        with self.__engine.begin() as conn:
+            existing = set(row[1] for row in conn.execute(f'PRAGMA table_info({INDEX_TABLE_NAME})'))
+            for column in IndexEntry.__table__.columns:
+                if column.name not in existing:
+                    conn.execute(f'ALTER TABLE {INDEX_TABLE_NAME} ADD COLUMN {column.name} {column.type}')
+            if 'lowerPath' not in existing:
+                paths = conn.execute(f'SELECT path FROM {INDEX_TABLE_NAME}').fetchall()
+                if paths:
+                    conn.execute(f'UPDATE {INDEX_TABLE_NAME} SET lowerPath=? WHERE path=?',
+                                 [(p.lower(), p) for (p,) in paths])
+            conn.execute(f'CREATE INDEX IF NOT EXISTS {INDEX_LOWER_PATH_NAME} '
+                         f'ON {INDEX_TABLE_NAME} (lowerPath, path)')
+
+    def __createJournal(self):
+        with self.__engine.begin() as conn:
+            conn.execute(f'CREATE TABLE IF NOT EXISTS {JOURNAL_TABLE_NAME} ('
+                         'seq INTEGER PRIMARY KEY AUTOINCREMENT, '
+                         'action TEXT NOT NULL, '
+                         'data TEXT)')
+            conn.execute(f'CREATE TABLE IF NOT EXISTS {META_TABLE_NAME} ('
+                         'key TEXT PRIMARY KEY, '
+                         'value TEXT)')
+            conn.execute(f'CREATE TABLE IF NOT EXISTS {SUMMARY_TABLE_NAME} ('
+                         'path TEXT PRIMARY KEY, '
+                         'statDigest TEXT, '
+                         'fullDigest TEXT, '
+                         'count INTEGER)')
+
+    @staticmethod
+    def readSeq(filename):
+        """
+        Read the delta sequence number of an index file without opening it as an index
+        :return: sequence number or None if the index doesn't have one (created before journaling)
+        """
+        conn = sqlite3.connect(filename)
+        try:
+            row = conn.execute(f'SELECT value FROM {META_TABLE_NAME} WHERE key=?', (META_DELTA_SEQ,)).fetchone()
+            return int(row[0]) if row and row[0] is not None else None
+        except sqlite3.OperationalError:
+            return None
+        finally:
+            conn.close()
+
+    def getSeq(self):
+        return self.__getMeta(META_DELTA_SEQ)
+
+    def getBaseSeq(self):
+        return self.__getMeta(META_BASE_SEQ)
+
+    def __getMeta(self, key):
+        with self.__engine.begin() as conn:
+            row = conn.execute(f'SELECT value FROM {META_TABLE_NAME} WHERE key=?', (key,)).fetchone()
+        return int(row[0]) if row and row[0] is not None else None
+
+    @staticmethod
+    def __setMeta(conn, key, value):
+        conn.execute(f'INSERT OR REPLACE INTO {META_TABLE_NAME} (key, value) VALUES (?, ?)', (key, str(value)))
+
+    def hasJournal(self):
+        self.flush()
+        with self.__engine.begin() as conn:
+            return conn.execute(f'SELECT EXISTS (SELECT 1 FROM {JOURNAL_TABLE_NAME})').fetchone()[0] == 1
+
+    def exportJournal(self, filename):
+        """
+        Write all journaled changes to a file, one json record per line
+        :return: the last journal seq that was written, pass it to markUploaded once the file is uploaded
+        """
+        self.flush()
+        self.lock.writer_acquire()
+        try:
+            lastSeq = 0
+            with self.__engine.begin() as conn, open(filename, 'w', encoding='utf-8') as f:
+                for seq, action, data in conn.execute(
+                        f'SELECT seq, action, data FROM {JOURNAL_TABLE_NAME} ORDER BY seq'):
+                    f.write(json.dumps({'a': action, 'd': json.loads(data) if data else None}))
+                    f.write('\n')
+                    lastSeq = seq
+            return lastSeq
+        finally:
+            self.lock.writer_release()
+
+    def createSnapshot(self, filename, deltaSeq):
+        """
+        Copy the index to a file that can be uploaded as a new base, the copy has an empty journal
+        :param deltaSeq: sequence number the base will be uploaded as
+        :return: the last journal seq that is included in the copy, pass it to markUploaded once the file is uploaded
+        """
+        self.flush()
+        self.lock.writer_acquire()
+        try:
+            with self.__engine.begin() as conn:
+                row = conn.execute(f'SELECT MAX(seq) FROM {JOURNAL_TABLE_NAME}').fetchone()
+            lastSeq = row[0] or 0
+            # the backup includes the changes that are still in the write ahead log
+            util.silentRemove(filename)
+            src = sqlite3.connect(self.filename)
+            dest = sqlite3.connect(filename)
+            try:
+                src.backup(dest)
+            finally:
+                dest.close()
+                src.close()
+        finally:
+            self.lock.writer_release()
+
+        conn = sqlite3.connect(filename)
+        try:
+            # the uploaded file has to be a single file
+            conn.execute('PRAGMA journal_mode=DELETE')
+            with conn:
+                conn.execute(f'DELETE FROM {JOURNAL_TABLE_NAME}')
+                self.__setMeta(conn, META_DELTA_SEQ, deltaSeq)
+                self.__setMeta(conn, META_BASE_SEQ, deltaSeq)
+            conn.execute('VACUUM')
+        finally:
+            conn.close()
+        return lastSeq
+
+    def markUploaded(self, lastJournalSeq, deltaSeq, isBase=False):
+        """
+        Remove the uploaded changes from the journal and record the sequence number they were uploaded as
+        """
+        self.lock.writer_acquire()
+        try:
+            with self.__engine.begin() as conn:
+                conn.execute(f'DELETE FROM {JOURNAL_TABLE_NAME} WHERE seq <= ?', (lastJournalSeq,))
+                self.__setMeta(conn, META_DELTA_SEQ, deltaSeq)
+                if isBase:
+                    self.__setMeta(conn, META_BASE_SEQ, deltaSeq)
+        finally:
+            self.lock.writer_release()
+        # the pool threads that read the index may be gone by the next upload
+        self.__closeReadConnections()
+
+    def applyJournal(self, filename, deltaSeq):
+        """
+        Apply changes exported by exportJournal, the changes aren't added to the journal
+        :param deltaSeq: sequence number of the delta the changes came from
+        """
+        self.flush()
+        self.lock.writer_acquire()
+        try:
+            with self.__engine.begin() as conn, open(filename, 'r', encoding='utf-8') as f:
+                changed = []
+                for line in f:
+                    record = json.loads(line)
+                    action, data = record['a'], record['d']
+                    if action in ('a', 'u'):
+                        data.setdefault('lowerPath', data['path'].lower())
+                        conn.execute(IndexEntry.__table__.insert().prefix_with('OR REPLACE'), [data])
+                        changed.append(data['path'])
+                    elif action == 'd':
+                        conn.execute(f'DELETE FROM {INDEX_TABLE_NAME} WHERE path=?', (data,))
+                        changed.append(data)
+                    elif action == 't':
+                        conn.execute('DELETE FROM ' + INDEX_TABLE_NAME)
+                        conn.execute('DELETE FROM ' + SUMMARY_TABLE_NAME)
+                self.__invalidateSummaries(conn, changed)
+                self.__setMeta(conn, META_DELTA_SEQ, deltaSeq)
+            # reload on next access
+            self.__files = None
+            self.__sortedFiles = None
+            self.__sortedKeys = None
+        finally:
+            self.lock.writer_release()
+
+    def __read(self, sql, args=(), one=False):
+        """
+        Run a query on the read connection of this thread, reads outside of a transaction don't hold locks
+        between queries. The connection is opened again if it was closed by __closeReadConnections().
+        :return: the first row if one is True, otherwise all of the rows
+        """
+        entry = getattr(self.__readConnections, 'entry', None)
+        if entry is None:
+            entry = [None, threading.Lock()]
+            self.__readConnections.entry = entry
+        with entry[1]:
+            if entry[0] is None:
+                # closed from whichever thread calls __closeReadConnections()
+                entry[0] = sqlite3.connect(self.filename, check_same_thread=False)
+                with self.__readEntriesLock:
+                    self.__readEntries.append(entry)
+            cursor = entry[0].execute(sql, args)
+            return cursor.fetchone() if one else cursor.fetchall()
+
+    def close(self):
+        """
+        Write all pending changes and stop the background writes, call once the index isn't changed anymore.
+        It can still be read.
+        """
+        self.__flusher.stop()
+        self.__flusher.flush()
+        self.__closeReadConnections()
+
+    def __closeReadConnections(self):
+        """
+        Close the read connections of all threads, a thread that reads again opens a new one
+        """
+        with self.__readEntriesLock:
+            entries, self.__readEntries = self.__readEntries, []
+        for entry in entries:
+            with entry[1]:
+                if entry[0] is not None:
+                    entry[0].close()
+                    entry[0] = None
+
     def get(self, path):
-        self.__lazyLoad(False)
-        if path in self.__files:
-            return self.__files[path]
-        return None
+        files = self.__files
+        if files is not None:
+            return files.get(path)
+        # not loaded, check the changes that aren't written yet and then the database
+        overlay = self.__overlay
+        if path in overlay:
+            return overlay[path]
+        row = self.__read(
+            f'SELECT {", ".join(INDEX_COLUMNS)} FROM {INDEX_TABLE_NAME} WHERE path=?', (path,), one=True)
+        return IndexRecord(*row) if row else None
+
+    def iterateOrdered(self, prefix=''):
+        """
+        Yields the entries whose lower case path starts with the prefix, in sorted order.
+        If the index isn't loaded in memory the entries are read from the database a page at a time,
+        so memory use doesn't depend on the size of the index.
+        A lower case key can be sent to the generator to skip ahead, send returns the first entry at or after it.
+        """
+        key = prefix.lower()
+        # range of lower case paths that start with the prefix
+        upper = upperBound(key) if key else None
+        if self.__files is not None:
+            self.__buildSorted()
+            with self.__sortedLock:
+                start = bisect_left(self.__sortedKeys, key)
+                end = bisect_left(self.__sortedKeys, upper) if upper is not None else len(self.__sortedKeys)
+                files = self.__sortedFiles[start:end]
+                keys = self.__sortedKeys[start:end]
+            i = 0
+            while i < len(files):
+                skipTo = yield files[i]
+                i = bisect_left(keys, skipTo, i + 1) if skipTo is not None else i + 1
+            return
+
+        self.flush()
+        columns = ', '.join(INDEX_COLUMNS)
+        bound = ' AND lowerPath < ?' if upper is not None else ''
+        boundArgs = (upper,) if upper is not None else ()
+        rows = self.__read(
+            f'SELECT {columns}, lowerPath FROM {INDEX_TABLE_NAME} WHERE lowerPath >= ?{bound} '
+            f'ORDER BY lowerPath, path LIMIT ?', (key,) + boundArgs + (self.__SCAN_PAGE,))
+        while rows:
+            skipTo = None
+            for row in rows:
+                skipTo = yield IndexRecord(*row[:-1])
+                if skipTo is not None:
+                    break
+            if skipTo is not None:
+                rows = self.__read(
+                    f'SELECT {columns}, lowerPath FROM {INDEX_TABLE_NAME} WHERE lowerPath >= ?{bound} '
+                    f'ORDER BY lowerPath, path LIMIT ?', (skipTo,) + boundArgs + (self.__SCAN_PAGE,))
+                continue
+            # continue after the last row, each page is a separate query so no lock is held between pages
+            last = rows[-1]
+            rows = self.__read(
+                f'SELECT {columns}, lowerPath FROM {INDEX_TABLE_NAME} WHERE (lowerPath, path) > (?, ?){bound} '
+                f'ORDER BY lowerPath, path LIMIT ?', (last[-1], last[0]) + boundArgs + (self.__SCAN_PAGE,))
+
+    def getSummary(self, path):
+        """
+        :param path: directory path with a trailing '/'
+        :return: stored (statDigest, fullDigest, count) of the directory or None if it isn't up to date
+        """
+        return self.__read(
+            f'SELECT statDigest, fullDigest, count FROM {SUMMARY_TABLE_NAME} WHERE path=?', (path,), one=True)
+
+    def updateSummaries(self):
+        """
+        Rebuild the summaries of the directories that changed, directories that are still up to date are skipped.
+        Should be called when nothing else is changing the index, like at the end of a sync.
+        """
+        self.flush()
+        valid = {row[0]: row[1:] for row in self.__read(
+            f'SELECT path, statDigest, fullDigest, count FROM {SUMMARY_TABLE_NAME}')}
+        builder = DirSummaryBuilder()
+        records = self.iterateOrdered()
+        record = next(records, None)
+        while record is not None:
+            skipTo = None
+            if record.status == 'uploading':
+                # unfinished uploads aren't in the sync, the directory can't be skipped until they're done
+                builder.invalidate(record.path)
+            elif record.isDir:
+                summary = valid.get(record.path)
+                builder.addDir(record.path, summary)
+                if summary is not None:
+                    skipTo = upperBound(record.sortKey)
+            else:
+                builder.addFile(record.path, record.size, record.modTime, record.hash)
+            try:
+                record = records.send(skipTo) if skipTo is not None else next(records)
+            except StopIteration:
+                record = None
+        summaries = builder.finish()
+
+        self.lock.writer_acquire()
+        try:
+            # something changed while building, the next sync will rebuild
+            if self.pendingActions:
+                return
+            with self.__engine.begin() as conn:
+                conn.execute(f'INSERT OR REPLACE INTO {SUMMARY_TABLE_NAME} (path, statDigest, fullDigest, count) '
+                             f'VALUES (?, ?, ?, ?)', [(path,) + s for path, s in summaries.items()])
+        finally:
+            self.lock.writer_release()
+
+    @staticmethod
+    def __invalidateSummaries(conn, paths):
+        # a change invalidates the summary of every directory above it, and of the directory itself
+        dirs = set()
+        for path in paths:
+            dirs.add('')
+            i = path.find('/')
+            while i != -1:
+                dirs.add(path[:i + 1])
+                i = path.find('/', i + 1)
+        if dirs:
+            conn.execute(f'DELETE FROM {SUMMARY_TABLE_NAME} WHERE path=?', [(d,) for d in dirs])
 
     def getAll(self):
-        self.__lazyLoad(False)
-        if self.__sortedFiles is None:
-            # Sort files by key (filepath), and return list of values (IndexEntry)
-            self.__sortedFiles = [v for (k, v) in sorted(self.__files.items(), key=lambda x: x[1])]
-        return self.__sortedFiles
+        """
+        :return: copy of the sorted list of all entries (IndexRecord)
+        """
+        self.__buildSorted()
+        with self.__sortedLock:
+            return list(self.__sortedFiles)
+
+    def __buildSorted(self):
+        self.__lazyLoad()
+        if self.__sortedFiles is not None:
+            return
+        # no changes while sorting, after this the order is updated with each change
+        self.lock.writer_acquire()
+        try:
+            if self.__sortedFiles is None:
+                # Sort files by the precomputed lower case path
+                files = sorted(self.__files.values(), key=attrgetter('sortKey'))
+                with self.__sortedLock:
+                    self.__sortedKeys = [f.sortKey for f in files]
+                    self.__sortedFiles = files
+        finally:
+            self.lock.writer_release()
+
+    def __sortedFind(self, file):
+        # there can be more than one path with the same key (only the case is different)
+        i = bisect_left(self.__sortedKeys, file.sortKey)
+        while i < len(self.__sortedKeys) and self.__sortedKeys[i] == file.sortKey:
+            if self.__sortedFiles[i].path == file.path:
+                return i
+            i += 1
+        return None
+
+    def __sortedPut(self, file, replace):
+        with self.__sortedLock:
+            if self.__sortedFiles is None:
+                return
+            i = self.__sortedFind(file) if replace else None
+            if i is not None:
+                self.__sortedFiles[i] = file
+            else:
+                i = bisect_left(self.__sortedKeys, file.sortKey)
+                self.__sortedKeys.insert(i, file.sortKey)
+                self.__sortedFiles.insert(i, file)
+
+    def __sortedRemove(self, file):
+        with self.__sortedLock:
+            if self.__sortedFiles is None:
+                return
+            i = self.__sortedFind(file)
+            if i is not None:
+                del self.__sortedKeys[i]
+                del self.__sortedFiles[i]
 
     def add(self, file: IndexEntry):
         def tmp():
@@ -128,99 +611,164 @@ class SecureIndex:
         self.__readLock(tmp)
 
     def clear(self):
+        self.__lazyLoad()
         self.lock.reader_acquire()
         try:
             self.pendingActions.append(('t', None))
             self.__files.clear()
+            with self.__sortedLock:
+                if self.__sortedFiles is not None:
+                    self.__sortedKeys = []
+                    self.__sortedFiles = []
             self.__delayWrite()
         finally:
             self.lock.reader_release()
-        self.__lazyLoad()
 
     def __readLock(self, func):
-        self.__lazyLoad()
         self.lock.reader_acquire()
         try:
             func()
             self.__delayWrite()
         finally:
             self.lock.reader_release()
+        # the writer lock can't be taken while holding the reader lock
+        if len(self.pendingActions) >= self.__MAX_PENDING:
+            self.__flusher.flush()
 
     def flush(self):
-        self.__writePending()
-
-    def __lazyLoad(self, updating=True):
-        # Files are being updates so clear the sorted cache
-        if updating:
-            self.__sortedFiles = None
+        """
+        Write all pending changes, returns once they're written
+        """
+        self.__flusher.flush()
+
+    def flushMetrics(self):
+        """
+        :return: dict with the batch size and latency of the writes, see BackgroundFlusher.metrics
+        """
+        return self.__flusher.metrics()
+
+    def __lazyLoad(self):
         if self.__files is None:
-            self.__files = {}
-            with util.session_scope(self.__sessionMaker) as session:
-                for f in session.query(IndexEntry):
-                    self.__files[f.path] = f
-                session.expunge_all()
+            self.lock.writer_acquire()
+            try:
+                if self.__files is None:
+                    # changes that aren't written yet are read back from the database
+                    self.__writePendingLocked()
+                    self.__files = self.__loadAll()
+            finally:
+                self.lock.writer_release()
+
+    def __loadAll(self):
+        # Load with a plain cursor, ORM objects use several times more memory and are much slower to create
+        files = {}
+        conn = sqlite3.connect(self.filename)
+        try:
+            cursor = conn.execute(f'SELECT {", ".join(INDEX_COLUMNS)} FROM {INDEX_TABLE_NAME}')
+            while True:
+                rows = cursor.fetchmany(self.__LOAD_BATCH)
+                if not rows:
+                    break
+                for row in rows:
+                    files[row[0]] = IndexRecord(*row)
+        finally:
+            conn.close()
+        return files
 
     def __delayWrite(self):
-        if self.idleTmr is None:
-            self.idleTmr = ResettingTimer(self.__IDLE_DELAY_SEC, self.__writePending)
-            self.idleTmr.start()
-        else:
-            self.idleTmr.reset()
-        if self.maxTmr is None:
-            self.maxTmr = ResettingTimer(self.__MAX_DELAY_SEC, self.__writePending)
-            self.maxTmr.start()
+        self.__flusher.changed()
 
     def __writePending(self):
         self.lock.writer_acquire()
         try:
-            with self.__engine.begin() as conn:
-                for type, data in self.pendingActions:
-                    self.hasChanges = True
-                    if type == 'a':
-                        conn.execute(
-                            IndexEntry.__table__
-                                .insert(),
-                            [data.__dict__])
-                    elif type == 'd':
-                        conn.execute(
-                            IndexEntry.__table__
-                                .delete()
-                                .where(IndexEntry.path == bindparam('path')),
-                            [{'path':data}])
-                    elif type == 'u':
-                        # update is very finicky, all of the properies passed to values have to exist in the db
-                        # also the bindparam name can't exist in the object
-                        conn.execute(
-                            IndexEntry.__table__
-                                .update()
-                                .where(IndexEntry.path == bindparam('x1'))
-                                .values(util.props(data)), # __dict__ doesnt work because SqlA creates extra properties
-                            [{'x1':data.path}])
-                    elif type == 't':
-                        conn.execute('DELETE FROM ' + INDEX_TABLE_NAME)
-                self.pendingActions.clear()
+            return self.__writePendingLocked()
         finally:
-            self.idleTmr = None
-            self.maxTmr = None
             self.lock.writer_release()
 
+    def __writePendingLocked(self):
+        """
+        Write all pending changes in one transaction. Only the last change of each path is written,
+        puts and deletes are each written with a single executemany.
+        :return: number of pending actions that were written
+        """
+        count = len(self.pendingActions)
+        if not count:
+            return 0
+        truncate, changes = self.__coalesce(self.pendingActions)
+        puts = [data.values() for type, data in changes if type != 'd']
+        deletes = [(data,) for type, data in changes if type == 'd']
+        journal = [(type, json.dumps(data.values() if type != 'd' else data)) for type, data in changes]
+        if truncate:
+            journal.insert(0, ('t', None))
+        with self.__engine.begin() as conn:
+            if journal:
+                conn.execute(f'INSERT INTO {JOURNAL_TABLE_NAME} (action, data) VALUES (?, ?)', journal)
+            if truncate:
+                conn.execute('DELETE FROM ' + INDEX_TABLE_NAME)
+            if deletes:
+                conn.execute(f'DELETE FROM {INDEX_TABLE_NAME} WHERE path=?', deletes)
+            if puts:
+                # a delete followed by an add of the same path is coalesced to the add, and the path can still
+                # be in the database, so adds and updates are both written as a replace
+                conn.execute(IndexEntry.__table__.insert().prefix_with('OR REPLACE'), puts)
+            if truncate:
+                conn.execute('DELETE FROM ' + SUMMARY_TABLE_NAME)
+            self.__invalidateSummaries(conn, [data if type == 'd' else data.path for type, data in changes])
+        self.hasChanges = True
+        self.pendingActions.clear()
+        self.__overlay = {}
+        return count
+
+    @staticmethod
+    def __coalesce(pendingActions):
+        """
+        Reduce the pending actions to the last change of each path
+        :return: (truncate, changes) truncate is True if the index was cleared, changes is a list of (type, data)
+                 with one entry per path, applied after the clear
+        """
+        truncate = False
+        changes = {}
+        for type, data in pendingActions:
+            if type == 't':
+                truncate = True
+                changes.clear()
+            elif type == 'd':
+                changes[data] = (type, data)
+            else:
+                changes[data.path] = (type, data)
+        return truncate, list(changes.values())
+
     def __removeEntry(self, file):
-        if isinstance(file, IndexEntry):
+        if isinstance(file, (IndexEntry, IndexRecord)):
             path = file.path
         else:
             path = file
 
-        if path in self.__files:
-            del self.__files[path]
+        existing = self.get(path)
+        if existing is not None:
+            if self.__files is not None:
+                del self.__files[path]
+                self.__sortedRemove(existing)
+            else:
+                self.__overlay[path] = None
             self.pendingActions.append(('d', copy.copy(path)))
 
     def __addEntry(self, file):
-        if file.path in self.__files:
+        file = IndexRecord.fromEntry(file)
+        if self.get(file.path) is not None:
             raise IndexException('File already exists in index: ' + file.path)
-        self.__files[file.path] = file
+        self.__put(file)
         self.pendingActions.append(('a', copy.copy(file)))
 
     def __addOrUpdateEntry(self, file):
-        action = 'u' if file.path in self.__files else 'a'
-        self.__files[file.path] = file
+        file = IndexRecord.fromEntry(file)
+        action = 'u' if self.get(file.path) is not None else 'a'
+        self.__put(file)
         self.pendingActions.append((action, copy.copy(file)))
+
+    def __put(self, file):
+        if self.__files is not None:
+            replace = file.path in self.__files
+            self.__files[file.path] = file
+            self.__sortedPut(file, replace)
+        else:
+            self.__overlay[file.path] = file
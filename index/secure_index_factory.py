@@ -1,4 +1,5 @@
 import os
+import threading
 
 from b2_ext.api import B2Api
 
@@ -11,6 +12,9 @@ from utility.config import ConfigException
 
 log = logging.getLogger()
 
+# Upload the whole index instead of a delta once this many deltas have been uploaded since the last base
+INDEX_COMPACT_DELTAS = 20
+
 class IndexFactoryException(Exception):
     def __init__(self, text):
         self.text = text
@@ -18,14 +22,41 @@ class IndexFactoryException(Exception):
         return repr(self.text)
 
 class SecureIndexFactory:
+    """
+    The remote index is stored as a base snapshot of the whole index plus a journal of deltas.
+    Each sync uploads only the changes it made as a new delta, every INDEX_COMPACT_DELTAS deltas the whole
+    index is uploaded as a new base and the old deltas are deleted.
+    Bases and deltas share one sequence number, a base includes every delta up to its own sequence number.
+    """
+
     def __init__(self, conf, api: B2Api, bucket_name):
         self.conf = conf
         self.api = api
         self.bucket_name = bucket_name
+        # checkpoints upload from a background thread, only one upload can pick the next sequence number
+        self.__uploadLock = threading.Lock()
 
     def __getName(self):
         return self.bucket_name + '\index'
 
+    def __getDeltaPrefix(self):
+        # deltas need a common prefix so they can be listed
+        return security.generateSecureName(self.conf, self.__getName() + '\\delta') + '.'
+
+    def __getDeltaName(self, seq):
+        return f'{self.__getDeltaPrefix()}{seq:010d}'
+
+    def __listDeltas(self):
+        """
+        :return: list of (seq, fileInfo) for all remote deltas, sorted by seq
+        """
+        deltas = []
+        for fileInfo in backblaze_b2.listFileInfosByPrefix(self.api, self.bucket_name, self.__getDeltaPrefix()):
+            seq = backblaze_b2.getIndexSeqFromFileInfo(fileInfo)
+            if seq is not None:
+                deltas.append((seq, fileInfo))
+        return sorted(deltas, key=lambda x: x[0])
+
     # Find, create or download a local index
     def createIndex(self, forceLocalIndex):
         # try and find local file
@@ -33,16 +64,28 @@ class SecureIndexFactory:
             raise ConfigException('IndexPath cannot be a directory')
 
         forceUpload = False
+        deltas = []
         if not self.conf.args.test:
-            forceUpload = not self.__getLatestIndex(forceLocalIndex)
-            log.info('Marking secure index for upload because remote is older or missing')
+            upToDate, deltas = self.__getLatestIndex(forceLocalIndex)
+            forceUpload = not upToDate
+            if forceUpload:
+                log.info('Marking secure index for upload because remote is older or missing')
 
-        return SecureIndex(self.conf.IndexPath, self, forceUpload=forceUpload)
+        secureIndex = SecureIndex(self.conf.IndexPath, self, forceUpload=forceUpload)
+        for seq, fileInfo in deltas:
+            self.__applyDelta(secureIndex, seq, fileInfo)
+        return secureIndex
 
     def __getLatestIndex(self, forceLocalIndex):
+        """
+        Download the remote base index if it's newer than the local one
+        :return: (upToDate, deltas) deltas is the list of (seq, fileInfo) that still have to be applied
+        """
         localModTime = None
+        localSeq = None
         if os.path.exists(self.conf.IndexPath):
             localModTime = util.getModTime(self.conf.IndexPath)
+            localSeq = SecureIndex.readSeq(self.conf.IndexPath)
             log.info('Local secure index found')
         elif forceLocalIndex:
             raise IndexFactoryException('Local secure index not found with forceLocalIndex=True')
@@ -55,30 +98,95 @@ class SecureIndexFactory:
         #from different applications and we want the latest one
         fileInfo = backblaze_b2.getFileInfoByName(self.api, self.bucket_name, indexName)
         remoteModTime = backblaze_b2.getModTimeFromFileInfo(fileInfo)
+        remoteSeq = backblaze_b2.getIndexSeqFromFileInfo(fileInfo)
         fileId = None if fileInfo is None else fileInfo['fileId']
 
         if fileInfo and not remoteModTime:
             log.info('Remote secure index has no timestamp')
 
-        # Download if the local index doesnt exist of if its older
-        # remoteModTime should always have a value if the file exists but it may have been improperly uploaded
-        if not forceLocalIndex and remoteModTime and \
-                (not localModTime or localModTime < remoteModTime):
+        # only deltas newer than the remote base belong to it, older ones are left over from before compaction
+        deltas = []
+        if remoteSeq is not None:
+            deltas = [d for d in self.__listDeltas() if d[0] > remoteSeq]
+        remoteLastSeq = deltas[-1][0] if deltas else remoteSeq
+
+        if localSeq is not None and remoteSeq is not None:
+            # Download if the remote base was uploaded after the last delta in the local index, or if the
+            # deltas the local index is missing aren't all there
+            download = localSeq < remoteSeq or \
+                       len(self.__contiguous(deltas, localSeq)) != len([d for d in deltas if d[0] > localSeq])
+        else:
+            # Download if the local index doesnt exist of if its older
+            # remoteModTime should always have a value if the file exists but it may have been improperly uploaded
+            download = remoteModTime and (not localModTime or localModTime < remoteModTime)
+
+        if not forceLocalIndex and download:
             log.info('Downloading remote secure index because it newer')
+            # the write ahead log of the old index must not be applied to the new one
+            util.silentRemove(self.conf.IndexPath + '-wal')
+            util.silentRemove(self.conf.IndexPath + '-shm')
             backblaze_b2.downloadSecureFile(conf=self.conf,
                                             api=self.api,
                                             fileId=fileId,
-                                            destination=self.conf.IndexPath)
+                                            destination=self.conf.IndexPath,
+                                            backendName=backblaze_b2.getCryptoBackendFromFileInfo(fileInfo))
+            localModTime = util.getModTime(self.conf.IndexPath)
+            localSeq = remoteSeq
+
+        if forceLocalIndex or fileInfo is None:
+            return False, []
+
+        if localSeq is not None and remoteLastSeq is not None:
+            # remote index is up to date once the deltas are applied, unless the local index is ahead
+            applicable = self.__contiguous(deltas, localSeq)
+            if len(applicable) != len([d for d in deltas if d[0] > localSeq]):
+                log.warning('Remote secure index deltas are missing, applying the ones before the gap')
+                return False, applicable
+            if localSeq <= remoteLastSeq:
+                log.info(f'Local secure index is up to date after applying ({len(applicable)}) deltas')
+                return True, applicable
+            return False, []
 
         # return if the remote index is up to date
         if remoteModTime and (not localModTime or localModTime <= remoteModTime):
             log.info('Local secure index is up to date')
-            return True
-        return False
+            return True, []
+        return False, []
+
+    @staticmethod
+    def __contiguous(deltas, localSeq):
+        """
+        :return: the deltas that directly follow localSeq, stops at the first missing sequence number
+        """
+        result = []
+        for d in deltas:
+            if d[0] <= localSeq:
+                continue
+            if d[0] != localSeq + len(result) + 1:
+                break
+            result.append(d)
+        return result
+
+    def __applyDelta(self, secureIndex, seq, fileInfo):
+        tempPath = self.conf.IndexPath + '.delta'
+        try:
+            backblaze_b2.downloadSecureFile(conf=self.conf,
+                                            api=self.api,
+                                            fileId=fileInfo['fileId'],
+                                            destination=tempPath,
+                                            backendName=backblaze_b2.getCryptoBackendFromFileInfo(fileInfo))
+            secureIndex.applyJournal(tempPath, seq)
+            log.info(f'Applied secure index delta ({seq})')
+        finally:
+            util.silentRemove(tempPath)
 
     # Upload local index to b2
     def uploadIndex(self, secureIndex):
-        if not secureIndex.hasChanges and not secureIndex.forceUpload:
+        with self.__uploadLock:
+            self.__uploadIndex(secureIndex)
+
+    def __uploadIndex(self, secureIndex):
+        if not secureIndex.hasJournal() and not secureIndex.forceUpload:
             log.info('Index not changed, skipping upload')
             return
         if self.conf.args.test:
@@ -86,10 +194,47 @@ class SecureIndexFactory:
 
         # cached by api
         bucket = self.api.get_bucket_by_name(self.bucket_name)
-        backblaze_b2.uploadSecureFile(conf=self.conf,
-                                      bucket=bucket,
-                                      filepath=secureIndex.filename,
-                                      saveModTime=True,
-                                      customName=self.__getName())
-
-        log.info('Index uploaded')
+        seq = (secureIndex.getSeq() or 0) + 1
+        baseSeq = secureIndex.getBaseSeq()
+        if secureIndex.forceUpload or baseSeq is None or seq - baseSeq > INDEX_COMPACT_DELTAS:
+            self.__uploadBase(secureIndex, bucket, seq)
+        else:
+            self.__uploadDelta(secureIndex, bucket, seq)
+        secureIndex.forceUpload = False
+
+    def __uploadBase(self, secureIndex, bucket, seq):
+        tempPath = self.conf.IndexPath + '.base'
+        try:
+            lastJournalSeq = secureIndex.createSnapshot(tempPath, seq)
+            backblaze_b2.uploadSecureFile(conf=self.conf,
+                                          bucket=bucket,
+                                          filepath=tempPath,
+                                          saveModTime=True,
+                                          customName=self.__getName(),
+                                          extraInfo={backblaze_b2.INDEX_SEQ_INFO: str(seq)})
+            secureIndex.markUploaded(lastJournalSeq, seq, isBase=True)
+        finally:
+            util.silentRemove(tempPath)
+        log.info(f'Index uploaded ({seq})')
+
+        # the base includes all of the old deltas
+        for deltaSeq, fileInfo in self.__listDeltas():
+            if deltaSeq <= seq:
+                try:
+                    bucket.delete_file_version(fileInfo['fileId'], fileInfo['fileName'])
+                except Exception:
+                    log.exception(f'Failed to delete old index delta ({deltaSeq})')
+
+    def __uploadDelta(self, secureIndex, bucket, seq):
+        tempPath = self.conf.IndexPath + '.delta'
+        try:
+            lastJournalSeq = secureIndex.exportJournal(tempPath)
+            backblaze_b2.uploadSecureFile(conf=self.conf,
+                                          bucket=bucket,
+                                          filepath=tempPath,
+                                          secureName=self.__getDeltaName(seq),
+                                          extraInfo={backblaze_b2.INDEX_SEQ_INFO: str(seq)})
+            secureIndex.markUploaded(lastJournalSeq, seq)
+        finally:
+            util.silentRemove(tempPath)
+        log.info(f'Index delta uploaded ({seq})')
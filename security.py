@@ -1,15 +1,35 @@
 import base64
+import gzip
+import io
+import logging
 import os
 import shutil
 import threading
+import zlib
 import gnupg_ext
+from abc import ABCMeta, abstractmethod
+from argon2 import low_level
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from argon2_ext import ArgonHasher
+from b2_ext.download_dest import AbstractDownloadDestination
 from utility import util
+from utility import aes_stream
+from utility.aes_stream import AesEncryptStream, AesDecryptStream
 from utility.gzip_stream import GzipCompressStream
 from utility.gzip_stream import GzipDecompressStream
 from utility.hash_stream import HashStream
 
 
+log = logging.getLogger()
+
+GPG_BACKEND = 'gpg'
+AES_BACKEND = 'aes'
+CRYPTO_BACKENDS = (GPG_BACKEND, AES_BACKEND)
+# raised when downloaded data can't be decrypted or decompressed, as opposed to when it can't be downloaded
+DECRYPT_ERRORS = (aes_stream.AesStreamError, gnupg_ext.GpgExtError, gzip.BadGzipFile, zlib.error, EOFError)
+
 class Passthrough(object):
     def __init__(self, obj):
         self.passObj = obj
@@ -42,26 +62,245 @@ def __getGpg(conf):
 
 def cleanupGpg(conf):
     global gpgCache
+    warm = sum(gpg.warmStarts for gpg in gpgCache.values())
+    cold = sum(gpg.coldStarts for gpg in gpgCache.values())
+    if warm or cold:
+        log.info(f'Gpg processes used: {warm} warm, {cold} cold')
+    for gpg in gpgCache.values():
+        gpg.close()
     gpgCache = {}
     if os.path.exists(conf.GPGHome):
         shutil.rmtree(conf.GPGHome)
 
-def generateSecureName(conf, filename):
-    argonSalt = base64.b64decode(conf.ArgonSalt.encode('ascii'))
-    h = ArgonHasher(time_cost=1, memory_cost=512, parallelism=2, salt_len=0)
-    hs = h.hashWithFixedSalt(conf.SecureNameSalt + filename, argonSalt)
+nameHasher = ArgonHasher(time_cost=1, memory_cost=512, parallelism=2, salt_len=0)
+
+def deriveSecureName(secureNameSalt, argonSalt, filename):
+    """
+    Derive the secure name without any caching
+    :param argonSalt: decoded argon salt bytes
+    """
+    hs = nameHasher.hashWithFixedSalt(secureNameSalt + filename, argonSalt)
     #trim the argon details and salt, they should be constant anyway
     hs = hs[51:]
     return base64.b64encode(hs.encode('utf-8'), b'-_').decode('utf-8')
 
+class SecureNames(object):
+    """
+    Derives secure names with the salts decoded once and keeps the most recently used names in memory.
+    Names that are already known, like the remoteName stored in the index, can be passed in so they
+    don't have to be derived again.
+
+    :param secureNameSalt: SecureNameSalt from the config
+    :param argonSalt: base64 encoded ArgonSalt from the config
+    :param cacheSize: max number of names to keep in memory
+    """
+
+    DEFAULT_CACHE_SIZE = 100000
+    # paths per task when deriving names in batches
+    __BATCH_CHUNK = 64
+
+    def __init__(self, secureNameSalt, argonSalt, cacheSize=None):
+        self.secureNameSalt = secureNameSalt
+        self.argonSalt = base64.b64decode(argonSalt.encode('ascii'))
+        self.cacheSize = cacheSize or self.DEFAULT_CACHE_SIZE
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        self.__names = OrderedDict()
+
+    def get(self, filename, knownName=None):
+        """
+        Get the secure name for a file
+        :param filename: normalized relative path
+        :param knownName: secure name that was already derived for this path, ex. remoteName from the index
+        """
+        if knownName:
+            self.put(filename, knownName)
+            return knownName
+        with self.lock:
+            name = self.__names.get(filename)
+            if name is not None:
+                self.__names.move_to_end(filename)
+                self.hits += 1
+                return name
+            self.misses += 1
+        name = deriveSecureName(self.secureNameSalt, self.argonSalt, filename)
+        self.put(filename, name)
+        return name
+
+    def put(self, filename, name):
+        with self.lock:
+            self.__names[filename] = name
+            self.__names.move_to_end(filename)
+            while len(self.__names) > self.cacheSize:
+                self.__names.popitem(last=False)
+
+    def getMany(self, filenames, workers=None, knownNames=None, executor=None):
+        """
+        Get the secure names for a list of files, names that aren't cached are derived in parallel.
+        Argon2 runs in native code without holding the GIL so threads are used instead of processes.
+        :param knownNames: dictionary of path -> secure name that are already known
+        :param executor: thread pool to derive the names on, one with workers threads is made for the call if None
+        :return: dictionary of path -> secure name
+        """
+        knownNames = knownNames or {}
+        result = {}
+        missing = []
+        for f in filenames:
+            if knownNames.get(f):
+                result[f] = self.get(f, knownNames[f])
+                continue
+            with self.lock:
+                name = self.__names.get(f)
+                if name is not None:
+                    self.__names.move_to_end(f)
+                    self.hits += 1
+                    result[f] = name
+                    continue
+                self.misses += 1
+            missing.append(f)
+
+        if not missing:
+            return result
+        chunks = [missing[i:i + self.__BATCH_CHUNK] for i in range(0, len(missing), self.__BATCH_CHUNK)]
+        ownExecutor = executor is None
+        if ownExecutor:
+            executor = ThreadPoolExecutor(max_workers=workers or os.cpu_count() or 1)
+        try:
+            for chunk, names in zip(chunks, executor.map(self.__deriveChunk, chunks)):
+                for f, name in zip(chunk, names):
+                    self.put(f, name)
+                    result[f] = name
+        finally:
+            if ownExecutor:
+                executor.shutdown()
+        return result
+
+    def __deriveChunk(self, filenames):
+        return [deriveSecureName(self.secureNameSalt, self.argonSalt, f) for f in filenames]
+
+__namesLock = threading.Lock()
+
+secureNamesCache = {}
+
+def getSecureNames(conf):
+    """
+    Get the process wide SecureNames for the configured salts
+    """
+    key = (conf.SecureNameSalt, conf.ArgonSalt)
+    with __namesLock:
+        if key not in secureNamesCache:
+            secureNamesCache[key] = SecureNames(conf.SecureNameSalt, conf.ArgonSalt)
+        return secureNamesCache[key]
+
+def generateSecureName(conf, filename, knownName=None):
+    return getSecureNames(conf).get(filename, knownName)
+
 def compressAndEncrypt(conf, filename):
     p, h = compressAndEncryptWithHash(conf, filename, False)
     return p
 
-tids = {}
+def getCryptoBackend(conf, name=None):
+    """
+    Get the crypto backend to use on the calling thread
+    :param name: name of the backend, files that were encrypted before the backend was recorded have no name
+                 and use gpg
+    """
+    name = name or GPG_BACKEND
+    if name == GPG_BACKEND:
+        return GpgBackend(__getGpg(conf), conf.GPGRecipient, conf.args.passphrase)
+    elif name == AES_BACKEND:
+        return AesBackend(__getKeyEncryptionKey(conf))
+    raise ValueError(f'Unknown crypto backend: {name}')
+
+__kekLock = threading.Lock()
+
+kekCache = {}
+
+def __getKeyEncryptionKey(conf):
+    # deriving the key is slow on purpose, only do it once per process
+    cacheKey = (conf.args.passphrase, conf.ArgonSalt)
+    with __kekLock:
+        if cacheKey not in kekCache:
+            argonSalt = base64.b64decode(conf.ArgonSalt.encode('ascii'))
+            kekCache[cacheKey] = low_level.hash_secret_raw(secret=conf.args.passphrase.encode('utf-8'),
+                                                           salt=argonSalt + b'ssync-aes-kek',
+                                                           time_cost=3, memory_cost=64 * 1024, parallelism=2,
+                                                           hash_len=32, type=low_level.Type.ID)
+        return kekCache[cacheKey]
+
+class CryptoBackend(metaclass=ABCMeta):
+    """
+    Encrypts and decrypts streams. Both methods return a context manager for a readable stream.
+    """
+
+    name = None
+    # number of bytes from the start of a file that verifyPrefix needs, None if only whole files can be checked
+    prefixSize = None
+
+    @abstractmethod
+    def openEncryptStream(self, instream):
+        pass
+
+    @abstractmethod
+    def openDecryptStream(self, instream):
+        pass
+
+    def verifyPrefix(self, data):
+        """
+        Check that the start of an encrypted file can be decrypted, raises an exception if it can't
+        :param data: the first prefixSize bytes of the file, or the whole file if it's shorter
+        """
+        raise NotImplementedError(f'{self.name} files can only be checked whole')
+
+class GpgBackend(CryptoBackend):
+    """
+    Encrypts to the configured gpg recipient using a gpg sub process
+    """
+
+    name = GPG_BACKEND
+
+    def __init__(self, gpg, recipient, passphrase):
+        self.gpg = gpg
+        self.recipient = recipient
+        self.passphrase = passphrase
+
+    def openEncryptStream(self, instream):
+        return self.gpg.openEncryptStream(instream, self.recipient, compress=False)
+
+    @contextmanager
+    def openDecryptStream(self, instream):
+        with self.gpg.openDecryptStream(instream, self.passphrase) as din:
+            yield din
+        if not self.gpg.result.ok:
+            raise gnupg_ext.GpgExtError('Decryption failed: ' + self.gpg.result.status)
+
+class AesBackend(CryptoBackend):
+    """
+    Encrypts in process with AES-GCM, every file gets a random data key that is stored with the file
+    encrypted by a key derived from the passphrase
+    """
+
+    name = AES_BACKEND
+    # the header, the first segment and one more byte to show that the first segment isn't the last one
+    prefixSize = aes_stream.HEADER_SIZE + aes_stream.SEGMENT_SIZE + aes_stream.TAG_SIZE + 1
+
+    def __init__(self, keyEncryptionKey):
+        self.keyEncryptionKey = keyEncryptionKey
+
+    def openEncryptStream(self, instream):
+        return AesEncryptStream(instream, self.keyEncryptionKey)
+
+    def openDecryptStream(self, instream):
+        return AesDecryptStream(instream, self.keyEncryptionKey)
+
+    def verifyPrefix(self, data):
+        # every segment is authenticated on its own, decrypting the first one checks the key and the data
+        with AesDecryptStream(io.BytesIO(data), self.keyEncryptionKey) as din:
+            din.read(aes_stream.SEGMENT_SIZE)
 
 def compressAndEncryptWithHash(conf, filename, computeHash=True):
-    gpg = __getGpg(conf)
+    backend = getCryptoBackend(conf, conf.CryptoBackend)
     tempPath = getTempPath(filename)
     util.silentRemove(tempPath)
 
@@ -70,24 +309,118 @@ def compressAndEncryptWithHash(conf, filename, computeHash=True):
       with HashStream(fin) as hin:
        hin = hin if computeHash else fin
        with GzipCompressStream(hin) as gzip:
-        with gpg.openEncryptStream(gzip, conf.GPGRecipient, compress=False) as ein:
+        with backend.openEncryptStream(gzip) as ein:
          shutil.copyfileobj(ein, fout)
        hashDigest = hin.hexdigest() if computeHash else None
 
     return tempPath, hashDigest
 
-def decompressAndDecrypt(conf, path, destination):
-    gpg = __getGpg(conf)
+@contextmanager
+def openCompressAndEncryptStream(conf, filename, computeHash=True):
+    """
+    Opens a stream of the compressed and encrypted file without writing it to disk.
+    Yields (stream, hashStream), the hash of the plain file can be read from hashStream.hexdigest()
+    once the stream has been read to the end and before the context exits. hashStream is None if computeHash is False.
+    """
+    backend = getCryptoBackend(conf, conf.CryptoBackend)
+
+    with open(filename, 'rb') as fin:
+     with HashStream(fin) as hin:
+      hin = hin if computeHash else fin
+      with GzipCompressStream(hin) as gzip:
+       with backend.openEncryptStream(gzip) as ein:
+        yield ein, hin if computeHash else None
+
+def decompressAndDecrypt(conf, path, destination, backendName=None):
+    backend = getCryptoBackend(conf, backendName)
     computeHash = False
     util.silentRemove(destination)
 
     with open(path, 'rb') as fin:
      with open(destination, 'wb') as fout:
-      with gpg.openDecryptStream(fin, conf.args.passphrase) as din:
+      with backend.openDecryptStream(fin) as din:
        with GzipDecompressStream(din) as gzip:
         with HashStream(gzip) as hin:
          hin = hin if computeHash else gzip
          shutil.copyfileobj(hin, fout)
 
+def openDecryptDestination(conf, destination, backendName=None):
+    """
+    Create a download destination that decrypts and decompresses the download straight in to the destination file.
+    Uses the backend of the calling thread, the thread is only writing to the destination while it downloads.
+    :param backendName: crypto backend the file was encrypted with
+    """
+    return DownloadDestDecrypt(getCryptoBackend(conf, backendName), destination)
+
+class DownloadDestDecrypt(AbstractDownloadDestination):
+    """
+    Download destination that decrypts and decompresses the data as it is downloaded.
+    The plain file is written to a temp name next to the destination and renamed once the download is complete,
+    the encrypted data is never written to disk.
+    """
+
+    def __init__(self, backend, destination):
+        self.backend = backend
+        self.destination = destination
+
+    def open(self, file_id, file_name, content_length, content_type, content_sha1, file_info, mod_time_millis,
+             range_=None):
+        if range_ is not None:
+            raise ValueError('Encrypted files can only be downloaded whole')
+        return DecryptWriter(self.backend, self.destination)
+
+class DecryptWriter(object):
+    """
+    Writable stream that passes the data to the decrypt stream through a pipe, the output is decompressed and
+    written by a separate thread so the download never blocks on a full pipe.
+    """
+
+    def __init__(self, backend, destination):
+        self.destination = destination
+        self.tempPath = getTempPath(destination)
+        self.__backend = backend
+        self.__error = None
+        self.__pipeIn = None
+        self.__pipeOut = None
+        self.__thread = None
+
+    def __enter__(self):
+        util.silentRemove(self.tempPath)
+        # the pipe is only made here so a writer that is never entered doesn't leak it
+        rfd, wfd = os.pipe()
+        self.__pipeIn = os.fdopen(rfd, 'rb')
+        self.__pipeOut = os.fdopen(wfd, 'wb')
+        self.__thread = threading.Thread(target=self.__decrypt, daemon=True)
+        self.__thread.start()
+        return self
+
+    def __decrypt(self):
+        try:
+            with open(self.tempPath, 'wb') as fout:
+             with self.__backend.openDecryptStream(self.__pipeIn) as din:
+              with GzipDecompressStream(din) as gzip:
+               shutil.copyfileobj(gzip, fout)
+        except BaseException as e:
+            self.__error = e
+        finally:
+            # keep reading so the writer doesn't block if decryption stopped early
+            while self.__pipeIn.read(util.HASH_CHUNK):
+                pass
+            self.__pipeIn.close()
+
+    def write(self, data):
+        self.__pipeOut.write(data)
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.__pipeOut.close()
+        self.__thread.join()
+        if exc_type is None and self.__error is None:
+            os.replace(self.tempPath, self.destination)
+        else:
+            util.silentRemove(self.tempPath)
+        if exc_type is None and self.__error is not None:
+            raise self.__error
+        return None  # don't hide exception
+
 def getTempPath(filePath):
     return filePath + util.APPLICATION_EXT
@@ -16,6 +16,8 @@ from sync.sync import sync_folders
 from utility import config
 from utility import util
 from utility import humanize
+from utility import aes_stream
+from utility.AimdController import AimdController
 
 util.setupLogging('logging.conf')
 log = logging.getLogger()
@@ -25,7 +27,8 @@ MAIN_CONFIG_SECTION = 'SSync'
 B2_CONFIG_SECTION = 'RemoteB2'
 REQUIRED_CONFIG = {'TempDir': str, 'GPGHome': str, 'GPGKeyFile': str, 'GPGRecipient': str, 'IndexPath': str,
                    'LargeFileSize': str}
-OPTIONAL_CONFIG = {'SecureNameSalt' : str, 'ArgonSalt': str}
+OPTIONAL_CONFIG = {'SecureNameSalt' : str, 'ArgonSalt': str, 'HashCachePath': str, 'HashCacheSize': int,
+                   'CryptoBackend': str, 'MaxTempSize': str, 'MaxMemorySize': str}
 
 def createArgs():
     parser = argparse.ArgumentParser(description='Securely synchronize files between locations.',
@@ -45,15 +48,38 @@ def createArgs():
                         help='show output of what will happen without making any changes')
     parser.add_argument('-vi', '--validateIndex',
                         help='validate and update the index on the remote folder, does not run sync')
+    parser.add_argument('--deepValidation', action='store_true',
+                        help='with validateIndex, also check the size and sha1 of each file against the index')
+    parser.add_argument('--sampleRate', type=float, default=0.0,
+                        help='with deepValidation, fraction of the files to download and check that they decrypt')
+    parser.add_argument('--validationReport',
+                        help='with validateIndex, write the results as json to this file')
     parser.add_argument('-q', '--quiet', action='store_true',
                         help='do not show progress while syncing')
     parser.add_argument('--uploadIndex',
                         help='uploads the local index to the remote, debug use only')
+    parser.add_argument('--streamUpload', action='store_true',
+                        help='encrypt and upload files without temp files, interrupted large uploads can\'t be resumed')
+    parser.add_argument('--checkpointMinutes', type=float, default=15,
+                        help='upload the index changes every this many minutes while syncing, 0 to disable')
+    parser.add_argument('--checkpointSize', default='10G',
+                        help='upload the index changes every time this much data is transferred while syncing, '
+                             '0B to disable')
     parser.add_argument('-w', '--workers', type=int,
                         help='max number of worker threads for searching and uploading')
+    parser.add_argument('--cpuWorkers', type=int,
+                        help='number of worker threads that hash, compress and encrypt files before they are '
+                             'transferred, defaults to the number of cores')
+    parser.add_argument('--netWorkers', type=int,
+                        help='number of worker threads that transfer files, defaults to workers')
+    parser.add_argument('--adaptiveConcurrency', action='store_true',
+                        help='start with at most 4 requests at once and adjust the number up to netWorkers to what '
+                             'the link and b2 can take, instead of always running netWorkers requests at once')
     parser.add_argument('--exclude', nargs='+',
                         help="""ignore files that match the given pattern. The pattern is 
-                                a regular expression that is tested against the full path of each file""")
+                                a regular expression that is tested against the full path of each file.
+                                Directories are tested with a trailing '/', matching directories are not
+                                scanned unless an include pattern could match something inside of them""")
     parser.add_argument('--include', nargs='+',
                         help="""override ignoring files that match the given pattern. The pattern is 
                                 a regular expression that is tested against the full path of each file""")
@@ -86,6 +112,11 @@ def processConfig():
 
     conf.__setattr__('args', args)
     conf.args.workers = conf.args.workers or 20
+    conf.args.cpuWorkers = conf.args.cpuWorkers or os.cpu_count() or 1
+    conf.args.netWorkers = conf.args.netWorkers or conf.args.workers
+    # shared by the b2 requests and the sync, starts low and grows while the throughput improves
+    conf.__setattr__('concurrency', AimdController(min(4, conf.args.netWorkers), maximum=conf.args.netWorkers)
+                     if conf.args.adaptiveConcurrency else None)
 
     if not conf.args.exclude:
         conf.args.exclude = []
@@ -93,6 +124,18 @@ def processConfig():
         conf.args.include = []
 
     conf.__setattr__('largeFileBytes', humanize.human2bytes(conf.LargeFileSize))
+    conf.__setattr__('checkpointBytes', humanize.human2bytes(conf.args.checkpointSize))
+    # temp files and buffered streams of the uploads that are in flight are kept under these sizes
+    conf.__setattr__('maxTempBytes', humanize.human2bytes(conf.MaxTempSize or '4G'))
+    conf.__setattr__('maxMemoryBytes', humanize.human2bytes(conf.MaxMemorySize or '1G'))
+
+    # files record the backend they were encrypted with, this only selects the backend for new uploads
+    conf.CryptoBackend = (conf.CryptoBackend or security.GPG_BACKEND).lower()
+    if conf.CryptoBackend not in security.CRYPTO_BACKENDS:
+        raise config.ConfigException(f'Invalid CryptoBackend: {conf.CryptoBackend}, '
+                                     f'expected one of {security.CRYPTO_BACKENDS}')
+    if conf.CryptoBackend == security.AES_BACKEND:
+        aes_stream.checkAvailable()
 
     return conf, b2conf
 
@@ -123,7 +166,8 @@ def runSync(conf, api):
         exit(1)
 
 def runValidation(conf, api):
-    log.info(f'Starting index validation on: {conf.args.validateIndex} (files only)')
+    log.info(f'Starting index validation on: {conf.args.validateIndex} (files only'
+             f'{", deep" if conf.args.deepValidation else ""})')
 
     try:
         remote = folder_parser.parseSyncDir(conf.args.validateIndex, conf, api)
@@ -134,8 +178,15 @@ def runValidation(conf, api):
         log.exception('Invalid remote path for validateIndex')
         exit(1)
 
-    index_verficiation.ValidateAndUpdateIndex(remote.bucket, remote.path, remote.secureIndex)
-    remote.secureIndex.source.uploadIndex(remote.secureIndex)
+    try:
+        index_verficiation.ValidateAndUpdateIndex(remote.bucket, remote.path, remote.secureIndex, conf.args.workers,
+                                                  deep=conf.args.deepValidation,
+                                                  conf=conf,
+                                                  sampleRate=conf.args.sampleRate,
+                                                  reportPath=conf.args.validationReport)
+        remote.secureIndex.source.uploadIndex(remote.secureIndex)
+    finally:
+        remote.secureIndex.close()
     return
 
 def runUploadIndex(conf, api):
@@ -154,7 +205,10 @@ def runUploadIndex(conf, api):
         exit(1)
 
     remote.secureIndex.forceUpload = True
-    remote.secureIndex.source.uploadIndex(remote.secureIndex)
+    try:
+        remote.secureIndex.source.uploadIndex(remote.secureIndex)
+    finally:
+        remote.secureIndex.close()
     return
 
 def generateNewSalts(conf):
@@ -174,8 +228,8 @@ if conf.args.test:
     b2Api = None
 else:
     log.info('Starting b2 api')
-    b2Api = backblaze_b2.setupApi(b2conf)
-    b2Api.set_thread_pool_size(conf.args.workers)
+    b2Api = backblaze_b2.setupApi(b2conf, conf.concurrency)
+    b2Api.set_thread_pool_size(conf.args.netWorkers)
 
 if not os.path.exists(conf.GPGKeyFile):
     log.error('GPG key file not found at: ' + conf.GPGKeyFile)
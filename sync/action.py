@@ -11,13 +11,14 @@
 import os
 
 import b2_ext
+import backblaze_b2
 import security
 import six
 import logging
 import threading
 
 from abc import (ABCMeta, abstractmethod)
-from b2_ext.download_dest import DownloadDestLocalFile
+from b2_ext.bucket import Bucket
 from b2_ext.upload_source import UploadSourceLocalFile
 from b2_ext.utils import raise_if_shutting_down
 
@@ -27,6 +28,16 @@ from .report import SyncFileReporter
 
 log = logging.getLogger()
 
+# Stages an action is run in, each stage of the sync runs on its own pool of threads
+STAGE_PREPARE = 'prepare'
+STAGE_TRANSFER = 'transfer'
+STAGE_FINISH = 'finish'
+STAGES = (STAGE_PREPARE, STAGE_TRANSFER, STAGE_FINISH)
+
+# Budgets an action can use bytes from while it's running
+BUDGET_TEMP = 'temp'
+BUDGET_MEMORY = 'memory'
+
 
 @six.add_metaclass(ABCMeta)
 class AbstractAction(object):
@@ -35,21 +46,41 @@ class AbstractAction(object):
     a file.  Multi-threaded tasks create a sequence of Actions, which
     are then run by a pool of threads.
 
+    An action is run in three stages: do_prepare for the CPU work
+    (hashing, compressing and encrypting), do_action for the network
+    transfer and do_finish to update the index.  Each stage runs after
+    the previous one has finished, possibly on a different thread.
+
     An action can depend on other actions completing.  An example of
     this is making sure a CreateBucketAction happens before an
     UploadFileAction.
     """
 
     def run(self, remoteFolder, conf, reporter, dry_run=False):
+        """
+        Runs every stage of the action on the calling thread.
+        """
+        for stage in STAGES:
+            self.run_stage(stage, remoteFolder, conf, reporter, dry_run)
+
+    def run_stage(self, stage, remoteFolder, conf, reporter, dry_run=False):
         raise_if_shutting_down()
         try:
-            log.info(f'Starting action ({threading.get_ident()}): {str(self)}')
+            if stage == STAGE_PREPARE:
+                log.info(f'Starting action ({threading.get_ident()}): {str(self)}')
             if not dry_run:
-                self.do_action(remoteFolder, conf, reporter)
-            self.do_report(reporter)
+                if stage == STAGE_PREPARE:
+                    self.do_prepare(remoteFolder, conf, reporter)
+                elif stage == STAGE_TRANSFER:
+                    self.do_action(remoteFolder, conf, reporter)
+                else:
+                    self.do_finish(remoteFolder, conf, reporter)
+            if stage == STAGE_FINISH:
+                self.do_report(reporter)
         except Exception as e:
             log.exception('an exception occurred in a sync action')
             reporter.error(str(self) + ": " + repr(e) + ' ' + str(e))
+            self.cleanup(remoteFolder)
             raise  # Re-throw so we can identify failed actions
 
     @abstractmethod
@@ -58,10 +89,34 @@ class AbstractAction(object):
         Returns the number of bytes to transfer for this action.
         """
 
+    def get_budget(self, conf, remoteFolder):
+        """
+        Returns (budgetName, bytes) of the temp disk space or memory the
+        action uses until it finishes, or None if it doesn't need any.
+        """
+        return None
+
+    def do_prepare(self, remoteFolder, conf, reporter):
+        """
+        Does the local CPU bound work before the transfer.
+        """
+
     @abstractmethod
     def do_action(self, remoteFolder, conf, reporter):
         """
-        Performs the action, returning only after the action is completed.
+        Performs the transfer, returning only after it is completed.
+        """
+
+    def do_finish(self, remoteFolder, conf, reporter):
+        """
+        Records the result of the transfer.
+        """
+
+    def cleanup(self, remoteFolder):
+        """
+        Releases anything the earlier stages left for the later ones. Called when a stage fails, and on the
+        other actions that were run together with it since their later stages won't run either.
+        Can be called more than once.
         """
 
     @abstractmethod
@@ -72,73 +127,172 @@ class AbstractAction(object):
 
 
 class B2UploadAction(AbstractAction):
-    def __init__(self, sourceFile):
+    def __init__(self, sourceFile, hashCache=None):
         self.sourceFile = sourceFile
+        self.hashCache = hashCache
+        # state handed from the prepare stage to the transfer and finish stages
+        self.ent = None
+        self.b2Name = None
+        self.tempPath = None
+        self.resume = False
+        self.stream = False
+        # index entry from before the upload, put back if the upload is abandoned after marking it uploading
+        self.previous = None
+        self.markedUploading = False
 
     def get_bytes(self):
         return self.sourceFile.latest_version().size
 
-    def do_action(self, remoteFolder, conf, reporter):
+    def get_budget(self, conf, remoteFolder):
+        sf = self.sourceFile
+        if sf.isDir or conf.args.testIndex:
+            return None
+        if conf.args.streamUpload and not os.path.exists(security.getTempPath(sf.nativePath)):
+            # streamed files are buffered in memory, large ones only a few parts at a time
+            bucket = remoteFolder.bucket
+            # test mode has no bucket and doesn't buffer the stream, largeFileBytes stands in for the part size
+            minimumPartSize = bucket.api.account_info.get_minimum_part_size() if bucket is not None \
+                else conf.largeFileBytes
+            return BUDGET_MEMORY, Bucket.stream_memory_size(minimumPartSize, self.get_bytes(),
+                                                            min_large_file_size=conf.largeFileBytes)
+        # the compressed and encrypted temp file is about the size of the file
+        return BUDGET_TEMP, self.get_bytes()
+
+    def do_prepare(self, remoteFolder, conf, reporter):
         sf = self.sourceFile
 
-        ent = IndexEntry(path=sf.relativePath,
-                         isDir=sf.isDir,
-                         size=sf.latest_version().size,
-                         modTime=sf.latest_version().mod_time,
-                         hash=None,
-                         remoteId=None,
-                         remoteName=None)
-
-        if not sf.isDir and not conf.args.testIndex:
-            b2Name = security.generateSecureName(conf, sf.relativePath)
-
-            resume = False
-            getHash = sf.latest_version().hash is None
-
-            # check if we need to resume a large file upload
-            if os.path.exists(security.getTempPath(sf.nativePath)):
-                log.info('Found temp file for: ' + sf.relativePath)
-                ie = remoteFolder.secureIndex.get(sf.relativePath)
-                resume = ie and ie.status == 'uploading'
-                if not resume:
-                    log.info('No pending upload for file')
-
-            tempPath = None
-            if resume:
-                log.info('Attempting to resume upload from temp file')
-                sf.latest_version().hash = ie.hash
-                #todo:add temp file validation
-                log.info('Resuming previous upload')
-                tempPath = security.getTempPath(sf.nativePath)
-
-            if tempPath is None:
-                tempPath, hashDigest = security.compressAndEncryptWithHash(conf, sf.nativePath, getHash)
-                if getHash:
-                    sf.latest_version().hash = hashDigest
-            ent.hash = sf.latest_version().hash
-
-            # write working status so we don't have to re-encrypt when resuming large files
-            if self.sourceFile.latest_version().size > conf.largeFileBytes:
-                ent.status = 'uploading'
-                remoteFolder.secureIndex.addorUpdate(ent)
-
-            try:
-                if not conf.args.test:
-                    info = remoteFolder.bucket.upload(
-                        UploadSourceLocalFile(tempPath),
-                        b2Name,
-                        min_large_file_size=conf.largeFileBytes,
-                        ignore_unfinished_check=not resume,
-                        progress_listener=SyncFileReporter(reporter)
-                    )
-                    ent.remoteId = info.id_
-                    ent.remoteName = info.file_name
-            finally:
-                # delete the temp file after the upload
-                util.silentRemove(tempPath)
+        self.ent = ent = IndexEntry(path=sf.relativePath,
+                                    isDir=sf.isDir,
+                                    size=sf.latest_version().size,
+                                    modTime=sf.latest_version().mod_time,
+                                    hash=None,
+                                    remoteId=None,
+                                    remoteName=None,
+                                    crypto=conf.CryptoBackend)
+
+        if sf.isDir or conf.args.testIndex:
+            return
+
+        # files that were uploaded before already have their secure name in the index
+        ie = self.previous = remoteFolder.secureIndex.get(sf.relativePath)
+        self.b2Name = security.generateSecureName(conf, sf.relativePath, ie.remoteName if ie else None)
+
+        getHash = sf.latest_version().hash is None
+
+        # check if we need to resume a large file upload
+        if os.path.exists(security.getTempPath(sf.nativePath)):
+            log.info('Found temp file for: ' + sf.relativePath)
+            self.resume = bool(ie and ie.status == 'uploading')
+            if not self.resume:
+                log.info('No pending upload for file')
+
+        if not self.resume and conf.args.streamUpload:
+            # the file is compressed and encrypted while it's transferred
+            self.stream = True
+            return
+
+        if self.resume:
+            log.info('Attempting to resume upload from temp file')
+            sf.latest_version().hash = ie.hash
+            # the temp file was encrypted with the backend that was configured when it was created
+            ent.crypto = ie.crypto
+            #todo:add temp file validation
+            log.info('Resuming previous upload')
+            self.tempPath = security.getTempPath(sf.nativePath)
+        else:
+            # stat before reading so the cached hash is only saved if the file didn't change
+            st = os.stat(sf.nativePath) if getHash and self.hashCache is not None else None
+            self.tempPath, hashDigest = security.compressAndEncryptWithHash(conf, sf.nativePath, getHash)
+            if getHash:
+                sf.latest_version().hash = hashDigest
+                if st is not None:
+                    self.hashCache.put(sf.nativePath, st, hashDigest)
+        ent.hash = sf.latest_version().hash
+
+        # write working status so we don't have to re-encrypt when resuming large files
+        if sf.latest_version().size > conf.largeFileBytes:
+            ent.status = 'uploading'
+            remoteFolder.secureIndex.addorUpdate(ent)
+            self.markedUploading = True
 
+    def do_action(self, remoteFolder, conf, reporter):
+        if self.sourceFile.isDir or conf.args.testIndex:
+            return
+        if self.stream:
+            getHash = self.sourceFile.latest_version().hash is None
+            self.__streamUpload(remoteFolder, conf, reporter, self.b2Name, getHash, self.ent)
+            return
+
+        ent = self.ent
+        try:
+            if not conf.args.test:
+                info = remoteFolder.bucket.upload(
+                    UploadSourceLocalFile(self.tempPath),
+                    self.b2Name,
+                    min_large_file_size=conf.largeFileBytes,
+                    ignore_unfinished_check=not self.resume,
+                    progress_listener=SyncFileReporter(reporter)
+                )
+                ent.remoteId = info.id_
+                ent.remoteName = info.file_name
+                ent.remoteSize = info.size
+                ent.remoteSha1 = backblaze_b2.normalizeContentSha1(info.content_sha1)
+        finally:
+            # delete the temp file after the upload
+            self.__removeTempFile()
+
+    def do_finish(self, remoteFolder, conf, reporter):
+        self.ent.status = None
+        remoteFolder.secureIndex.addorUpdate(self.ent)
+        self.markedUploading = False
+
+    def cleanup(self, remoteFolder):
+        self.__removeTempFile()
+        if self.markedUploading:
+            # the entry has no remote file yet, the temp file it points to for resuming is gone
+            if self.previous is not None:
+                remoteFolder.secureIndex.addorUpdate(self.previous)
+            else:
+                remoteFolder.secureIndex.remove(self.ent)
+            self.markedUploading = False
+
+    def __removeTempFile(self):
+        if self.tempPath is not None:
+            util.silentRemove(self.tempPath)
+            self.tempPath = None
+
+    def __streamUpload(self, remoteFolder, conf, reporter, b2Name, getHash, ent):
+        """
+        Compress, encrypt and upload the file in one pass without a temp file.
+        Large files are uploaded in parts from memory so they can't be resumed.
+        """
+        sf = self.sourceFile
+        # stat before reading so the cached hash is only saved if the file didn't change
+        st = os.stat(sf.nativePath) if getHash and self.hashCache is not None else None
+
+        with security.openCompressAndEncryptStream(conf, sf.nativePath, getHash) as (stream, hashStream):
+            if conf.args.test:
+                while stream.read(util.HASH_CHUNK):
+                    pass
+            else:
+                info = remoteFolder.bucket.upload_stream(
+                    stream,
+                    b2Name,
+                    min_large_file_size=conf.largeFileBytes,
+                    content_length_hint=sf.latest_version().size,
+                    progress_listener=SyncFileReporter(reporter)
+                )
+                ent.remoteId = info.id_
+                ent.remoteName = info.file_name
+                ent.remoteSize = info.size
+                ent.remoteSha1 = backblaze_b2.normalizeContentSha1(info.content_sha1)
+            if getHash:
+                sf.latest_version().hash = hashStream.hexdigest()
+
+        if getHash and st is not None:
+            self.hashCache.put(sf.nativePath, st, sf.latest_version().hash)
+        ent.hash = sf.latest_version().hash
         ent.status = None
-        remoteFolder.secureIndex.addorUpdate(ent)
 
     def do_report(self, reporter):
         text = 'Uploaded ' + self.sourceFile.relativePath
@@ -167,15 +321,11 @@ class B2DownloadAction(AbstractAction):
             util.silentRemove(self.localPath)
             open(self.localPath, 'a').close()
         else:
-            # Download the file to a .tmp file
-            downloadPath = self.localPath + util.APPLICATION_EXT
-            destination = DownloadDestLocalFile(downloadPath)
-
+            # Decrypt while downloading, the plain file is written to a temp file and renamed when it's complete
+            destination = security.openDecryptDestination(conf, self.localPath,
+                                                          self.remoteFile.latest_version().crypto)
             remoteFolder.bucket.download_file_by_name(
                 self.remoteFile.nativePath, destination, SyncFileReporter(reporter))
-            security.decompressAndDecrypt(conf, downloadPath, self.localPath)
-
-            util.silentRemove(downloadPath)
 
         modTime = self.remoteFile.latest_version().mod_time / 1000.0
         os.utime(self.localPath, (modTime, modTime))
@@ -205,6 +355,8 @@ class B2DeleteAction(AbstractAction):
             except b2_ext.exception.FileNotPresent:
                 # ignore if the files doesn't exist, operation was likely interrupted and index is wrong
                 pass
+
+    def do_finish(self, remoteFolder, conf, reporter):
         remoteFolder.secureIndex.remove(self.remoteFile.relativePath)
 
     def do_report(self, reporter):
@@ -8,15 +8,18 @@
 #
 ######################################################################
 
+import itertools
 import os
 import sys
 import logging
+from stat import S_ISDIR
 from abc import ABCMeta, abstractmethod
 
 from b2_ext.raw_api import SRC_LAST_MODIFIED_MILLIS
 from utility import util
+from utility.dir_summary import DirSummaryBuilder, summaryMatches
 from .exception import EnvironmentEncodingError
-from .path_entity import PathEntity, FileVersion
+from .path_entity import PathEntity, FileVersion, SkippedSubtree
 
 log = logging.getLogger()
 
@@ -71,24 +74,41 @@ class LocalFolder(AbstractFolder):
     Folder interface to a directory on the local machine.
     """
 
-    def __init__(self, path):
+    # directories with more entries than this aren't compared with their summary as a whole, the walk of the
+    # directory has to be kept in memory until it's compared. Their sub directories still are.
+    MAX_SUMMARY_ENTRIES = 10000
+
+    def __init__(self, path, hashCache=None):
         """
         Initializes a new folder.
         :param path: Path to the root of the local folder.  Must be unicode.
+        :param hashCache: optional HashCache used to avoid re-reading unchanged files
         """
         if not isinstance(path, str):
             raise ValueError('folder path should be unicode: %s' % repr(path))
         self.path = os.path.abspath(path)
         if not self.path.endswith(os.sep):
             self.path += os.sep
+        self.hashCache = hashCache
 
     def type(self):
         return 'local'
 
-    def all_files(self, reporter):
-        for (full_path, isDir) in self.__walk_relative_paths(self.path, reporter):
+    def all_files(self, reporter, pathFilter=None, summaryIndex=None, useHash=False):
+        """
+        :param pathFilter: optional PathFilter, excluded files are skipped and excluded directories are not walked
+        :param summaryIndex: optional SecureIndex with directory summaries, the contents of a directory that
+                             matches its summary are replaced by a SkippedSubtree
+        :param useHash: compare the summaries including the file hashes, hashes are only taken from the hash
+                        cache so directories with files that aren't cached are never skipped
+        """
+        for item in self.__walk_relative_paths(self.path, reporter, pathFilter, summaryIndex, useHash):
+            if isinstance(item, SkippedSubtree):
+                yield item
+                continue
+            (full_path, isDir, stat) = item
             try:
-                yield self.__makePathEntity(full_path, isDir)
+                yield self.__makePathEntity(full_path, isDir, stat)
             except:
                 log.exception('Failed to create path entity: ' + full_path)
 
@@ -107,7 +127,7 @@ class LocalFolder(AbstractFolder):
         elif not os.path.isdir(self.path):
             raise Exception('%s is not a directory' % (self.path,))
 
-    def __walk_relative_paths(self, dir_path, reporter):
+    def __walk_relative_paths(self, dir_path, reporter, pathFilter=None, summaryIndex=None, useHash=False):
         """
         Yields all of the file names anywhere under this folder, in the
         order they would appear in B2. String sorting order.
@@ -116,19 +136,21 @@ class LocalFolder(AbstractFolder):
             raise ValueError('folder path should be unicode: %s' % repr(dir_path))
 
         # Collect the names
-        # We know the dir_path is unicode, which will cause os.listdir() to
+        # We know the dir_path is unicode, which will cause os.scandir() to
         # return unicode paths.
         names = []
-        paths = []
+        entries = []
         try:
-            paths = os.listdir(dir_path)
+            with os.scandir(dir_path) as it:
+                entries = list(it)
         except:
             log.exception('Failed to get children of: ' + dir_path)
 
-        for name in paths:
-            # We expect listdir() to return unicode if dir_path is unicode.
+        for entry in entries:
+            name = entry.name
+            # We expect scandir() to return unicode if dir_path is unicode.
             # If the file name is not valid, based on the file system
-            # encoding, then listdir() will return un-decoded str/bytes.
+            # encoding, then scandir() will return un-decoded str/bytes.
             if not isinstance(name, str):
                 name = self.__handle_non_unicode_file_name(name)
 
@@ -139,32 +161,98 @@ class LocalFolder(AbstractFolder):
             full_path = os.path.join(dir_path, name)
 
             # Skip broken symlinks or other inaccessible files
-            if not os.path.exists(full_path):
+            # The stat is cached by the entry and is reused for the size and mod time
+            try:
+                stat = entry.stat()
+            except OSError:
                 if reporter is not None:
                     reporter.local_access_error(full_path)
-            elif not os.access(full_path, os.R_OK):
+                continue
+            if not util.isReadable(stat):
                 if reporter is not None:
                     reporter.local_permission_error(full_path)
-            else:
-                isDir = os.path.isdir(full_path)
-                if isDir:
-                    full_path += os.sep
-                # need to keep sorting consistent and different path separators can change sorting between folder types
-                sortPath = full_path.replace(os.sep, '/')
-                names.append((full_path, sortPath, isDir))
+                continue
+
+            isDir = S_ISDIR(stat.st_mode)
+            if isDir:
+                full_path += os.sep
+
+            include = True
+            if pathFilter is not None:
+                relativePath = util.normalizePath(full_path[len(self.path):], isDir)
+                include = pathFilter.isIncluded(relativePath)
+                if not include and (not isDir or pathFilter.canPruneDir(relativePath)):
+                    log.debug('Skipping excluded path: %s', full_path)
+                    continue
+            # need to keep sorting consistent and different path separators can change sorting between folder types
+            sortPath = full_path.replace(os.sep, '/')
+            names.append((full_path, sortPath, isDir, stat, include))
 
         # Yield all of the answers
-        for full_path, tmp, isDir in sorted(names, key=lambda x: x[1].lower()):
+        for full_path, tmp, isDir, stat, include in sorted(names, key=lambda x: x[1].lower()):
+            if isDir:
+                # excluded directories are still walked if an inclusion could match something inside of them
+                if include:
+                    yield (full_path, True, stat)
+                if include and summaryIndex is not None:
+                    yield from self.__walk_summarized(full_path, reporter, pathFilter, summaryIndex, useHash)
+                else:
+                    for rp in self.__walk_relative_paths(full_path, reporter, pathFilter, summaryIndex, useHash):
+                        yield rp
+            else:
+                yield (full_path, False, stat)
+
+    def __walk_summarized(self, dir_path, reporter, pathFilter, summaryIndex, useHash):
+        """
+        Walks a directory and compares it with its summary in the index, yields a SkippedSubtree instead of its
+        contents if they match.
+        """
+        relativePath = self.__relativePath(dir_path, True)
+        stored = summaryIndex.getSummary(relativePath)
+        if stored is None or stored[2] > self.MAX_SUMMARY_ENTRIES:
+            yield from self.__walk_relative_paths(dir_path, reporter, pathFilter, summaryIndex, useHash)
+            return
+
+        walk = self.__walk_relative_paths(dir_path, reporter, pathFilter)
+        entries = list(itertools.islice(walk, stored[2] + 1))
+        if len(entries) > stored[2]:
+            # more entries than the index has, walk again so the sub directories are still compared
+            walk.close()
+            yield from self.__walk_relative_paths(dir_path, reporter, pathFilter, summaryIndex, useHash)
+            return
+
+        builder = DirSummaryBuilder(relativePath)
+        for full_path, isDir, stat in entries:
+            path = self.__relativePath(full_path, isDir)
             if isDir:
-                yield (full_path, True)
-                for rp in self.__walk_relative_paths(full_path, reporter):
-                    yield rp
+                builder.addDir(path)
             else:
-                yield (full_path, False)
+                hash = self.hashCache.get(full_path, stat) if useHash and self.hashCache is not None else None
+                builder.addFile(path, stat.st_size, util.getModTimeFromStat(stat), hash)
+        computed = builder.finish()
+        if summaryMatches(computed.get(relativePath), stored, useHash):
+            yield SkippedSubtree(relativePath, stored[2])
+            return
+
+        # something changed, the sub directories that didn't can still be skipped
+        i = 0
+        while i < len(entries):
+            full_path, isDir, stat = entries[i]
+            yield entries[i]
+            i += 1
+            if isDir:
+                path = self.__relativePath(full_path, True)
+                if summaryMatches(computed.get(path), summaryIndex.getSummary(path), useHash):
+                    yield SkippedSubtree(path, computed[path][2])
+                    while i < len(entries) and entries[i][0].startswith(full_path):
+                        i += 1
+
+    def __relativePath(self, fullPath, isDir):
+        return util.normalizePath(fullPath[len(self.path):], isDir)
 
     def __handle_non_unicode_file_name(self, name):
         """
-        Decide what to do with a name returned from os.listdir()
+        Decide what to do with a name returned from os.scandir()
         that isn't unicode.  We think that this only happens when
         the file name can't be decoded using the file system
         encoding. Just in case that's not true, we'll allow all-ascii
@@ -175,12 +263,11 @@ class LocalFolder(AbstractFolder):
             return name
         raise EnvironmentEncodingError(repr(name), sys.getfilesystemencoding())
 
-    def __makePathEntity(self, fullPath, isDir):
-        relativePath = fullPath[len(self.path):]
+    def __makePathEntity(self, fullPath, isDir, stat):
         # Normalize path separators to match b2
-        normalRelativePath = util.normalizePath(relativePath, isDir)
-        mod_time = util.getModTime(fullPath)
-        size = 0 if isDir else os.path.getsize(fullPath)
+        normalRelativePath = self.__relativePath(fullPath, isDir)
+        mod_time = util.getModTimeFromStat(stat)
+        size = 0 if isDir else stat.st_size
 
         # Hash is computed later
         version = FileVersion(id_=fullPath,
@@ -191,9 +278,20 @@ class LocalFolder(AbstractFolder):
 
     def updateHashForSubFile(self, pathEntity):
         if not pathEntity.latest_version().hash and not pathEntity.isDir:
-            pathEntity.latest_version().hash = util.calculateHash(pathEntity.nativePath)
+            if self.hashCache is None:
+                pathEntity.latest_version().hash = util.calculateHash(pathEntity.nativePath)
+            else:
+                pathEntity.latest_version().hash = self.hashCache.getOrCalculate(pathEntity.nativePath)
         return pathEntity.latest_version().hash
 
+    def close(self):
+        """
+        Prune and close the hash cache, should be called after the sync is finished.
+        """
+        if self.hashCache is not None:
+            self.hashCache.prune(self.path)
+            self.hashCache.close()
+
     def __repr__(self):
         return 'LocalFolder: ' + self.path
 
@@ -212,15 +310,16 @@ class SecureFolder(AbstractFolder):
         self.bucket = bucket
 
     def all_files(self, reporter):
-        for fileInfo in self.secureIndex.getAll():
-            if self.path != '':
-                # Index is sorted by name so try and find the dir and start from there
-                if fileInfo < self.path:
-                    continue
-                # We either passed all of the files in this folder or there were none
-                if not fileInfo.path.startswith(self.path.lower()):
-                    break;
-
+        # Streams the entries in this folder in sorted order, without loading the whole index.
+        # A lower case key can be sent to skip ahead, like SecureIndex.iterateOrdered
+        records = self.secureIndex.iterateOrdered(self.path)
+        skipTo = None
+        while True:
+            try:
+                fileInfo = records.send(skipTo) if skipTo is not None else next(records)
+            except StopIteration:
+                return
+            skipTo = None
             # ignore files that were uploading, we want to resume them, so they shouldn't appear in the secure folder
             if fileInfo.status == 'uploading':
                 continue
@@ -228,10 +327,11 @@ class SecureFolder(AbstractFolder):
             version = FileVersion(id_=fileInfo.remoteId,
                                   size=fileInfo.size,
                                   mod_time=fileInfo.modTime,
-                                  hash=fileInfo.hash)
+                                  hash=fileInfo.hash,
+                                  crypto=fileInfo.crypto)
             pathEntity = PathEntity(fileInfo.remoteName, fileInfo.path, fileInfo.isDir, [version])
 
-            yield pathEntity
+            skipTo = yield pathEntity
 
     def type(self):
         return 'sec'
@@ -14,6 +14,7 @@ from b2_ext.exception import CommandError
 from index.secure_index_factory import SecureIndexFactory
 from utility import util
 from .folder import LocalFolder, SecureFolder
+from .hash_cache import HashCache
 
 log = logging.getLogger()
 
@@ -29,7 +30,10 @@ def parseSyncDir(dirPath, conf, api):
         return parseSecureB2Folder(dirPath, conf, api, False)
     else:
         log.info(f'Parsing {dirPath} as local path')
-        return LocalFolder(dirPath)
+        hashCache = None
+        if conf.HashCachePath:
+            hashCache = HashCache(conf.HashCachePath, conf.HashCacheSize)
+        return LocalFolder(dirPath, hashCache)
 
 
 def parseSecureB2Folder(path, conf, api, forceLocalIndex):
@@ -0,0 +1,169 @@
+import os
+import sqlite3
+import threading
+import time
+import logging
+
+from utility import util
+
+log = logging.getLogger()
+
+CACHE_TABLE_NAME = 'hashes'
+
+
+class HashCache:
+    """
+    Persistent cache of local file hashes so unchanged files don't have to be read again on every sync.
+
+    Entries are keyed by (device, inode, size, mtime_ns, ctime_ns), any change to the file will change at least
+    one of those values so a stale hash is never returned. The path is stored alongside the key so entries for
+    deleted files can be evicted.
+
+    Writes are buffered and committed in batches inside a sqlite transaction, an interrupted run leaves the
+    cache in the last committed state.
+
+    :param filename: path to the sqlite cache file
+    :param maxEntries: max number of entries to keep, least recently seen entries are evicted first
+    """
+
+    DEFAULT_MAX_ENTRIES = 5000000
+    __BATCH_SIZE = 1000
+
+    def __init__(self, filename, maxEntries=None):
+        self.filename = filename
+        self.maxEntries = maxEntries or self.DEFAULT_MAX_ENTRIES
+        self.runStart = int(round(time.time() * 1000))
+        self.lock = threading.Lock()
+        self.__pendingPuts = []
+        self.__pendingTouches = []
+        self.__conn = sqlite3.connect(filename, check_same_thread=False)
+        self.__conn.execute(f'CREATE TABLE IF NOT EXISTS {CACHE_TABLE_NAME} ('
+                            'dev INTEGER NOT NULL, '
+                            'ino INTEGER NOT NULL, '
+                            'size INTEGER NOT NULL, '
+                            'mtimeNs INTEGER NOT NULL, '
+                            'ctimeNs INTEGER NOT NULL, '
+                            'hash TEXT NOT NULL, '
+                            'path TEXT NOT NULL, '
+                            'lastSeen INTEGER NOT NULL, '
+                            'PRIMARY KEY (dev, ino))')
+        self.__conn.execute(f'CREATE INDEX IF NOT EXISTS {CACHE_TABLE_NAME}_lastSeen '
+                            f'ON {CACHE_TABLE_NAME} (lastSeen)')
+        self.__conn.commit()
+
+    @staticmethod
+    def __usable(st):
+        # some file systems (FAT, some network shares) don't have stable inode numbers
+        return st.st_ino != 0
+
+    def get(self, path, st):
+        """
+        Get the cached hash for a file
+        :param path: full path to the file
+        :param st: stat result of the file
+        :return: hash or None if the file isn't cached or has changed
+        """
+        if not self.__usable(st):
+            return None
+        with self.lock:
+            row = self.__conn.execute(
+                f'SELECT size, mtimeNs, ctimeNs, hash, path FROM {CACHE_TABLE_NAME} WHERE dev=? AND ino=?',
+                (st.st_dev, st.st_ino)).fetchone()
+            if row is None or row[:3] != (st.st_size, st.st_mtime_ns, st.st_ctime_ns):
+                return None
+            self.__pendingTouches.append((self.runStart, path, st.st_dev, st.st_ino))
+            self.__flushIfFull()
+            return row[3]
+
+    def put(self, path, st, hash):
+        """
+        Add a hash to the cache
+        :param path: full path to the file
+        :param st: stat result taken before the file was read
+        :param hash: hash of the file contents
+        """
+        if not self.__usable(st):
+            return
+        # Don't cache the hash if the file changed while it was being read
+        try:
+            after = os.stat(path)
+        except OSError:
+            return
+        if self.__key(st) != self.__key(after):
+            log.debug(f'File changed while hashing, not caching: {path}')
+            return
+        with self.lock:
+            self.__pendingPuts.append(self.__key(st) + (hash, path, self.runStart))
+            self.__flushIfFull()
+
+    def getOrCalculate(self, path):
+        st = os.stat(path)
+        hash = self.get(path, st)
+        if hash is None:
+            hash = util.calculateHash(path)
+            self.put(path, st, hash)
+        return hash
+
+    @staticmethod
+    def __key(st):
+        return st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns, st.st_ctime_ns
+
+    def __flushIfFull(self):
+        if len(self.__pendingPuts) + len(self.__pendingTouches) >= self.__BATCH_SIZE:
+            self.__writePending()
+
+    def __writePending(self):
+        with self.__conn:
+            self.__conn.executemany(
+                f'INSERT OR REPLACE INTO {CACHE_TABLE_NAME} '
+                '(dev, ino, size, mtimeNs, ctimeNs, hash, path, lastSeen) VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                self.__pendingPuts)
+            self.__conn.executemany(
+                f'UPDATE {CACHE_TABLE_NAME} SET lastSeen=?, path=? WHERE dev=? AND ino=?',
+                self.__pendingTouches)
+        self.__pendingPuts.clear()
+        self.__pendingTouches.clear()
+
+    def flush(self):
+        with self.lock:
+            self.__writePending()
+
+    def prune(self, rootPath):
+        """
+        Evict entries under rootPath that weren't seen during this run and no longer point to an existing file,
+        then trim the cache down to maxEntries.
+        :param rootPath: full path of the folder that was scanned
+        """
+        with self.lock:
+            self.__writePending()
+            stale = []
+            rows = self.__conn.execute(
+                f'SELECT dev, ino, path FROM {CACHE_TABLE_NAME} WHERE lastSeen < ? AND substr(path, 1, ?) = ?',
+                (self.runStart, len(rootPath), rootPath)).fetchall()
+            for dev, ino, path in rows:
+                try:
+                    st = os.stat(path)
+                    if st.st_dev == dev and st.st_ino == ino:
+                        continue
+                except OSError:
+                    pass
+                stale.append((dev, ino))
+
+            with self.__conn:
+                self.__conn.executemany(f'DELETE FROM {CACHE_TABLE_NAME} WHERE dev=? AND ino=?', stale)
+                count = self.__conn.execute(f'SELECT COUNT(*) FROM {CACHE_TABLE_NAME}').fetchone()[0]
+                if count > self.maxEntries:
+                    self.__conn.execute(
+                        f'DELETE FROM {CACHE_TABLE_NAME} WHERE rowid IN '
+                        f'(SELECT rowid FROM {CACHE_TABLE_NAME} ORDER BY lastSeen LIMIT ?)',
+                        (count - self.maxEntries,))
+            log.info(f'Hash cache pruned, removed ({len(stale)}) deleted files, '
+                     f'trimmed ({max(0, count - self.maxEntries)}) old entries')
+
+    def close(self):
+        with self.lock:
+            if self.__conn is None:
+                return
+            self.__writePending()
+            self.__conn.close()
+            self.__conn = None
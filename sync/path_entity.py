@@ -44,6 +44,23 @@ class PathEntity(object):
         return 'File: ' + self.relativePath
 
 
+class SkippedSubtree(object):
+    """
+    Stands in for everything under a directory whose summary matched the index, the files under it aren't
+    listed or compared.
+
+    :param relativePath: normalized path of the directory, with a trailing '/'
+    :param count: number of entries under the directory
+    """
+
+    def __init__(self, relativePath, count):
+        self.relativePath = relativePath
+        self.count = count
+
+    def __repr__(self):
+        return 'Skipped: ' + self.relativePath
+
+
 class FileVersion(object):
     """
     Holds information about one version of a file:
@@ -52,13 +69,15 @@ class FileVersion(object):
        mod_time - modification time, in milliseconds, to avoid rounding issues
                   with millisecond times from B2
        action - "hide" or "upload" (never "start")
+       crypto - crypto backend the remote file was encrypted with
     """
 
-    def __init__(self, id_, size, mod_time, hash):
+    def __init__(self, id_, size, mod_time, hash, crypto=None):
         self.id_ = id_
         self.size = size
         self.mod_time = mod_time
         self.hash = hash
+        self.crypto = crypto
 
     def __repr__(self):
         return 'FileVersion(%s, %s)' % (
@@ -0,0 +1,100 @@
+import re
+import logging
+
+log = logging.getLogger()
+
+SPECIAL_CHARS = set('.^$*+?{}[]\\|()')
+QUANTIFIER_CHARS = set('*+?{')
+
+
+def literalPrefix(pattern):
+    """
+    Returns the literal text that every match of the pattern has to start with.
+    This is conservative, an empty string is returned if the prefix can't be determined.
+    """
+    if '|' in pattern:
+        return ''
+    prefix = []
+    for c in pattern:
+        if c in SPECIAL_CHARS:
+            # the last character is optional if it has a quantifier
+            if c in QUANTIFIER_CHARS and prefix:
+                prefix.pop()
+            break
+        prefix.append(c)
+    return ''.join(prefix)
+
+
+class PathMatcher(object):
+    """
+    Matches a path against a list of regular expressions in one call.
+    The patterns without groups are combined in to a single regex. Patterns with groups are tested on their
+    own, combining them would renumber the groups their backreferences refer to. If the patterns can't be
+    combined (ex. global flags in the middle of the expression) then each pattern is tested on its own.
+    """
+
+    def __init__(self, patterns):
+        self.patterns = list(patterns)
+        self.__combined = None
+        self.__compiled = []
+        if not self.patterns:
+            return
+        compiled = [re.compile(p) for p in self.patterns]
+        simple = [p for p, c in zip(self.patterns, compiled) if c.groups == 0]
+        self.__compiled = [c for c in compiled if c.groups]
+        if not simple:
+            return
+        try:
+            self.__combined = re.compile('|'.join(f'(?:{p})' for p in simple))
+        except re.error:
+            log.debug('Patterns could not be combined, matching each pattern separately: %s', self.patterns)
+            self.__compiled = compiled
+
+    def __bool__(self):
+        return len(self.patterns) > 0
+
+    def match(self, path):
+        if self.__combined is not None and self.__combined.match(path) is not None:
+            return True
+        return any(p.match(path) for p in self.__compiled)
+
+
+class PathFilter(object):
+    """
+    Decides which relative paths are part of a sync using the exclusion and inclusion patterns.
+    Inclusions override exclusions.
+
+    Directories are tested with a trailing '/', a directory that is excluded is pruned (not listed at all)
+    when no inclusion pattern could match a path inside of it.
+
+    :param exclusions: list of regular expression strings
+    :param inclusions: list of regular expression strings
+    """
+
+    def __init__(self, exclusions, inclusions):
+        self.exclusions = PathMatcher(exclusions)
+        self.inclusions = PathMatcher(inclusions)
+        self.__includePrefixes = [literalPrefix(p) for p in inclusions]
+
+    def isIncluded(self, relativePath):
+        if not self.exclusions:
+            return True
+        if self.inclusions.match(relativePath):
+            return True
+        return not self.exclusions.match(relativePath)
+
+    def canPruneDir(self, relativePath):
+        """
+        Returns true if nothing in the directory can be part of the sync, so it doesn't need to be walked
+        :param relativePath: normalized relative path of the directory, ending with '/'
+        """
+        if self.isIncluded(relativePath):
+            return False
+        # an inclusion could still match a path in the directory unless its literal prefix rules it out
+        for prefix in self.__includePrefixes:
+            if prefix.startswith(relativePath) or relativePath.startswith(prefix):
+                return False
+        return True
+
+    def __str__(self):
+        return f'PathFilter(exclusions={self.exclusions.patterns}, inclusions={self.inclusions.patterns})'
@@ -115,7 +115,7 @@ class UpPolicy(AbstractFileSyncPolicy):
         return False
 
     def _make_transfer_action(self):
-        upload = B2UploadAction(self.sourceFile)
+        upload = B2UploadAction(self.sourceFile, self.sourceDir.hashCache)
         if self.shouldDeleteOld() and self.destinationFile is not None:
             delete = B2DeleteAction(self.destinationFile)
             return delete, upload
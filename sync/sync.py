@@ -10,20 +10,48 @@
 
 from __future__ import division
 
+import collections
+import heapq
 import logging
-import re
+import queue
 import time
 import datetime
 import threading
 
+import security
 from utility import util
 from b2_ext.exception import CommandError
+from index.index_checkpointer import IndexCheckpointer
+from utility.ByteBudget import ByteBudget
+from .action import B2UploadAction, STAGES, STAGE_PREPARE, STAGE_TRANSFER, STAGE_FINISH, BUDGET_TEMP, \
+    BUDGET_MEMORY
+from .path_entity import SkippedSubtree
+from .path_filter import PathFilter
 from .policy_manager import POLICY_MANAGER, SyncType
 from .report import SyncReport
 import concurrent.futures as futures
 
 log = logging.getLogger()
 
+# Number of files that can be waiting for a hash, per hashing worker
+HASH_LOOKAHEAD_PER_WORKER = 4
+# Max number of files the local scan can get ahead of the compare
+SCAN_QUEUE_LIMIT = 10000
+# Number of upload actions to derive secure names for at once
+SECURE_NAME_BATCH = 256
+# Max number of actions that wait for their batch of secure names, so syncs with few uploads aren't held back
+SECURE_NAME_PENDING_LIMIT = 2 * SECURE_NAME_BATCH
+# Number of actions that are reordered so the largest ones start first
+SCHEDULE_WINDOW = 1000
+# Lanes of the prepare and transfer stages, files bigger than largeFileBytes run in the large lane
+LANE_SMALL = 0
+LANE_LARGE = 1
+LANE_NAMES = ('small', 'large')
+# The large lane of a stage has this fraction of the stage's workers on top of them
+LARGE_LANE_SHARE = 4
+# Number of failed actions that are kept to list at the end of the sync, the rest are only counted
+FAILED_ACTION_LOG_LIMIT = 100
+
 
 def __nextOrNone(iterator):
     try:
@@ -32,28 +60,54 @@ def __nextOrNone(iterator):
         return None
 
 
-def __filter_folder(folder, reporter, exclusions, inclusions):
+def __all_files(folder, reporter, scan):
     """
-    Filters a folder through a list of exclusions and inclusions.
-    Inclusions override exclusions.
+    Returns the files in a folder, using the shared scan if it was made for the folder.
     """
-    log.debug('_filter_folder() exclusions for %s are %s', folder, exclusions)
-    log.debug('_filter_folder() inclusions for %s are %s', folder, inclusions)
-    useIgnore = len(exclusions) > 0
+    if scan is not None and scan.folder is folder:
+        return scan.all_files()
+    return folder.all_files(reporter)
 
-    for f in folder.all_files(reporter):
-        if useIgnore:
-            if any(pattern.match(f.name) for pattern in inclusions):
-                log.debug('_filter_folder() included %s from %s', f, folder)
-                yield f
-                continue
-            if any(pattern.match(f.name) for pattern in exclusions):
-                log.debug('_filter_folder() excluded %s from %s', f, folder)
-                continue
-        yield f
+
+def __filter_folder(folder, reporter, pathFilter, scan=None):
+    """
+    Filters a folder through a PathFilter.
+    Local folders already skip excluded paths while walking, this catches everything else.
+    """
+    log.debug('_filter_folder() filter for %s is %s', folder, pathFilter)
+
+    # keys sent to skip ahead are passed on to the folder
+    files = __all_files(folder, reporter, scan)
+    skipTo = None
+    while True:
+        try:
+            f = files.send(skipTo) if skipTo is not None else next(files)
+        except StopIteration:
+            return
+        skipTo = None
+        if pathFilter is not None and not isinstance(f, SkippedSubtree) and \
+                not pathFilter.isIncluded(f.relativePath):
+            log.debug('_filter_folder() excluded %s from %s', f, folder)
+            continue
+        skipTo = yield f
+
+
+def __skip_subtree(files, current, skipped):
+    """
+    Skip the files under a directory that was skipped on the other side.
+    :param files: iterator of the files that supports skipping ahead with send, like SecureFolder.all_files
+    :return: the first file after the directory
+    """
+    key = skipped.relativePath.lower()
+    if current is None or not current.relativePath.lower().startswith(key):
+        return current
+    try:
+        return files.send(key[:-1] + chr(ord(key[-1]) + 1))
+    except StopIteration:
+        return None
 
 
-def __iter_folders(folder_a, folder_b, reporter, exclusions=tuple(), inclusions=tuple()):
+def __iter_folders(folder_a, folder_b, reporter, pathFilter=None, scan=None):
     """
     An iterator over all of the files in the union of two folders,
     matching file names.
@@ -63,14 +117,26 @@ def __iter_folders(folder_a, folder_b, reporter, exclusions=tuple(), inclusions=
     file is in only one folder.
     :param folder_a: A Folder object.
     :param folder_b: A Folder object.
+    :param scan: optional SharedFolderScan for one of the folders
     """
 
-    iter_a = __filter_folder(folder_a, reporter, exclusions, inclusions)
-    iter_b = folder_b.all_files(reporter)
+    iter_a = __filter_folder(folder_a, reporter, pathFilter, scan)
+    iter_b = __all_files(folder_b, reporter, scan)
 
     current_a = __nextOrNone(iter_a)
     current_b = __nextOrNone(iter_b)
     while current_a is not None or current_b is not None:
+        # directories that match their summary in the index are skipped on both sides
+        if isinstance(current_a, SkippedSubtree):
+            reporter.update_compare(current_a.count)
+            current_b = __skip_subtree(iter_b, current_b, current_a)
+            current_a = __nextOrNone(iter_a)
+            continue
+        if isinstance(current_b, SkippedSubtree):
+            reporter.update_compare(current_b.count)
+            current_a = __skip_subtree(iter_a, current_a, current_b)
+            current_b = __nextOrNone(iter_b)
+            continue
         if (current_a != current_b):
             i = True
         if current_a is None:
@@ -92,6 +158,60 @@ def __iter_folders(folder_a, folder_b, reporter, exclusions=tuple(), inclusions=
             current_b = __nextOrNone(iter_b)
 
 
+def __needs_hash(local_file, remote_file, comparison):
+    """
+    Returns true if the policy will need the hash of the local file to compare the two files.
+    Mirrors the checks done before the hash comparison in AbstractFileSyncPolicy.
+    """
+    if comparison < 4 or local_file is None or remote_file is None:
+        return False
+    if local_file.isDir or remote_file.isDir:
+        return False
+    local_version = local_file.latest_version()
+    remote_version = remote_file.latest_version()
+    return local_version.hash is None and \
+           local_version.size == remote_version.size and \
+           local_version.mod_time == remote_version.mod_time
+
+
+def __prefetch_hashes(pairs, local_folder, local_index, comparison, executor, lookahead):
+    """
+    Hashes the local files that need a hash comparison on a worker pool ahead of the policy stage.
+    Pairs are yielded in the same order they were received, a pair is only yielded once its hash is ready.
+
+    :param pairs: iterator of (source_file, dest_file) pairs
+    :param local_folder: the local folder used to compute the hashes
+    :param local_index: index of the local file in each pair
+    :param lookahead: max number of pairs that can be waiting for hashes
+    """
+    pending = collections.deque()
+
+    def pop_ready(block):
+        pair, future = pending.popleft()
+        if future is not None:
+            # If the hash failed then leave it for the policy, it will try again and report the error
+            if block:
+                futures.wait([future])
+            if future.exception() is not None:
+                log.debug('hash prefetch failed for %s: %s', pair[local_index], future.exception())
+        return pair
+
+    for pair in pairs:
+        future = None
+        if __needs_hash(pair[local_index], pair[1 - local_index], comparison):
+            future = executor.submit(local_folder.updateHashForSubFile, pair[local_index])
+        pending.append((pair, future))
+
+        # Yield everything at the front of the queue that is done, only block if the window is full
+        while pending and (pending[0][1] is None or pending[0][1].done()):
+            yield pop_ready(False)
+        if len(pending) > lookahead:
+            yield pop_ready(True)
+
+    while pending:
+        yield pop_ready(True)
+
+
 def __make_file_sync_actions(sourceDir, source_file, destinationDir, dest_file,
                              syncType, now_millis, args):
     """
@@ -104,81 +224,386 @@ def __make_file_sync_actions(sourceDir, source_file, destinationDir, dest_file,
         yield action
 
 
-def __make_folder_sync_actions(sourceDir, destinationDir, args, now_millis, reporter):
+def __make_folder_sync_actions(sourceDir, destinationDir, args, now_millis, reporter, pathFilter=None, scan=None):
     """
     Yields a sequence of actions that will sync the destination
     folder to the source folder.
     """
-    exclusions = [re.compile(ex) for ex in args.exclude]
-    inclusions = [re.compile(inc) for inc in args.include]
-
     if (sourceDir.type(), destinationDir.type()) not in \
             [('sec', 'local'), ('local', 'sec')]:
         raise NotImplementedError("Sync support only local-to-b2 and b2-to-local")
     syncType = SyncType.UPLOAD if sourceDir.type() == 'local' else SyncType.DOWNLOAD
 
-    for (source_file, dest_file) in \
-            __iter_folders(sourceDir, destinationDir, reporter, exclusions, inclusions):
-        if source_file is None:
-            log.debug('determined that %s is not present on source', dest_file)
-        elif dest_file is None:
-            log.debug('determined that %s is not present on destination', source_file)
+    # Hash local files on a separate pool so the comparison isn't limited to one file at a time
+    if syncType == SyncType.UPLOAD:
+        localDir, localIndex = sourceDir, 0
+    else:
+        localDir, localIndex = destinationDir, 1
+    hash_executor = futures.ThreadPoolExecutor(max_workers=args.workers)
+    pairs = __prefetch_hashes(__iter_folders(sourceDir, destinationDir, reporter, pathFilter, scan),
+                              localDir, localIndex, args.comparison or 4, hash_executor,
+                              lookahead=args.workers * HASH_LOOKAHEAD_PER_WORKER)
+
+    try:
+        for (source_file, dest_file) in pairs:
+            if source_file is None:
+                log.debug('determined that %s is not present on source', dest_file)
+            elif dest_file is None:
+                log.debug('determined that %s is not present on destination', source_file)
+
+            if sourceDir.type() == 'local':
+                if source_file is not None:
+                    reporter.update_compare(1)
+            else:
+                if dest_file is not None:
+                    reporter.update_compare(1)
+
+            for action in __make_file_sync_actions(sourceDir, source_file, destinationDir, dest_file,
+                                                   syncType, now_millis, args):
+                yield action
+    finally:
+        hash_executor.shutdown()
+
+
+def __with_secure_names(actions, remoteFolder, conf):
+    """
+    Derives the secure names for upload actions in batches before they are scheduled,
+    so the uploads only have to look the names up.  The actions are passed on once a
+    batch is full, or once SECURE_NAME_PENDING_LIMIT actions are waiting.
+    """
+    secureNames = security.getSecureNames(conf)
+    pending = []
+    paths = []
+
+    def derive():
+        knownNames = {}
+        for path in paths:
+            ie = remoteFolder.secureIndex.get(path)
+            if ie is not None and ie.remoteName:
+                knownNames[path] = ie.remoteName
+        secureNames.getMany(paths, knownNames=knownNames, executor=executor)
+        paths.clear()
+
+    executor = futures.ThreadPoolExecutor(max_workers=conf.args.workers, thread_name_prefix='secure-names')
+    try:
+        for action in actions:
+            for a in (action if isinstance(action, tuple) else (action,)):
+                if isinstance(a, B2UploadAction) and not a.sourceFile.isDir:
+                    paths.append(a.sourceFile.relativePath)
+            pending.append(action)
+            if len(paths) >= SECURE_NAME_BATCH or len(pending) >= SECURE_NAME_PENDING_LIMIT:
+                if paths:
+                    derive()
+                yield from pending
+                pending.clear()
+
+        if paths:
+            derive()
+        yield from pending
+    finally:
+        executor.shutdown()
+
+
+def __largest_first(actions, window=SCHEDULE_WINDOW):
+    """
+    Reorders the actions so the largest of the next window actions is always yielded first.
+    Starting the large files early keeps them from running alone at the end of the sync.
+    """
+    heap = []
+    for seq, action in enumerate(actions):
+        heapq.heappush(heap, (-__action_bytes(action), seq, action))
+        if len(heap) > window:
+            yield heapq.heappop(heap)[2]
+    while heap:
+        yield heapq.heappop(heap)[2]
+
+
+def __action_bytes(action):
+    return action[1].get_bytes() if isinstance(action, tuple) else action.get_bytes()
 
-        if sourceDir.type() == 'local':
-            if source_file is not None:
-                reporter.update_compare(1)
-        else:
-            if dest_file is not None:
-                reporter.update_compare(1)
 
-        for action in __make_file_sync_actions(sourceDir, source_file, destinationDir, dest_file,
-                                               syncType, now_millis, args):
-            yield action
+def __lane_workers(workers):
+    # small files keep all of the workers so they aren't slowed down once the large files are done
+    return [workers, max(1, workers // LARGE_LANE_SHARE)]
 
 
-def count_files(local_folder, reporter):
+class SharedFolderScan(object):
     """
-    Counts all of the files in a local folder.
+    Walks a local folder once and feeds the files to both the progress
+    counter and the compare, so the folder isn't walked twice.
+
+    The walk runs on its own thread and the files are handed over through
+    a bounded queue, so the walk can only get queue_limit files ahead of
+    the compare.
     """
-    # Don't pass in a reporter to all_files.  Broken symlinks will be reported
-    # during the next pass when the source and dest files are compared.
-    for _ in local_folder.all_files(None):
-        reporter.update_local(1)
-    reporter.end_local()
+
+    __DONE = object()
+
+    def __init__(self, folder, reporter, pathFilter=None, queue_limit=SCAN_QUEUE_LIMIT, summaryIndex=None,
+                 useHash=False):
+        self.folder = folder
+        self.reporter = reporter
+        self.pathFilter = pathFilter
+        self.summaryIndex = summaryIndex
+        self.useHash = useHash
+        self.queue = queue.Queue(max(queue_limit, 2))
+        self.cancelled = threading.Event()
+        self.error = None
+        self.thread = threading.Thread(target=self.__run, name='local-scan', daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def __run(self):
+        try:
+            for f in self.folder.all_files(self.reporter, self.pathFilter, self.summaryIndex, self.useHash):
+                if self.cancelled.is_set():
+                    break
+                self.reporter.update_local(f.count if isinstance(f, SkippedSubtree) else 1)
+                self.queue.put(f)
+        except BaseException as e:
+            log.exception('Local folder scan failed')
+            self.error = e
+        finally:
+            self.reporter.end_local()
+            self.queue.put(self.__DONE)
+
+    def all_files(self):
+        """
+        Yields the files found by the scan, can only be iterated once.
+        """
+        try:
+            while True:
+                f = self.queue.get()
+                if f is self.__DONE:
+                    break
+                yield f
+            if self.error is not None:
+                raise self.error
+        finally:
+            # If the compare stops early make sure the scan thread isn't stuck on a full queue
+            self.cancelled.set()
+            while not self.queue.empty():
+                self.queue.get_nowait()
+
+    def stop(self):
+        """
+        Stops the walk if it's still running and waits for its thread, the
+        queue is drained so the thread can't be stuck on it.
+        """
+        self.cancelled.set()
+        while self.thread.is_alive():
+            try:
+                self.queue.get(timeout=0.1)
+            except queue.Empty:
+                pass
 
 
-class BoundedQueueExecutor(object):
+class PipelineStage(object):
     """
-    Wraps a futures.Executor and limits the number of requests that
-    can be queued at once.  Requests to submit() tasks block until
-    there is room in the queue.
+    One stage of a StagedExecutor, a thread pool with a bounded queue.
 
-    The number of available slots in the queue is tracked with a
-    semaphore that is acquired before queueing an action, and
-    released when an action finishes.
+    The number of tasks in the stage (queued, running or waiting for room
+    in the next stage) is tracked with a semaphore that is acquired before
+    queueing a task, and released when the task has moved on.  A stage
+    without a queue_limit doesn't limit its queue.
     """
 
-    def __init__(self, executor, queue_limit):
-        self.executor = executor
-        self.semaphore = threading.Semaphore(queue_limit)
+    def __init__(self, name, workers, queue_limit, lane=None):
+        self.name = name
+        self.lane = lane
+        self.workers = workers
+        self.executor = futures.ThreadPoolExecutor(max_workers=workers,
+                                                   thread_name_prefix=f'{name}-{lane}' if lane else name)
+        self.semaphore = threading.Semaphore(workers + queue_limit) if queue_limit is not None else None
+        self.lock = threading.Lock()
+        self.tasks = 0
+        # seconds spent running tasks, waiting in the queue and waiting for room in the next stage
+        self.busy = 0.0
+        self.queued = 0.0
+        self.blocked = 0.0
+
+    def add_times(self, busy, queued, blocked):
+        with self.lock:
+            self.tasks += 1
+            self.busy += busy
+            self.queued += queued
+            self.blocked += blocked
+
+    def stats(self, elapsed):
+        """
+        :return: dict with the number of tasks, the fraction of the worker time spent running tasks
+                 and blocked on the next stage, and the average time a task waited in the queue
+        """
+        with self.lock:
+            capacity = self.workers * elapsed
+            return {'name': f'{self.name} ({self.lane})' if self.lane else self.name,
+                    'workers': self.workers,
+                    'tasks': self.tasks,
+                    'utilization': self.busy / capacity if capacity else 0.0,
+                    'blocked': self.blocked / capacity if capacity else 0.0,
+                    'avgQueued': self.queued / self.tasks if self.tasks else 0.0}
+
+
+class StagedExecutor(object):
+    """
+    Runs tasks through a pipeline of stages, each with its own thread
+    pool and bounded queue, so CPU bound and network bound work can be
+    given different numbers of workers.
+
+    submit() blocks while queue_limit tasks haven't finished.  A task can
+    also need bytes from one of the budgets, it waits in the budget until
+    there is room and then starts the first stage, which isn't limited by
+    count so later tasks that fit aren't held up.  A worker that finishes
+    a stage blocks until there is room in the next one, so a slow stage
+    holds back the stages before it instead of letting their results
+    pile up.  A task is not run in the later stages once one of its
+    stages raises.
+
+    A stage can be split in to lanes that each have their own workers and
+    queue, a task runs in the lane it was submitted to.
+    """
 
-    def submit(self, fcn, *args, **kwargs):
-        # Wait until there is room in the queue.
+    def __init__(self, stages, queue_limit, budgets=None, lanes=None):
+        """
+        :param stages: list of (name, workers, queue_limit) in the order the stages run, the queue_limit of the
+                       first stage is ignored. workers can be a list with the number of workers in each lane.
+        :param queue_limit: max number of tasks that can be waiting or running in any stage
+        :param budgets: dict of name -> ByteBudget
+        :param lanes: names of the lanes
+        """
+        self.stages = []
+        for i, (name, workers, limit) in enumerate(stages):
+            if isinstance(workers, (list, tuple)):
+                self.stages.append([PipelineStage(name, w, limit if i else None, lanes[lane])
+                                    for lane, w in enumerate(workers)])
+            else:
+                self.stages.append([PipelineStage(name, workers, limit if i else None)])
+        self.semaphore = threading.Semaphore(queue_limit)
+        self.budgets = budgets or {}
+        # tasks that were submitted and haven't finished, some of them might still be waiting in a budget
+        self.pending = 0
+        self.idle = threading.Condition()
+        self.started = time.monotonic()
+        self.finished = None
+
+    def submit(self, fcn, *args, budget=None, lane=0):
+        """
+        Runs fcn(stageName, *args) in each stage.
+        :param budget: (budgetName, bytes) the task uses from when it starts until it finishes, or None
+        :param lane: index of the lane to run in, stages without lanes ignore it
+        :return: future with the result of the last stage
+        """
         self.semaphore.acquire()
-
-        # Wrap the action in a function that will release
-        # the semaphore after it runs.
-        def run_it():
+        with self.idle:
+            self.pending += 1
+        future = futures.Future()
+        future.set_running_or_notify_cancel()
+        task = (fcn, args, future, budget, lane)
+        if budget is None:
+            self.__enter(0, task)
+        else:
+            self.budgets[budget[0]].submit(budget[1], lambda: self.__enter(0, task))
+        return future
+
+    def __stage(self, index, task):
+        lanes = self.stages[index]
+        return lanes[task[4]] if len(lanes) > 1 else lanes[0]
+
+    def __enter(self, index, task):
+        stage = self.__stage(index, task)
+        if stage.semaphore is not None:
+            stage.semaphore.acquire()
+        stage.executor.submit(self.__run, index, task, time.monotonic())
+
+    def __run(self, index, task, queued):
+        fcn, args, future = task[:3]
+        stage = self.__stage(index, task)
+        start = time.monotonic()
+        try:
             try:
-                fcn(*args, **kwargs)
-            finally:
-                self.semaphore.release()
-
-        # Submit the wrapped action.
-        return self.executor.submit(run_it)
+                result = fcn(stage.name, *args)
+            except BaseException as e:
+                stage.add_times(time.monotonic() - start, start - queued, 0.0)
+                self.__done(task)
+                future.set_exception(e)
+                return
+            end = time.monotonic()
+            if index + 1 < len(self.stages):
+                self.__enter(index + 1, task)
+            else:
+                self.__done(task)
+                future.set_result(result)
+            stage.add_times(end - start, start - queued, time.monotonic() - end)
+        finally:
+            if stage.semaphore is not None:
+                stage.semaphore.release()
+
+    def __done(self, task):
+        budget = task[3]
+        if budget is not None:
+            self.budgets[budget[0]].release(budget[1])
+        self.semaphore.release()
+        with self.idle:
+            self.pending -= 1
+            if not self.pending:
+                self.idle.notify_all()
 
     def shutdown(self):
-        self.executor.shutdown()
+        # tasks that are waiting in a budget haven't been given to the first stage yet
+        with self.idle:
+            while self.pending:
+                self.idle.wait()
+        for lanes in self.stages:
+            for stage in lanes:
+                stage.executor.shutdown()
+        self.finished = time.monotonic()
+
+    def stats(self):
+        elapsed = (self.finished or time.monotonic()) - self.started
+        return [stage.stats(elapsed) for lanes in self.stages for stage in lanes]
+
+
+class ActionResults(object):
+    """
+    Counts the actions as they finish, so the sync doesn't have to keep
+    every future (and with it the action and its files) until the end.
+    Only the first failures are kept to list once the sync is done.
+    """
+
+    def __init__(self, failure_limit=FAILED_ACTION_LOG_LIMIT):
+        self.lock = threading.Lock()
+        self.failure_limit = failure_limit
+        self.succeeded = 0
+        self.failed = 0
+        self.failed_bytes = 0
+        self.failures = []
+
+    def add(self, future, action, action_bytes):
+        """
+        Done callback of the future of an action.
+        """
+        e = future.exception()
+        with self.lock:
+            if e is None:
+                self.succeeded += 1
+                return
+            self.failed += 1
+            self.failed_bytes += action_bytes
+            if len(self.failures) < self.failure_limit:
+                # only the text, the exception's traceback would keep the action alive
+                self.failures.append(f'{action}: {e!r}')
+
+    def log_failures(self):
+        with self.lock:
+            if not self.failed:
+                return
+            log.error(f'{self.failed} actions failed ({self.failed_bytes} bytes), '
+                      f'{self.succeeded} succeeded')
+            for failure in self.failures:
+                log.error(f'Failed: {failure}')
+            if self.failed > len(self.failures):
+                log.error(f'... and {self.failed - len(self.failures)} more, see the log above')
 
 
 def sync_folders(
@@ -199,19 +624,43 @@ def sync_folders(
     # Make a reporter to report progress.
     with SyncReport(stdout, conf.args.quiet) as reporter:
 
-        # Make an executor to count files and run all of the actions.  This is
-        # not the same as the executor in the API object, which is used for
-        # uploads.  The tasks in this executor wait for uploads.  Putting them
-        # in the same thread pool could lead to deadlock.
+        # Make an executor to run all of the actions.  This is not the same
+        # as the executor in the API object, which is used for uploads.  The
+        # tasks in the transfer stage wait for uploads.  Putting them in the
+        # same thread pool could lead to deadlock.
         #
-        # We use an executor with a bounded queue to avoid using up lots of memory
-        # when syncing lots of files.
-        unbounded_executor = futures.ThreadPoolExecutor(max_workers=conf.args.workers)
-        queue_limit = conf.args.workers + 1000
-        sync_executor = BoundedQueueExecutor(unbounded_executor, queue_limit=queue_limit)
-
-        # First, start the thread that counts the local files.  That's the operation
+        # Each action is prepared (hashed, compressed and encrypted) on the
+        # CPU workers, transferred on the network workers and then recorded
+        # in the index.  The stages have bounded queues to avoid using up lots
+        # of memory when syncing lots of files, and to limit the number of
+        # prepared temp files that are waiting to be uploaded.
+        #
+        # Uploads also need temp disk space or memory until they're finished,
+        # they're only started while the bytes in flight fit in the budgets.
+        #
+        # Large files run in their own lane of the prepare and transfer
+        # stages so they can't hold up all of the small files (the upload
+        # of each large file is split in to parts on the API pool).  The
+        # large lanes have a few workers on top of the stage's workers.
+        #
+        # netWorkers is only the most transfers that can run at once.  With
+        # adaptive concurrency the b2 requests of the transfer workers and
+        # the API pool share the slots of conf.concurrency, which follows
+        # what the link and the service can take.  The slots are held per request and not per
+        # action, a large file would otherwise hold one while its parts wait
+        # for more.
+        budgets = {BUDGET_TEMP: ByteBudget(conf.maxTempBytes),
+                   BUDGET_MEMORY: ByteBudget(conf.maxMemoryBytes)}
+        sync_executor = StagedExecutor([(STAGE_PREPARE, __lane_workers(conf.args.cpuWorkers), None),
+                                        (STAGE_TRANSFER, __lane_workers(conf.args.netWorkers), conf.args.netWorkers),
+                                        (STAGE_FINISH, 1, 1000)],
+                                       queue_limit=conf.args.cpuWorkers + conf.args.netWorkers + 1000,
+                                       budgets=budgets,
+                                       lanes=LANE_NAMES)
+
+        # First, start the thread that scans the local files.  That's the operation
         # that should be fastest, and it provides scale for the progress reporting.
+        # The same scan is used for the compare so the local folder is only walked once.
         localFolder = None
         if source_folder.type() == 'local':
             localFolder = source_folder
@@ -219,9 +668,6 @@ def sync_folders(
             localFolder = dest_folder
         if localFolder is None:
             raise ValueError('neither folder is a local folder')
-        sync_executor.submit(count_files, localFolder, reporter)
-
-        # Schedule each of the actions
         remoteFolder = None
         if source_folder.type() == 'sec':
             remoteFolder = source_folder
@@ -230,36 +676,116 @@ def sync_folders(
         if remoteFolder is None:
             raise ValueError('neither folder is a b2 folder')
 
-        log.info('Starting folder scan')
-        t1 = time.time()
-        action_futures = []
-        total_files = 0
-        total_bytes = 0
-        for action in __make_folder_sync_actions(source_folder, dest_folder, conf.args, now_millis, reporter):
-            #runAction(action, remoteFolder, conf, reporter, conf.args.dryrun)
-            future = sync_executor.submit(runAction, action, remoteFolder, conf, reporter, conf.args.dryrun)
-            action_futures.append(future)
-            total_files += 1
-            total_bytes += action[1].get_bytes() if isinstance(action, tuple) else action.get_bytes()
-        reporter.end_compare(total_files, total_bytes)
-
-        # Wait for everything to finish
-        sync_executor.shutdown()
-        remoteFolder.secureIndex.flush()
-        remoteFolder.secureIndex.source.uploadIndex(remoteFolder.secureIndex)
-
-        t = time.time() - t1
-        log.info(f'Sync complete in {str(datetime.timedelta(seconds=round(t)))}')
-
-        if any(1 for f in action_futures if f.exception() is not None):
-            raise CommandError('sync is incomplete')
+        try:
+            # Filters only apply to the source folder, excluded directories in a local source aren't walked.
+            # Directories that match their summary in the index aren't compared file by file, with comparison 4
+            # the summaries include the hashes from the hash cache
+            pathFilter = PathFilter(conf.args.exclude, conf.args.include)
+            scan = SharedFolderScan(localFolder, reporter, pathFilter if localFolder is source_folder else None,
+                                    summaryIndex=remoteFolder.secureIndex,
+                                    useHash=(conf.args.comparison or 4) >= 4)
+            scan.start()
+
+            checkpointer = None
+            try:
+                # Upload the index changes while the sync is running so a crash doesn't lose them
+                if not conf.args.dryrun:
+                    checkpointer = IndexCheckpointer(remoteFolder.secureIndex, (conf.args.checkpointMinutes or 0) * 60,
+                                                     conf.checkpointBytes)
+                    checkpointer.start()
+
+                # Schedule each of the actions
+
+                log.info('Starting folder scan')
+                t1 = time.time()
+                results = ActionResults()
+                total_files = 0
+                total_bytes = 0
+                actions = __make_folder_sync_actions(source_folder, dest_folder, conf.args, now_millis, reporter,
+                                                     pathFilter, scan)
+                # only uploads to the remote folder need the names, and a dry run doesn't upload anything
+                if dest_folder is remoteFolder and not conf.args.testIndex and not conf.args.dryrun:
+                    actions = __with_secure_names(actions, remoteFolder, conf)
+                for action in __largest_first(actions):
+                    #runAction(action, remoteFolder, conf, reporter, conf.args.dryrun)
+                    action_bytes = __action_bytes(action)
+                    budget = __action_budget(action, conf, remoteFolder)
+                    lane = LANE_LARGE if action_bytes > conf.largeFileBytes else LANE_SMALL
+                    future = sync_executor.submit(runActionStage, action, remoteFolder, conf, reporter,
+                                                  conf.args.dryrun, budget=budget, lane=lane)
+                    # nothing holds on to the future or the action once it is done
+                    future.add_done_callback(lambda f, a=action, n=action_bytes: results.add(f, a, n))
+                    if checkpointer is not None:
+                        future.add_done_callback(lambda f, n=action_bytes: checkpointer.transferred(n))
+                    total_files += 1
+                    total_bytes += action_bytes
+                reporter.end_compare(total_files, total_bytes)
+            finally:
+                # Wait for the actions that were scheduled, even if the compare failed, and
+                # save the hash cache and the index so the work they did isn't lost
+                sync_executor.shutdown()
+                scan.stop()
+                if checkpointer is not None:
+                    checkpointer.stop()
+                localFolder.close()
+                remoteFolder.secureIndex.flush()
+            if not conf.args.dryrun:
+                remoteFolder.secureIndex.updateSummaries()
+            log.info('Index writes: {flushes} flushes, {changes} changes, batch avg {avgBatch:.0f} max {maxBatch}, '
+                     'latency avg {avgLatency:.3f}s max {maxLatency:.3f}s'
+                     .format(**remoteFolder.secureIndex.flushMetrics()))
+            for stats in sync_executor.stats():
+                log.info('Stage {name}: {workers} workers, {tasks} tasks, {utilization:.0%} busy, '
+                         '{blocked:.0%} waiting for the next stage, queue wait avg {avgQueued:.3f}s'.format(**stats))
+            for name, budget in budgets.items():
+                log.info('Budget {name}: limit {limit}, peak {peak}, wait avg {avgWait:.3f}s max {maxWait:.3f}s'
+                         .format(name=name, **budget.metrics()))
+            if conf.concurrency is not None:
+                log.info('Concurrency: limit {limit} of {maximum}, peak {peakLimit}, {increases} increases, '
+                         '{decreases} decreases, {congestions} busy or timed out requests'
+                         .format(**conf.concurrency.metrics()))
+            remoteFolder.secureIndex.source.uploadIndex(remoteFolder.secureIndex)
+
+            t = time.time() - t1
+            log.info(f'Sync complete in {str(datetime.timedelta(seconds=round(t)))}')
+
+            if results.failed:
+                results.log_failures()
+                raise CommandError('sync is incomplete')
+        finally:
+            # stop the background writes of the index so nothing is left for them at exit
+            remoteFolder.secureIndex.close()
+
+
+def __action_budget(action, conf, remoteFolder):
+    """
+    :return: (budgetName, bytes) the action needs until it's finished, or None
+    """
+    if conf.args.dryrun:
+        return None
+    budget = None
+    for a in (action if isinstance(action, tuple) else (action,)):
+        b = a.get_budget(conf, remoteFolder)
+        if b is not None and (budget is None or b[1] > budget[1]):
+            budget = b
+    return budget
 
 def runAction(action, remoteFolder, conf, reporter, dry_run):
+    for stage in STAGES:
+        runActionStage(stage, action, remoteFolder, conf, reporter, dry_run)
+
+def runActionStage(stage, action, remoteFolder, conf, reporter, dry_run):
     if isinstance(action, tuple):
         actions = [action[0], action[1]]
     else:
         actions = [action]
 
-    for a in actions:
-        log.debug(f'scheduling action {a} on {remoteFolder}')
-        a.run(remoteFolder, conf, reporter, dry_run)
\ No newline at end of file
+    try:
+        for a in actions:
+            log.debug(f'running {stage} of action {a} on {remoteFolder}')
+            a.run_stage(stage, remoteFolder, conf, reporter, dry_run)
+    except BaseException:
+        # the later stages of the whole unit won't run, not only the ones of the action that failed
+        for a in actions:
+            a.cleanup(remoteFolder)
+        raise
\ No newline at end of file
@@ -0,0 +1,119 @@
+import logging
+import time
+from threading import Condition
+
+log = logging.getLogger()
+
+
+class AimdController(object):
+    """Adjusts the number of requests that can run at once to what the link and the service can take.
+
+    c = AimdController(4, maximum=20)
+    c.acquire()        # before each request, blocks while limit requests are running
+    c.success(nbytes)  # the request worked and transferred nbytes
+    c.congestion()     # the service was busy (503, 429) or the request timed out
+    c.release()        # after each request
+
+    Every interval seconds the throughput of the interval is compared with the one before. The limit grows by
+    one while the throughput keeps improving by more than tolerance and the requests are actually using the
+    whole limit. Once it stops improving the limit is held, and probed again every probeIntervals intervals in
+    case the link got faster. Congestion cuts the limit by decrease, at most once per interval so one burst
+    of errors only counts once.
+    """
+
+    def __init__(self, initial, minimum=1, maximum=64, interval=5.0, decrease=0.7, tolerance=0.05,
+                 probeIntervals=6):
+        self.minimum = minimum
+        self.maximum = max(minimum, maximum)
+        self.limit = float(min(max(initial, minimum), self.maximum))
+        self.interval = interval
+        self.decrease = decrease
+        self.tolerance = tolerance
+        self.probeIntervals = probeIntervals
+        self.__cond = Condition()
+        self.__inFlight = 0
+        self.__lastCut = None
+        # the interval that is being measured
+        self.__windowStart = time.monotonic()
+        self.__windowBytes = 0
+        self.__windowPeak = 0
+        self.__windowCongested = False
+        self.__lastThroughput = None
+        self.__holding = 0
+        self.increases = 0
+        self.decreases = 0
+        self.congestions = 0
+        self.peakLimit = int(self.limit)
+
+    def acquire(self):
+        with self.__cond:
+            while self.__inFlight >= int(self.limit):
+                self.__cond.wait()
+            self.__inFlight += 1
+            self.__windowPeak = max(self.__windowPeak, self.__inFlight)
+
+    def release(self):
+        with self.__cond:
+            self.__inFlight -= 1
+            self.__cond.notify()
+
+    def success(self, nbytes):
+        with self.__cond:
+            self.__windowBytes += nbytes
+            self.__adjust(time.monotonic())
+
+    def congestion(self):
+        with self.__cond:
+            now = time.monotonic()
+            self.congestions += 1
+            self.__windowCongested = True
+            if self.__lastCut is None or now - self.__lastCut >= self.interval:
+                self.__lastCut = now
+                self.__setLimit(max(self.minimum, self.limit * self.decrease))
+                self.decreases += 1
+                # the next interval is measured with the new limit
+                self.__startWindow(now, None)
+            else:
+                self.__adjust(now)
+
+    def __adjust(self, now):
+        elapsed = now - self.__windowStart
+        if elapsed < self.interval:
+            return
+        throughput = self.__windowBytes / elapsed
+        if not self.__windowCongested and self.__windowPeak >= int(self.limit):
+            improved = self.__lastThroughput is None or throughput > self.__lastThroughput * (1 + self.tolerance)
+            self.__holding = 0 if improved else self.__holding + 1
+            if (improved or self.__holding >= self.probeIntervals) and self.limit < self.maximum:
+                self.__holding = 0
+                self.__setLimit(self.limit + 1)
+                self.increases += 1
+        self.__startWindow(now, throughput)
+
+    def __startWindow(self, now, throughput):
+        self.__windowStart = now
+        self.__windowBytes = 0
+        self.__windowPeak = self.__inFlight
+        self.__windowCongested = False
+        self.__lastThroughput = throughput
+
+    def __setLimit(self, limit):
+        old = int(self.limit)
+        self.limit = float(min(limit, self.maximum))
+        self.peakLimit = max(self.peakLimit, int(self.limit))
+        if int(self.limit) != old:
+            log.debug(f'Concurrency limit changed from {old} to {int(self.limit)}')
+        self.__cond.notify_all()
+
+    def metrics(self):
+        """
+        :return: dict with the current and peak limit, and the number of increases, decreases and congestion
+                 signals
+        """
+        with self.__cond:
+            return {'limit': int(self.limit),
+                    'peakLimit': self.peakLimit,
+                    'maximum': self.maximum,
+                    'increases': self.increases,
+                    'decreases': self.decreases,
+                    'congestions': self.congestions}
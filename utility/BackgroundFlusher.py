@@ -0,0 +1,115 @@
+import logging
+import time
+from threading import Thread, Condition, Lock, current_thread
+
+log = logging.getLogger()
+
+
+class BackgroundFlusher(Thread):
+    """Call a flush function from one long lived thread once changes have been idle
+    for idleDelay seconds, or at the latest maxDelay seconds after the first change:
+
+    f = BackgroundFlusher(2, 5, flush)
+    f.start()
+    f.changed() # after each change
+    f.flush()   # flush now and wait for it to finish
+    f.stop()    # stop the thread and wait for it, changes that are still waiting are left for flush()
+
+    The flush function returns the number of changes it wrote, it's used for the batch size metrics.
+    If it raises on the background thread the error is logged and the flush is tried again after idleDelay,
+    the function has to keep the changes it couldn't write.
+    """
+
+    def __init__(self, idleDelay, maxDelay, function, name=None):
+        Thread.__init__(self, name=name, daemon=True)
+        self.idleDelay = idleDelay
+        self.maxDelay = maxDelay
+        self.function = function
+        self.__cond = Condition()
+        # time of the first and the last change that hasn't been flushed, None if there are no changes
+        self.__firstChange = None
+        self.__lastChange = None
+        self.__stopped = False
+        self.__metricsLock = Lock()
+        self.flushes = 0
+        self.flushedChanges = 0
+        self.maxBatch = 0
+        self.totalLatency = 0.0
+        self.maxLatency = 0.0
+
+    def changed(self):
+        now = time.monotonic()
+        with self.__cond:
+            self.__lastChange = now
+            if self.__firstChange is None:
+                # only wake the thread when it's waiting without a timeout
+                self.__firstChange = now
+                self.__cond.notify()
+
+    def flush(self):
+        """Flush on the calling thread, all changes made before the call are written when it returns"""
+        with self.__cond:
+            self.__firstChange = None
+            self.__lastChange = None
+        self.__flush()
+
+    def stop(self):
+        with self.__cond:
+            self.__stopped = True
+            self.__cond.notify()
+        # a flush that is running finishes first
+        if self.is_alive() and current_thread() is not self:
+            self.join()
+
+    def run(self):
+        with self.__cond:
+            while not self.__stopped:
+                if self.__firstChange is None:
+                    self.__cond.wait()
+                    continue
+                due = min(self.__lastChange + self.idleDelay, self.__firstChange + self.maxDelay)
+                remaining = due - time.monotonic()
+                if remaining > 0:
+                    self.__cond.wait(remaining)
+                    continue
+                self.__firstChange = None
+                self.__lastChange = None
+                failed = None
+                # changes made while flushing start a new batch
+                self.__cond.release()
+                try:
+                    self.__flush()
+                except Exception:
+                    log.exception(f'Background flush failed, retrying in {self.idleDelay} seconds')
+                    failed = time.monotonic()
+                finally:
+                    self.__cond.acquire()
+                if failed is not None:
+                    # the failed batch is still waiting, count it as a change so it's retried
+                    self.__firstChange = self.__firstChange or failed
+                    self.__lastChange = max(self.__lastChange or failed, failed)
+
+    def __flush(self):
+        start = time.monotonic()
+        count = self.function() or 0
+        latency = time.monotonic() - start
+        if count:
+            with self.__metricsLock:
+                self.flushes += 1
+                self.flushedChanges += count
+                self.maxBatch = max(self.maxBatch, count)
+                self.totalLatency += latency
+                self.maxLatency = max(self.maxLatency, latency)
+
+    def metrics(self):
+        """
+        :return: dict with the number of flushes that wrote something, the number of changes written,
+                 the average and max batch size and the average and max flush latency in seconds
+        """
+        with self.__metricsLock:
+            return {'flushes': self.flushes,
+                    'changes': self.flushedChanges,
+                    'avgBatch': self.flushedChanges / self.flushes if self.flushes else 0,
+                    'maxBatch': self.maxBatch,
+                    'avgLatency': self.totalLatency / self.flushes if self.flushes else 0.0,
+                    'maxLatency': self.maxLatency}
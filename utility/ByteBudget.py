@@ -0,0 +1,105 @@
+import time
+from collections import deque
+from threading import Lock
+
+
+class ByteBudget(object):
+    """Start tasks while the bytes used by the running tasks stay under a limit.
+
+    b = ByteBudget(4 * 1024 ** 3)
+    b.submit(size, start) # calls start() now, or later from the release() that makes room for it
+    b.release(size)       # once the task is done with its bytes
+
+    start() is called without holding the lock and must not block.
+
+    Tasks up to smallBytes are small, the rest are large. Large tasks are started in order and only use up to
+    limit - reserve between them, so there is always room for small tasks and they aren't stuck behind a large
+    one. While a large task is waiting the small tasks only get the reserve, so they can't starve it either.
+    A task bigger than its share of the limit is counted as using the whole share, it runs once the other large
+    tasks are done.
+    """
+
+    def __init__(self, limit, smallBytes=None, reserve=None):
+        self.limit = limit
+        self.reserve = reserve if reserve is not None else limit // 8
+        self.smallBytes = min(smallBytes if smallBytes is not None else limit // 64, self.reserve)
+        self.__lock = Lock()
+        self.__small = deque()
+        self.__large = deque()
+        self.inFlight = 0
+        self.smallInFlight = 0
+        self.largeInFlight = 0
+        self.peak = 0
+        self.waits = 0
+        self.totalWait = 0.0
+        self.maxWait = 0.0
+
+    def cost(self, size):
+        """
+        :return: the bytes a task of this size is counted as using
+        """
+        if size <= self.smallBytes:
+            return size
+        return min(size, self.limit - self.reserve)
+
+    def submit(self, size, start):
+        with self.__lock:
+            queue = self.__small if size <= self.smallBytes else self.__large
+            queue.append((self.cost(size), start, time.monotonic()))
+            ready = self.__admit()
+        for start in ready:
+            start()
+
+    def release(self, size):
+        cost = self.cost(size)
+        with self.__lock:
+            self.inFlight -= cost
+            if size <= self.smallBytes:
+                self.smallInFlight -= cost
+            else:
+                self.largeInFlight -= cost
+            ready = self.__admit()
+        for start in ready:
+            start()
+
+    def __admit(self):
+        """
+        :return: the start functions of the tasks that fit, called with the lock held
+        """
+        ready = []
+        now = time.monotonic()
+        while self.__large:
+            cost, start, queued = self.__large[0]
+            if self.largeInFlight + cost > self.limit - self.reserve or self.inFlight + cost > self.limit:
+                break
+            self.__large.popleft()
+            self.largeInFlight += cost
+            self.__started(cost, queued, now)
+            ready.append(start)
+        while self.__small:
+            cost, start, queued = self.__small[0]
+            if self.inFlight + cost > self.limit or (self.__large and self.smallInFlight + cost > self.reserve):
+                break
+            self.__small.popleft()
+            self.smallInFlight += cost
+            self.__started(cost, queued, now)
+            ready.append(start)
+        return ready
+
+    def __started(self, cost, queued, now):
+        self.inFlight += cost
+        self.peak = max(self.peak, self.inFlight)
+        wait = now - queued
+        self.waits += 1
+        self.totalWait += wait
+        self.maxWait = max(self.maxWait, wait)
+
+    def metrics(self):
+        """
+        :return: dict with the limit, the peak bytes in flight, and the average and max time a task waited
+        """
+        with self.__lock:
+            return {'limit': self.limit,
+                    'peak': self.peak,
+                    'avgWait': self.totalWait / self.waits if self.waits else 0.0,
+                    'maxWait': self.maxWait}
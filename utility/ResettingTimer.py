@@ -1,41 +0,0 @@
-from threading import Thread, Event
-
-class ResettingTimer(Thread):
-    """Call a function after a specified number of seconds:
-
-    t = TimerReset(30.0, f, args=[], kwargs={})
-    t.start()
-    t.cancel() # stop the timer's action if it's still waiting
-    """
-
-    def __init__(self, interval, function, args=[], kwargs={}):
-        Thread.__init__(self)
-        self.interval = interval
-        self.function = function
-        self.args = args
-        self.kwargs = kwargs
-        self.finished = Event()
-        self.resetted = True
-
-    def cancel(self):
-        """Stop the timer if it hasn't finished yet"""
-        self.finished.set()
-
-    def run(self):
-        while self.resetted:
-            self.resetted = False
-            self.finished.wait(self.interval)
-
-        if not self.finished.isSet():
-            self.function(*self.args, **self.kwargs)
-        self.finished.set()
-
-    def reset(self, interval=None):
-        """ Reset the timer """
-
-        if interval:
-            self.interval = interval
-
-        self.resetted = True
-        self.finished.set()
-        self.finished.clear()
\ No newline at end of file
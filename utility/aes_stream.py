@@ -0,0 +1,157 @@
+import os
+import struct
+
+from utility.byte_buffer import Buffer
+
+try:
+    from cryptography.exceptions import InvalidTag
+    from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+except ImportError:
+    AESGCM = None
+    InvalidTag = None
+
+# Format:
+#   header:   MAGIC | VERSION | key nonce (12) | data key encrypted with the key encryption key (32 + 16 tag)
+#             | segment nonce prefix (8)
+#   segments: AES-GCM encrypted SEGMENT_SIZE chunks of plain data, 16 byte tag each, only the last can be shorter.
+#             The nonce is the prefix + 4 byte segment counter and the last segment is authenticated as the last
+#             one, so segments can't be reordered, dropped or truncated without failing.
+MAGIC = b'SSAE'
+VERSION = b'\x01'
+SEGMENT_SIZE = 64 * 1024
+TAG_SIZE = 16
+KEY_NONCE_SIZE = 12
+NONCE_PREFIX_SIZE = 8
+WRAPPED_KEY_SIZE = 32 + TAG_SIZE
+HEADER_SIZE = len(MAGIC) + len(VERSION) + KEY_NONCE_SIZE + WRAPPED_KEY_SIZE + NONCE_PREFIX_SIZE
+LAST_SEGMENT = b'\x01'
+NOT_LAST_SEGMENT = b'\x00'
+
+
+class AesStreamError(Exception):
+    pass
+
+
+def checkAvailable():
+    if AESGCM is None:
+        raise AesStreamError('The cryptography package is required for AES encryption (pip install cryptography)')
+
+
+def _readFull(stream, size):
+    buf = bytearray()
+    while len(buf) < size:
+        data = stream.read(size - len(buf))
+        if not data:
+            break
+        buf.extend(data)
+    return bytes(buf)
+
+
+def _nonce(prefix, counter):
+    return prefix + struct.pack('>I', counter)
+
+
+class AesEncryptStream(object):
+    def __init__(self, instream, keyEncryptionKey):
+        """
+        Create a stream that encrypts the input with a new random data key using AES-GCM.
+        The data key is stored in the header, encrypted with the key encryption key.
+        :param instream: stream-like object to encrypt
+        :param keyEncryptionKey: 32 byte key used to encrypt the data key
+        """
+        checkAvailable()
+        self.__input = instream
+        self.__buf = Buffer()
+        self.__next = None
+        self.__counter = 0
+        self.__done = False
+
+        dataKey = AESGCM.generate_key(bit_length=256)
+        self.__aes = AESGCM(dataKey)
+        self.__noncePrefix = os.urandom(NONCE_PREFIX_SIZE)
+        keyNonce = os.urandom(KEY_NONCE_SIZE)
+        wrappedKey = AESGCM(keyEncryptionKey).encrypt(keyNonce, dataKey, MAGIC + VERSION)
+        self.__buf.write(MAGIC + VERSION + keyNonce + wrappedKey + self.__noncePrefix)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.__input = None
+        self.__aes = None
+        self.__buf = None
+        return
+
+    def read(self, size=-1):
+        while not self.__done and (size < 0 or len(self.__buf) < size):
+            self.__encryptSegment()
+        return self.__buf.read(size)
+
+    def __encryptSegment(self):
+        # read one segment ahead so we know which segment is the last one
+        data = self.__next if self.__next is not None else _readFull(self.__input, SEGMENT_SIZE)
+        self.__next = _readFull(self.__input, SEGMENT_SIZE) if len(data) == SEGMENT_SIZE else b''
+        last = len(self.__next) == 0
+        nonce = _nonce(self.__noncePrefix, self.__counter)
+        self.__buf.write(self.__aes.encrypt(nonce, data, LAST_SEGMENT if last else NOT_LAST_SEGMENT))
+        self.__counter += 1
+        self.__done = last
+
+
+class AesDecryptStream(object):
+    def __init__(self, instream, keyEncryptionKey):
+        """
+        Create a stream that decrypts data written by AesEncryptStream.
+        :param instream: stream-like object to decrypt
+        :param keyEncryptionKey: 32 byte key the data key was encrypted with
+        """
+        checkAvailable()
+        self.__input = instream
+        self.__buf = Buffer()
+        self.__next = None
+        self.__counter = 0
+        self.__done = False
+
+        header = _readFull(instream, HEADER_SIZE)
+        if len(header) != HEADER_SIZE or not header.startswith(MAGIC):
+            raise AesStreamError('Not an AES encrypted stream')
+        if header[len(MAGIC):len(MAGIC) + len(VERSION)] != VERSION:
+            raise AesStreamError('Unsupported AES stream version')
+        offset = len(MAGIC) + len(VERSION)
+        keyNonce = header[offset:offset + KEY_NONCE_SIZE]
+        offset += KEY_NONCE_SIZE
+        wrappedKey = header[offset:offset + WRAPPED_KEY_SIZE]
+        offset += WRAPPED_KEY_SIZE
+        self.__noncePrefix = header[offset:]
+        try:
+            dataKey = AESGCM(keyEncryptionKey).decrypt(keyNonce, wrappedKey, MAGIC + VERSION)
+        except InvalidTag:
+            raise AesStreamError('Failed to decrypt the data key, wrong passphrase or salt?')
+        self.__aes = AESGCM(dataKey)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.__input = None
+        self.__aes = None
+        self.__buf = None
+        return
+
+    def read(self, size=-1):
+        while not self.__done and (size < 0 or len(self.__buf) < size):
+            self.__decryptSegment()
+        return self.__buf.read(size)
+
+    def __decryptSegment(self):
+        segmentSize = SEGMENT_SIZE + TAG_SIZE
+        data = self.__next if self.__next is not None else _readFull(self.__input, segmentSize)
+        self.__next = _readFull(self.__input, segmentSize) if len(data) == segmentSize else b''
+        last = len(self.__next) == 0
+        nonce = _nonce(self.__noncePrefix, self.__counter)
+        try:
+            self.__buf.write(self.__aes.decrypt(nonce, data, LAST_SEGMENT if last else NOT_LAST_SEGMENT))
+        except InvalidTag:
+            raise AesStreamError(f'Encrypted data is corrupt or truncated at segment {self.__counter}')
+        self.__counter += 1
+        self.__done = last
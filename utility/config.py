@@ -64,7 +64,7 @@ def readConfig(filename,
         val = parseItem(item, t, cSsync[item])
         setattr(config, item, val)
 
-    for item in optional_items:
+    for item, t in optional_items.items():
         if not cfg.has_option(sectionName, item):
             setattr(config, item, None)
         else:
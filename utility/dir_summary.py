@@ -0,0 +1,122 @@
+import hashlib
+
+
+class _Frame(object):
+    __slots__ = ('path', 'explicit', 'stat', 'full', 'count')
+
+    def __init__(self, path, explicit):
+        self.path = path
+        # implicit directories only exist because something under them was added
+        self.explicit = explicit
+        self.stat = hashlib.sha1()
+        self.full = hashlib.sha1()
+        self.count = 0
+
+
+class DirSummaryBuilder(object):
+    """
+    Builds a merkle summary of every directory in a tree from its entries. The entries have to be added in the
+    order the index and the local walk return them (sorted by lower case path, directories with a trailing '/').
+
+    Each directory gets (statDigest, fullDigest, count):
+      statDigest - digest of the name, size and mod time of every file and the summary of every sub directory
+      fullDigest - same as statDigest but also includes the file hashes, None if any hash is unknown
+      count      - number of entries under the directory
+    A digest is None if the directory can't be summarized, two trees with the same digest have the same files.
+    """
+
+    def __init__(self, root=''):
+        self.summaries = {}
+        self.__stack = [_Frame(root, True)]
+
+    def addFile(self, path, size, modTime, hash):
+        frame = self.__enter(path, False)
+        line = f'f\0{path}\0{size}\0{modTime}'
+        if frame.stat is not None:
+            frame.stat.update((line + '\n').encode('utf-8'))
+        if frame.full is not None:
+            if hash is None:
+                frame.full = None
+            else:
+                frame.full.update(f'{line}\0{hash}\n'.encode('utf-8'))
+        frame.count += 1
+
+    def addDir(self, path, summary=None):
+        """
+        :param summary: known summary of the directory, nothing under the directory can be added after it
+        """
+        frame = self.__enter(path, True)
+        if summary is None:
+            self.__stack.append(_Frame(path, True))
+        else:
+            self.__addSummary(frame, path, True, summary)
+
+    def invalidate(self, path):
+        """
+        Add an entry that stops the directory containing it from being summarized
+        """
+        frame = self.__enter(path, path.endswith('/'))
+        frame.stat = None
+        frame.full = None
+        frame.count += 1
+
+    def finish(self):
+        """
+        :return: dict of directory path -> (statDigest, fullDigest, count)
+        """
+        while self.__stack:
+            self.__close()
+        return self.summaries
+
+    def __enter(self, path, isDir):
+        """
+        Close the directories that don't contain the path and open the ones that do
+        :return: the frame of the directory directly containing the path
+        """
+        while len(self.__stack) > 1 and not path.startswith(self.__stack[-1].path):
+            self.__close()
+        end = len(path) - 1 if isDir else len(path)
+        parent = path[:path.rfind('/', 0, end) + 1]
+        while self.__stack[-1].path != parent and parent.startswith(self.__stack[-1].path):
+            top = self.__stack[-1].path
+            self.__stack.append(_Frame(parent[:parent.index('/', len(top)) + 1], False))
+        return self.__stack[-1]
+
+    def __close(self):
+        frame = self.__stack.pop()
+        summary = (frame.stat.hexdigest() if frame.stat is not None else None,
+                   frame.full.hexdigest() if frame.full is not None else None,
+                   frame.count)
+        if frame.path in self.summaries:
+            # paths that only differ in case are mixed together in the sort order
+            summary = (None, None, frame.count)
+        self.summaries[frame.path] = summary
+        if self.__stack:
+            self.__addSummary(self.__stack[-1], frame.path, frame.explicit, summary)
+
+    @staticmethod
+    def __addSummary(frame, path, explicit, summary):
+        statDigest, fullDigest, count = summary
+        kind = 'd' if explicit else 'i'
+        if frame.stat is not None:
+            if statDigest is None:
+                frame.stat = None
+            else:
+                frame.stat.update(f'{kind}\0{path}\0{statDigest}\n'.encode('utf-8'))
+        if frame.full is not None:
+            if fullDigest is None:
+                frame.full = None
+            else:
+                frame.full.update(f'{kind}\0{path}\0{fullDigest}\n'.encode('utf-8'))
+        frame.count += count + (1 if explicit else 0)
+
+
+def summaryMatches(computed, stored, useHash):
+    """
+    :param useHash: compare the digests that include the file hashes
+    :return: True if both summaries are known and the same
+    """
+    if computed is None or stored is None:
+        return False
+    i = 1 if useHash else 0
+    return computed[i] is not None and computed[i] == stored[i]
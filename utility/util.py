@@ -2,15 +2,18 @@ import hashlib
 import logging
 import logging.config
 import os
+import stat
 import inspect
 from contextlib import contextmanager
 
 APPLICATION_EXT = '.ssynctmp'
+# large reads let hashlib release the GIL so files can be hashed in parallel
+HASH_CHUNK = 1024 * 1024
 
 def calculateHash(path):
     hash_md5 = hashlib.md5()
     with open(path, "rb") as f:
-        for chunk in iter(lambda: f.read(4096), b""):
+        for chunk in iter(lambda: f.read(HASH_CHUNK), b""):
             hash_md5.update(chunk)
     return hash_md5.hexdigest()
 
@@ -42,6 +45,34 @@ def is_int(s):
 def getModTime(filepath):
     return int(round(os.path.getmtime(filepath) * 1000))
 
+def getModTimeFromStat(st):
+    return int(round(st.st_mtime * 1000))
+
+def isReadable(st):
+    """
+    Check read permissions from a stat result, same as os.access(path, os.R_OK) without another system call.
+    Windows only has a read-only attribute so everything is readable.
+    """
+    if not hasattr(os, 'geteuid'):
+        return True
+    uid = os.geteuid()
+    if uid == 0:
+        return True
+    if st.st_uid == uid:
+        return bool(st.st_mode & stat.S_IRUSR)
+    if st.st_gid in __getGroups():
+        return bool(st.st_mode & stat.S_IRGRP)
+    return bool(st.st_mode & stat.S_IROTH)
+
+__groups = None
+
+def __getGroups():
+    global __groups
+    if __groups is None:
+        __groups = set(os.getgroups())
+        __groups.add(os.getegid())
+    return __groups
+
 def checkDirectory(path):
     if not os.path.isdir(path):
         try: